@@ -1,18 +1,36 @@
 #!/usr/bin/env python3
-import logging.config
 import sys
 
-from store import LOGGING_CONFIG
-
 try:
     assert sys.version_info >= (3, 8)
 except AssertionError:
     sys.exit('Sorry. This script requires python3 >= 3.8 version')
 
-if __name__ == "__main__":
-    from cli import Bootstrap
+# certbot hooks start a fresh interpreter several times per certificate, they skip argparse, logging config
+# and the agent runtime and import only their own module.
+HOOKS = {
+    "auth-hook": "agent.hooks.auth",
+    "deploy-hook": "agent.hooks.deploy",
+    "clean-hook": "agent.hooks.clean",
+}
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in HOOKS:
+        import importlib
+
+        return importlib.import_module(HOOKS[sys.argv[1]]).main()
+
+    import logging.config
+
+    from .cli import Bootstrap
+    from .log import LOGGING_CONFIG
 
     logging.config.dictConfig(LOGGING_CONFIG)
     bootstrap = Bootstrap()
 
     bootstrap()  # initial call
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import sqlite3
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional
+
+logger = logging.getLogger('agent.accounts')
+
+
+def _post(url, data=None, headers=None):
+    """ stdlib POST, the hook runs twice per certificate and `requests` alone doubles its start up time. """
+    request = urllib.request.Request(url, data=data, headers=headers or {}, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as error:
+        return error.code, error.read().decode()
+
+
+class AcmeDnsClient(object):
+    """
+    Handles the communication with ACME-DNS API
+    """
+
+    def __init__(self, acme_dns_url):
+        self.acme_dns_url = acme_dns_url
+
+    def register_account(self, allow_from):
+        """Registers a new ACME-DNS account"""
+
+        if allow_from:
+            # Include whitelisted networks to the registration call
+            reg_data = {"allowfrom": allow_from}
+            status, text = _post(self.acme_dns_url + "/register",
+                                 data=json.dumps(reg_data).encode())
+        else:
+            status, text = _post(self.acme_dns_url + "/register")
+        if status == 201:
+            return json.loads(text)
+        else:
+            # Encountered an error
+            msg = ("Encountered an error while trying to register a new acme-dns "
+                   "account. HTTP status {}, Response body: {}")
+            raise ValueError(msg.format(status, text))
+
+    def update_txt_record(self, account, txt):
+        """Updates the TXT challenge record to ACME-DNS subdomain."""
+        update = {"subdomain": account['subdomain'], "txt": txt}
+        headers = {"X-Api-User": account['username'],
+                   "X-Api-Key": account['password'],
+                   "Content-Type": "application/json"}
+        status, text = _post(self.acme_dns_url + "/update",
+                             headers=headers,
+                             data=json.dumps(update).encode())
+        if status == 200:
+            # Successful update
+            return update
+        else:
+            msg = ("Encountered an error while trying to update TXT record in "
+                   "acme-dns. \n"
+                   "------- Request headers:\n{}\n"
+                   "------- Request body:\n{}\n"
+                   "------- Response HTTP status: {}\n"
+                   "------- Response body: {}")
+            s_headers = json.dumps(headers, indent=2, sort_keys=True)
+            s_update = json.dumps(update, indent=2, sort_keys=True)
+            raise ValueError(msg.format(s_headers, s_update, status, text))
+
+
+def account_domain(domain: str) -> str:
+    # a wildcard validates through the same `_acme-challenge` record as its base domain.
+    return domain[2:] if domain.startswith("*.") else domain
+
+
+class AccountStore:
+    """
+    Every acme-dns account of this box in one SQLite file, looked up by domain.
+    The agent keeps all of them in memory and registers accounts when add_domain arrives,
+    the certbot auth hook opens the same file and only reads.
+    """
+    timeout = 30
+
+    def __init__(self, path: str):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            # acme-dns credentials, readable by the agent user only.
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        self.connection = sqlite3.connect(path, timeout=self.timeout, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS accounts (domain TEXT PRIMARY KEY, account TEXT NOT NULL, created REAL)"
+        )
+
+    def get(self, domain: str) -> Optional[Dict]:
+        row = self.connection.execute("SELECT account FROM accounts WHERE domain = ?",
+                                      (account_domain(domain),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, domain: str, account: Dict):
+        self.connection.execute("INSERT OR REPLACE INTO accounts (domain, account, created) VALUES (?, ?, ?)",
+                                (account_domain(domain), json.dumps(account), time.time()))
+
+    def all(self) -> Dict[str, Dict]:
+        return {domain: json.loads(account)
+                for domain, account in self.connection.execute("SELECT domain, account FROM accounts")}
+
+    def import_legacy(self, letsencrypt_path: str) -> List[str]:
+        """ one time import of the `<letsencrypt_path>/<domain>.json` files earlier auth hooks wrote. """
+        imported = []
+        for path in glob.glob(os.path.join(letsencrypt_path, "*.json")):
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+            except (IOError, ValueError):
+                continue
+            if not isinstance(data, dict):
+                continue
+            for domain, account in data.items():
+                if isinstance(account, dict) and "subdomain" in account and self.get(domain) is None:
+                    self.put(domain, account)
+                    imported.append(domain)
+        return imported
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
+
+
+class AccountCache:
+    """
+    In-agent view of the AccountStore, registrations for new domains run concurrently in the executor,
+    so the auth hook finds the account ready instead of registering one in the middle of certbot's auth phase.
+    """
+    allow_from: List[str] = []
+
+    def __init__(self, store):
+        self.accounts = AccountStore(store.accounts_path)
+        self.client = AcmeDnsClient(store.acme_dns_url)
+        imported = self.accounts.import_legacy(store.letsencrypt_path)
+        if imported:
+            logger.info(f"{self}, imported {len(imported)} acme-dns accounts from {store.letsencrypt_path}")
+        self.cache: Dict[str, Dict] = self.accounts.all()
+        self.pending: Dict[str, asyncio.Future] = {}
+
+    async def _register(self, domain: str) -> Dict:
+        try:
+            account = await asyncio.get_event_loop().run_in_executor(None, self.client.register_account,
+                                                                     self.allow_from)
+            self.accounts.put(domain, account)
+            self.cache[domain] = account
+            logger.info(f"{self}, {domain}: acme-dns account {account.get('fulldomain')} registered.")
+            return account
+        finally:
+            self.pending.pop(domain, None)
+
+    def prefetch(self, domain: str):
+        """ start registering in the background, `ensure` later joins the same registration. """
+        domain = account_domain(domain)
+        if domain in self.cache or domain in self.pending:
+            return
+        # registered by an auth hook while this agent was not looking.
+        account = self.accounts.get(domain)
+        if account is not None:
+            self.cache[domain] = account
+            return
+        self.pending[domain] = asyncio.ensure_future(self._register(domain))
+
+    async def ensure(self, domain: str) -> Dict:
+        domain = account_domain(domain)
+        if domain in self.cache:
+            return self.cache[domain]
+        self.prefetch(domain)
+        if domain in self.cache:
+            return self.cache[domain]
+        return await asyncio.shield(self.pending[domain])
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
@@ -0,0 +1,139 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Dict, Optional
+
+from .ocsp import discard_response
+from .utils import write_atomic
+from .vhost import deploy_vhost, ocsp_response_path
+
+BUNDLE_FILES = ("cert.pem", "chain.pem", "fullchain.pem", "privkey.pem")
+OPENSSL_BINARY = "openssl"
+
+
+def read_bundle(letsencrypt_path: str, domain: str) -> Dict[str, bytes]:
+    live_path = os.path.join(letsencrypt_path, "live", domain)
+    files = {}
+    for name in BUNDLE_FILES:
+        with open(os.path.join(live_path, name), 'rb') as f:
+            files[name] = f.read()
+    return files
+
+
+def _next_version(archive_path: str) -> int:
+    versions = [int(match.group(1)) for match in
+                (re.match(r"cert(\d+)\.pem$", name) for name in os.listdir(archive_path)) if match]
+    return max(versions, default=0) + 1
+
+
+def write_bundle(letsencrypt_path: str, domain: str, files: Dict[str, bytes]):
+    """
+    certbot layout: numbered files in `archive/<domain>/`, `live/<domain>/*.pem` are relative symlinks to the
+    newest ones. Every link is swapped with a rename, nginx reading during an install sees old or new files.
+    """
+    if "fullchain.pem" not in files:
+        files = {**files, "fullchain.pem": files["cert.pem"] + files["chain.pem"]}
+    missing = [name for name in BUNDLE_FILES if not files.get(name)]
+    if missing:
+        raise ValueError(f"bundle for {domain} misses {', '.join(missing)}")
+
+    archive_path = os.path.join(letsencrypt_path, "archive", domain)
+    live_path = os.path.join(letsencrypt_path, "live", domain)
+    os.makedirs(archive_path, mode=0o700, exist_ok=True)
+    os.makedirs(live_path, exist_ok=True)
+
+    version = _next_version(archive_path)
+    for name in BUNDLE_FILES:
+        target = os.path.join(archive_path, f"{name[:-4]}{version}.pem")
+        write_atomic(target, files[name], 0o600 if name == "privkey.pem" else 0o644)
+    for name in BUNDLE_FILES:
+        link = os.path.join(live_path, name)
+        tmp_link = f"{link}.tmp"
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.relpath(os.path.join(archive_path, f"{name[:-4]}{version}.pem"), live_path), tmp_link)
+        os.replace(tmp_link, link)
+
+
+def install_bundle(nginx_path: str, letsencrypt_path: str, domain: str, files: Dict[str, bytes],
+                   vhost_mode: str = "domain", access_log_mode: str = "domain") -> bool:
+    """ certificate issued elsewhere: write it, drop the previous certificate's OCSP response, render the vhost. """
+    write_bundle(letsencrypt_path, domain, files)
+    discard_response(ocsp_response_path(letsencrypt_path, domain))
+    return deploy_vhost(nginx_path, letsencrypt_path, domain, vhost_mode, access_log_mode)
+
+
+async def _openssl(*args, data: bytes) -> bytes:
+    process = await asyncio.create_subprocess_exec(OPENSSL_BINARY, *args,
+                                                   stdin=asyncio.subprocess.PIPE,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE,
+                                                   )
+    stdout, stderr = await process.communicate(data)
+    if process.returncode != 0:
+        raise ValueError(f"openssl {args[0]}: {stderr.decode().strip()}")
+    return stdout
+
+
+async def verify_bundle(files: Dict[str, bytes]):
+    """ raises ValueError unless the private key belongs to the certificate and the certificate is not expired. """
+    cert_key = await _openssl("x509", "-noout", "-pubkey", data=files["cert.pem"])
+    private_key = await _openssl("pkey", "-pubout", data=files["privkey.pem"])
+    if cert_key != private_key:
+        raise ValueError("private key does not match the certificate")
+    try:
+        await _openssl("x509", "-noout", "-checkend", "0", data=files["cert.pem"])
+    except ValueError:
+        raise ValueError("certificate has expired")
+
+
+class BundleAssembler:
+    """
+    Reassembles `install_bundle` payloads, a bundle is sent whole as `files` or as base64 `data` chunks of its
+    JSON encoding, `{"transfer_id", "chunk", "chunks", "data"}` with `sha256` of the joined JSON on any chunk.
+    Unfinished transfers are forgotten after `timeout`.
+    """
+    timeout = 5 * 60
+    max_size = 4 * 1024 * 1024
+
+    def __init__(self):
+        self.transfers: Dict[str, Dict] = {}
+
+    def expire(self, now: float):
+        for transfer_id in [transfer_id for transfer_id, transfer in self.transfers.items()
+                            if now - transfer["started"] > self.timeout]:
+            del self.transfers[transfer_id]
+
+    def add(self, payload: Dict) -> Optional[Dict[str, bytes]]:
+        """ returns the bundle files once complete, None while chunks are missing. """
+        if "files" in payload:
+            return {name: content.encode() for name, content in payload["files"].items()}
+
+        now = time.monotonic()
+        self.expire(now)
+        transfer_id, chunk, chunks = str(payload["transfer_id"]), int(payload["chunk"]), int(payload["chunks"])
+        if not 0 <= chunk < chunks:
+            raise ValueError(f"bundle transfer {transfer_id} chunk {chunk} of {chunks}")
+        transfer = self.transfers.setdefault(transfer_id, {"started": now, "parts": {}, "size": 0, "sha256": None})
+        part = base64.b64decode(payload["data"])
+        transfer["size"] += len(part)
+        if transfer["size"] > self.max_size:
+            del self.transfers[transfer_id]
+            raise ValueError(f"bundle transfer {transfer_id} exceeds {self.max_size} bytes")
+        transfer["parts"][chunk] = part
+        transfer["sha256"] = payload.get("sha256") or transfer["sha256"]
+        if len(transfer["parts"]) < chunks:
+            return None
+
+        del self.transfers[transfer_id]
+        data = b"".join(transfer["parts"][number] for number in range(chunks))
+        if transfer["sha256"] and hashlib.sha256(data).hexdigest() != transfer["sha256"]:
+            raise ValueError(f"bundle transfer {transfer_id} checksum mismatch")
+        return {name: content.encode() for name, content in json.loads(data)["files"].items()}
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
@@ -1,14 +1,29 @@
 import argparse
+import glob
+import json
 import logging.handlers
 import os
 import subprocess
 import sys
+import time
+from datetime import datetime, timezone
 
-logger = logging.getLogger('agent')
+from .log import SUBSYSTEMS, configure as configure_logging
+
+logger = logging.getLogger('agent.cli')
 
 DEFAULT_NGINX_PATH = '/etc/nginx/'
 
 
+def log_level(entry: str) -> str:
+    name, _, level = entry.rpartition("=")
+    if name and name not in SUBSYSTEMS:
+        raise argparse.ArgumentTypeError(f"unknown subsystem {name}, one of {', '.join(SUBSYSTEMS)}")
+    if not isinstance(logging.getLevelName(level.upper()), int):
+        raise argparse.ArgumentTypeError(f"unknown level {level}")
+    return entry
+
+
 class CommonArguments:
 
     def __call__(self, parser: argparse.ArgumentParser, *args, **kwargs):
@@ -25,6 +40,181 @@ class CommonArguments:
             '--config-path',
             help='',
         )
+        parser.add_argument(
+            '--nginx-binary',
+            help='nginx executable used for config test and reload, default: /usr/sbin/nginx',
+        )
+        parser.add_argument(
+            '--ocsp-responder',
+            help='override OCSP responder url from certificates, e.g. a local stub responder for testing',
+        )
+        parser.add_argument(
+            '--log-path',
+            help='nginx log directory tailed for access log stats, default: /var/log/nginx/',
+        )
+        parser.add_argument(
+            '--log-stats-interval',
+            type=int,
+            help='seconds between access log stats deltas sent to the gateway, 0 disables, default: 60',
+        )
+        parser.add_argument(
+            '--stub-status-url',
+            help='nginx stub_status sampled for the heartbeat, default: http://127.0.0.1:8088/nginx_status',
+        )
+        parser.add_argument(
+            '--metrics-port',
+            type=int,
+            help='serve Prometheus metrics on http://<metrics-host>:<port>/metrics, default: disabled',
+        )
+        parser.add_argument(
+            '--metrics-host',
+            help='metrics listen address, default: 127.0.0.1',
+        )
+        parser.add_argument(
+            '--slow-callback-ms',
+            type=int,
+            help='log the event loop stack when a callback blocks longer, 0 disables, default: 200',
+        )
+        parser.add_argument(
+            '--redis-url',
+            help='redis for domain state shared with certbot hooks, default: redis://localhost:6379/0',
+        )
+        parser.add_argument(
+            '--nameserver',
+            dest='nameservers',
+            action='append',
+            help='resolver used to check _acme-challenge propagation, repeatable, default: 8.8.8.8',
+        )
+        parser.add_argument(
+            '--dns-port',
+            type=int,
+            help='resolver port, default: 53',
+        )
+        parser.add_argument(
+            '--acme-dns-url',
+            help='acme-dns api used by the auth hook, default: https://auth.acme-dns.io',
+        )
+        parser.add_argument(
+            '--codec',
+            dest='codecs',
+            action='append',
+            choices=['msgpack', 'orjson', 'json'],
+            help='gateway codecs offered in preference order, repeatable, installed ones only, '
+                 'default: msgpack orjson json',
+        )
+        parser.add_argument(
+            '--no-compression',
+            action='store_true',
+            help='do not offer permessage-deflate to the gateway',
+        )
+        parser.add_argument(
+            '--compression-level',
+            type=int,
+            choices=range(1, 10),
+            help='permessage-deflate zlib level, default: 6',
+        )
+        parser.add_argument(
+            '--compression-window-bits',
+            type=int,
+            choices=range(9, 16),
+            help='permessage-deflate window for both directions, smaller uses less memory per connection, '
+                 'default: 15',
+        )
+        parser.add_argument(
+            '--compression-mem-level',
+            type=int,
+            choices=range(1, 10),
+            help='permessage-deflate zlib memLevel, default: 8',
+        )
+        parser.add_argument(
+            '--journal-size',
+            type=int,
+            help='unacknowledged gateway events kept for replay after reconnect, default: 1000',
+        )
+        parser.add_argument(
+            '--journal-path',
+            help='keep the gateway journal in this file too, so events survive an agent restart, '
+                 'default: memory only',
+        )
+        parser.add_argument(
+            '--reconnect-max-delay',
+            type=float,
+            help='upper bound of the jittered gateway reconnect delay in seconds, default: 60',
+        )
+        parser.add_argument(
+            '--producer-queue-size',
+            type=int,
+            help='outbound events held while the gateway is away, progress updates are dropped first, '
+                 'default: 1000',
+        )
+        parser.add_argument(
+            '--receive-queue-size',
+            type=int,
+            help='gateway commands waiting for the worker before the websocket stops being read, default: 100',
+        )
+        parser.add_argument(
+            '--shared-redis-url',
+            help='redis shared by edges serving the same domains, one of them issues and the others install '
+                 'its certificate, bundles include private keys, default: every edge issues',
+        )
+        parser.add_argument(
+            '--node-name',
+            help='this edge in --shared-redis-url leases and logs, default: hostname',
+        )
+        parser.add_argument(
+            '--ratelimit-max-defer',
+            type=int,
+            help='seconds an add_domain may wait for a Let\'s Encrypt rate limit window, longer waits are '
+                 'rejected, default: 3600',
+        )
+        parser.add_argument(
+            '--idempotency-size',
+            type=int,
+            help='gateway commands remembered by message_id, a retry of one of them gets its result instead of '
+                 'running again, default: 10000',
+        )
+        parser.add_argument(
+            '--idempotency-ttl',
+            type=int,
+            help='seconds a command is remembered after its last result, default: 21600',
+        )
+        parser.add_argument(
+            '--sync-renew-before',
+            type=int,
+            help='sync_state issues again when a certificate expires within this many seconds, '
+                 'default: 2592000 (30 days)',
+        )
+        parser.add_argument(
+            '--sync-issue-limit',
+            type=int,
+            help='domains sync_state orders certificates for at most, the next sync continues, default: 100',
+        )
+        parser.add_argument(
+            '--vhost-mode',
+            choices=['domain', 'shared'],
+            help='domain: three server blocks per domain in conf.d, shared: one server for all domains with the '
+                 'certificate picked by SNI at handshake, for very large domain counts, default: domain',
+        )
+        parser.add_argument(
+            '--access-log-mode',
+            choices=['domain', 'buffered', 'cached', 'shared'],
+            help='domain: unbuffered <domain>.log per domain, buffered: the same files written in chunks, '
+                 'cached: <domain>.log opened on demand through open_log_file_cache, shared: one buffered '
+                 'agent-access.log with $host as first field, default: domain',
+        )
+        parser.add_argument(
+            '--hook-command',
+            help='run certbot hooks as "<command> auth-hook", e.g. nginx-agent or a nginx-agent.pyz build, '
+                 'default: ./dns_acme_*.py',
+        )
+        parser.add_argument(
+            '--log-level',
+            dest='log_levels',
+            action='append',
+            type=log_level,
+            help='LEVEL for every subsystem or SUBSYSTEM=LEVEL, e.g. gw=DEBUG, repeatable, subsystems are the '
+                 'agent modules, default: INFO, DEBUG with --debug',
+        )
         parser.add_argument(
             '-d',
             '--debug',
@@ -58,6 +248,95 @@ class InstallArguments:
             default=False,
             help='',
         )
+        parser.add_argument(
+            '--gzip-level',
+            type=int,
+            choices=range(1, 10),
+            help='gzip_comp_level, default: picked by --measure-compression, else 5',
+        )
+        parser.add_argument(
+            '--gzip-type',
+            dest='gzip_types',
+            action='append',
+            help='MIME type compressed by gzip (and brotli), repeatable, replaces the default list of text, '
+                 'json, javascript, xml, svg and font types',
+        )
+        parser.add_argument(
+            '--brotli',
+            choices=['auto', 'on', 'off'],
+            default='auto',
+            help='auto: brotli when nginx has the module, on: fail without it, default: auto',
+        )
+        parser.add_argument(
+            '--brotli-level',
+            type=int,
+            choices=range(0, 12),
+            help='brotli_comp_level, default: picked by --measure-compression, else 5',
+        )
+        parser.add_argument(
+            '--no-gzip-static',
+            action="store_true",
+            default=False,
+            help='do not serve precompressed <file>.gz / <file>.br variants (gzip_static, brotli_static)',
+        )
+        parser.add_argument(
+            '--measure-compression',
+            action="store_true",
+            default=False,
+            help='compress sample payloads at every level, print ratio and CPU throughput and pick the levels',
+        )
+        parser.add_argument(
+            '--compression-sample',
+            dest='compression_samples',
+            action='append',
+            help='file or directory measured by --measure-compression, repeatable, '
+                 'default: generated JSON, JavaScript and CSS',
+        )
+        parser.add_argument(
+            '--precompress',
+            action='append',
+            metavar='DIR',
+            help='write .gz (and .br) variants of the static files under DIR for gzip_static, repeatable',
+        )
+
+
+class BackfillArguments:
+    def __call__(self, parser: argparse.ArgumentParser, *args, **kwargs):
+        parser.add_argument(
+            'paths',
+            nargs='*',
+            help='log files, plain or .gz, default: /var/log/nginx/*.log*',
+        )
+        parser.add_argument(
+            '--host',
+            help='only aggregate requests for this host',
+        )
+        parser.add_argument(
+            '--since',
+            type=_parse_datetime,
+            help='start, UTC unless an offset is given, e.g. 2021-03-01, 2021-03-01T12:00:00 or '
+                 '2021-03-01T12:00:00+02:00',
+        )
+        parser.add_argument(
+            '--until',
+            type=_parse_datetime,
+            help='end (exclusive), same format as --since',
+        )
+        parser.add_argument(
+            '-w',
+            '--workers',
+            type=int,
+            default=None,
+            help='parser processes, default: cpu count',
+        )
+
+
+def _parse_datetime(value: str) -> float:
+    moment = datetime.fromisoformat(value)
+    # UTC unless the value has its own offset.
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
 
 
 class BaseService:
@@ -107,9 +386,14 @@ class NginxService(BaseService):
             ├── conf.d
             ├── sites-enabled
                     ├── default
+                    ├── status
             ├── ssl
                    ├── nginx.crt
-                    ── nginx.key
+                   ├── nginx.key
+                   └── tickets
+                          ├── current.key
+                          ├── next.key
+                          └── previous.key
             ├── nginx.conf
 
     """
@@ -118,14 +402,17 @@ class NginxService(BaseService):
     default_nginx_config = "nginx.conf"
     default_server_config = "default"
     default_restricted_config = "restricted.conf"
+    default_status_config = "status"
 
     nginx_key_path: str
     nginx_cert_path: str
 
-    def __init__(self, config_dir="/etc/nginx", upstream=None, reconfigure=False):
+    def __init__(self, config_dir="/etc/nginx", upstream=None, reconfigure=False, compression=None):
+        from .compression import CompressionProfile
         self.config_dir: str = config_dir
         self.reconfigure: bool = reconfigure
         self.upstream = upstream
+        self.compression: CompressionProfile = compression or CompressionProfile()
         ssl_path, confd_path, common_path = os.path.join(self.config_dir, "ssl"), \
                                             os.path.join(self.config_dir, "conf.d"), \
                                             os.path.join(self.config_dir, "common")
@@ -135,6 +422,7 @@ class NginxService(BaseService):
                 os.makedirs(item)
         self.nginx_key_path, self.nginx_cert_path = os.path.join(ssl_path, self.nginx_key), os.path.join(ssl_path,
                                                                                                          self.nginx_crt)
+        self.tickets_path = os.path.join(ssl_path, "tickets")
 
     def _gen_ssl_certificate(self):
         if not os.path.exists(self.nginx_key_path) or not os.path.exists(self.nginx_cert_path) or self.reconfigure:
@@ -142,6 +430,11 @@ class NginxService(BaseService):
                 f'openssl req -x509 -nodes -days 365 -newkey rsa:2048 -keyout {self.nginx_key_path} -out {self.nginx_cert_path} -subj "/C=US/ST=Denial/L=Springfield/O=Dis/CN=www.nginx.com" ',
                 shell=True)
 
+    def _gen_session_ticket_keys(self):
+        from .tickets import TicketKeyManager
+        # placeholder keys, the agent replaces them with fleet wide keys received from the control plane.
+        TicketKeyManager.bootstrap(self.tickets_path, reconfigure=self.reconfigure)
+
     def _gen_default_server_config(self):
         default_server_config_path = os.path.join(self.config_dir, "sites-enabled", self.default_server_config)
         if not os.path.exists(default_server_config_path) or self.reconfigure:
@@ -163,6 +456,25 @@ server {{
             """.format(ssl_certificate=self.nginx_cert_path, ssl_certificate_key=self.nginx_key_path)
             self._write(default_server_config_path, template)
 
+    def _gen_status_server_config(self):
+        status_server_config_path = os.path.join(self.config_dir, "sites-enabled", self.default_status_config)
+        if not os.path.exists(status_server_config_path) or self.reconfigure:
+            template = """
+# local only, sampled by nginx-agent for the heartbeat telemetry.
+server {
+        listen 127.0.0.1:8088;
+        server_name localhost;
+        access_log off;
+
+        location = /nginx_status {
+            stub_status;
+            allow 127.0.0.1;
+            deny all;
+        }
+}
+            """
+            self._write(status_server_config_path, template)
+
     def _gen_common_restricted(self):
         default_gen_common_restricted_path = os.path.join(self.config_dir, "common", self.default_restricted_config)
         if not os.path.exists(default_gen_common_restricted_path) or self.reconfigure:
@@ -185,6 +497,7 @@ location / {
             self._write(default_gen_common_restricted_path, template)
 
     def _gen_main_nginx_conf(self):
+        from .tickets import TicketKeyManager
         default_main_nginx_config_path = os.path.join(self.config_dir, self.default_nginx_config)
         if not os.path.exists(default_main_nginx_config_path) or self.reconfigure:
             if not self.upstream:
@@ -245,7 +558,9 @@ http {{
     # http://vincent.bernat.im/en/blog/2011-ssl-session-reuse-rfc5077.html
     ssl_session_cache shared:SSL:50m;
     ssl_session_timeout 1d;
-    ssl_session_tickets off;
+    # ticket keys are shared by the fleet and rotated by nginx-agent, first key encrypts, others only decrypt.
+    ssl_session_tickets on;
+{ssl_session_ticket_keys}
     
     # disable SSLv3(enabled by default since nginx 0.8.19) since it's less secure then TLS http://en.wikipedia.org/wiki/Secure_Sockets_Layer#SSL_3.0
     ssl_protocols TLSv1.2 TLSv1.3;
@@ -267,17 +582,10 @@ http {{
     error_log /var/log/nginx/error.log;
 
     ##
-    # Gzip Settings
+    # Compression Settings
     ##
 
-    gzip on;
-
-    # gzip_vary on;
-    # gzip_proxied any;
-    # gzip_comp_level 6;
-    # gzip_buffers 16 8k;
-    # gzip_http_version 1.1;
-    # gzip_types text/plain text/css application/json application/javascript text/xml application/xml application/xml+rss text/javascript;
+{compression}
 
     ##
     # Virtual Host Configs
@@ -286,12 +594,19 @@ http {{
     include /etc/nginx/conf.d/*.conf;
     include /etc/nginx/sites-enabled/*;
 }}
-            """.format(upstream=self.upstream)
+            """.format(
+                upstream=self.upstream,
+                compression=self.compression.render(),
+                ssl_session_ticket_keys="\n".join(f"    ssl_session_ticket_key {path};"
+                                                   for path in TicketKeyManager.key_paths(self.tickets_path)),
+            )
             self._write(default_main_nginx_config_path, template)
 
     def check(self):
         self._gen_ssl_certificate()
+        self._gen_session_ticket_keys()
         self._gen_default_server_config()
+        self._gen_status_server_config()
         self._gen_common_restricted()
         self._gen_main_nginx_conf()
 
@@ -302,6 +617,7 @@ class Bootstrap:
         The most commonly used commands are:
         - default              create standalone system setup.
         - letsencrypt          Shortcut for let`s encrypt service.
+        - backfill             Per host stats from historical nginx access logs.
     """
     epilog = ""
     description = ""
@@ -335,13 +651,41 @@ class Bootstrap:
     def _install(self, args: argparse.Namespace):
         if not args.upstream:
             raise ValueError(f"Upstream {args.upstream} required for main nginx config file.")
-        _nginx = NginxService(config_dir=args.nginx_path, upstream=args.upstream, reconfigure=args.reconfigure)
+        compression = self._compression(args)
+        _nginx = NginxService(config_dir=args.nginx_path, upstream=args.upstream, reconfigure=args.reconfigure,
+                              compression=compression)
         _nginx.check()
+        if args.precompress:
+            from .compression import precompress
+            for root in args.precompress:
+                written = precompress(root, compression.brotli_static)
+                print(f"precompress {root}: {written} variants written")
 
         # TODO ADD SYSTEM START SERVICE CONFIG WITH CONNECT_URL AND CONNECT_TOKEN
         # _systemd = SystemService()
         return
 
+    @staticmethod
+    def _compression(args: argparse.Namespace):
+        from .compression import DEFAULT_TYPES, CompressionProfile, measure, pick_level, sample_payloads
+        levels = {"gzip": args.gzip_level, "brotli": args.brotli_level}
+        if args.measure_compression:
+            results = measure(sample_payloads(args.compression_samples or []))
+            for name, entries in results.items():
+                picked = pick_level(entries)
+                print(f"{name:<8}{'level':>6}{'ratio':>8}{'MB/s':>9}")
+                for entry in entries:
+                    mark = " <" if entry["level"] == picked else ""
+                    print(f"{'':<8}{entry['level']:>6}{entry['ratio']:>8.3f}{entry['mb_per_second']:>9.1f}{mark}")
+                # an explicit --gzip-level / --brotli-level wins over the measured one.
+                if levels[name] is None:
+                    levels[name] = picked
+        return CompressionProfile.detect(
+            args.nginx_binary or '/usr/sbin/nginx', args.nginx_path, brotli=args.brotli,
+            static=not args.no_gzip_static, types=args.gzip_types or DEFAULT_TYPES,
+            gzip_level=levels["gzip"], brotli_level=levels["brotli"],
+        )
+
     def command_install(self, parser: argparse.ArgumentParser = None):
         # install required tools.
         # create required structure`s.
@@ -356,12 +700,33 @@ class Bootstrap:
         self._install(args)
 
     def command_run(self, parser: argparse.ArgumentParser = None):
-        from main import main
-        from store import Store
         argument_classes = [
             CommonArguments()
         ]
         [cls(parser) for cls in argument_classes]
         args: argparse.Namespace = parser.parse_args(sys.argv[2:])
+        configure_logging(args.log_levels, args.debug)
+        # redis, websockets and dnspython only once there is something to run, --help stays cheap.
+        from .main import main
+        from .store import Store
         store = Store(**vars(args))
         main(store)
+
+    def command_backfill(self, parser: argparse.ArgumentParser = None):
+        from .logstats import backfill
+        argument_classes = [
+            BackfillArguments()
+        ]
+        [cls(parser) for cls in argument_classes]
+        args: argparse.Namespace = parser.parse_args(sys.argv[2:])
+        paths = args.paths or sorted(glob.glob('/var/log/nginx/*.log*'))
+
+        start = time.perf_counter()
+        aggregator, size, lines = backfill(paths, workers=args.workers, host=args.host,
+                                           since=args.since, until=args.until)
+        elapsed = time.perf_counter() - start
+
+        print(json.dumps(aggregator.serialize(), indent=2))
+        print(f"{aggregator.lines} of {lines} lines, {size / 1024 / 1024:.1f} MiB from {len(paths)} files "
+              f"in {elapsed:.2f}s, {lines / elapsed:.0f} lines/sec, {size / 1024 / 1024 / elapsed:.1f} MiB/sec",
+              file=sys.stderr)
@@ -0,0 +1,119 @@
+import json
+import logging
+from typing import Dict, List, Optional, Sequence, Union
+
+logger = logging.getLogger('agent.codec')
+
+SUBPROTOCOL_PREFIX = "nginx-agent."
+
+
+class Codec:
+    """
+    Message encoding on the gateway websocket, offered as the `nginx-agent.<name>` subprotocol.
+    A gateway that does not pick any subprotocol gets JSON text frames, like before negotiation existed.
+    """
+    name = ""
+    binary = False
+
+    @property
+    def subprotocol(self) -> str:
+        return f"{SUBPROTOCOL_PREFIX}{self.name}"
+
+    @classmethod
+    def available(cls) -> bool:
+        return True
+
+    def encode(self, content) -> Union[str, bytes]:
+        raise NotImplementedError
+
+    def decode(self, data: Union[str, bytes]):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
+
+
+class JsonCodec(Codec):
+    name = "json"
+
+    def encode(self, content) -> str:
+        return json.dumps(content)
+
+    def decode(self, data: Union[str, bytes]):
+        return json.loads(data)
+
+
+class OrjsonCodec(Codec):
+    """ same JSON text frames, encoded by orjson, a few times faster than the stdlib for our payloads. """
+    name = "orjson"
+
+    @classmethod
+    def available(cls) -> bool:
+        try:
+            import orjson  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def encode(self, content) -> str:
+        return self._orjson.dumps(content).decode()
+
+    def decode(self, data: Union[str, bytes]):
+        return self._orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """ binary frames, ints and floats no longer go through their decimal text form. """
+    name = "msgpack"
+    binary = True
+
+    @classmethod
+    def available(cls) -> bool:
+        try:
+            import msgpack  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def encode(self, content) -> bytes:
+        return self._msgpack.packb(content, use_bin_type=True)
+
+    def decode(self, data: Union[str, bytes]):
+        if isinstance(data, str):
+            return json.loads(data)
+        return self._msgpack.unpackb(data, raw=False)
+
+
+CODECS: Dict[str, type] = {codec.name: codec for codec in (MsgpackCodec, OrjsonCodec, JsonCodec)}
+DEFAULT_PREFERENCE = ("msgpack", "orjson", "json")
+
+
+def offered_codecs(preference: Sequence[str] = DEFAULT_PREFERENCE) -> List[Codec]:
+    """ codecs in preference order, skipping the ones whose library is not installed, JSON is always last. """
+    codecs = []
+    for name in preference:
+        if name not in CODECS:
+            raise ValueError(f"Unknown codec {name}, choices: {', '.join(CODECS)}")
+        cls = CODECS[name]
+        if cls.available():
+            codecs.append(cls())
+        else:
+            logger.debug(f"codec {name} not installed, not offered.")
+    if not any(isinstance(codec, JsonCodec) for codec in codecs):
+        codecs.append(JsonCodec())
+    return codecs
+
+
+def negotiated_codec(codecs: Sequence[Codec], subprotocol: Optional[str]) -> Codec:
+    for codec in codecs:
+        if codec.subprotocol == subprotocol:
+            return codec
+    return JsonCodec()
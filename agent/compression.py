@@ -0,0 +1,194 @@
+import glob
+import gzip
+import json
+import os
+import random
+import subprocess
+import time
+import zlib
+from typing import Dict, Iterable, List, Optional
+
+# text/html is always compressed, listing it makes nginx warn about a duplicate type.
+DEFAULT_TYPES = (
+    "text/plain", "text/css", "text/xml", "text/javascript", "application/javascript", "application/json",
+    "application/xml", "application/rss+xml", "application/atom+xml", "application/manifest+json",
+    "application/wasm", "image/svg+xml", "font/ttf", "font/otf",
+)
+# files precompressed for gzip_static / brotli_static, everything else is already compressed or too small to matter.
+STATIC_EXTENSIONS = (".html", ".css", ".js", ".mjs", ".json", ".svg", ".xml", ".txt", ".wasm", ".ttf", ".otf", ".map")
+
+
+def nginx_modules(nginx_binary: str, nginx_path: str) -> str:
+    """ `nginx -V` configure arguments plus the names of enabled dynamic modules, "" when nginx is not there. """
+    try:
+        output = subprocess.run([nginx_binary, "-V"], capture_output=True, text=True, timeout=10).stderr
+    except (OSError, subprocess.SubprocessError):
+        output = ""
+    enabled = glob.glob(os.path.join(nginx_path, "modules-enabled", "*.conf"))
+    return output + "\n" + "\n".join(os.path.basename(path) for path in enabled)
+
+
+class CompressionProfile:
+    """
+    gzip, and brotli when nginx has the module, for proxied responses at a level picked for this box,
+    `*_static` serves the precompressed variants of local files next to them.
+    """
+    gzip_level = 5
+    brotli_level = 5
+    min_length = 256
+
+    def __init__(self, types: Iterable[str] = DEFAULT_TYPES, gzip_level: Optional[int] = None,
+                 brotli_level: Optional[int] = None, brotli: bool = False, gzip_static: bool = False,
+                 brotli_static: bool = False):
+        self.types = [name for name in dict.fromkeys(types) if name != "text/html"]
+        if gzip_level is not None:
+            self.gzip_level = gzip_level
+        if brotli_level is not None:
+            self.brotli_level = brotli_level
+        self.brotli = brotli
+        self.gzip_static = gzip_static
+        self.brotli_static = brotli_static
+
+    @classmethod
+    def detect(cls, nginx_binary: str, nginx_path: str, brotli: str = "auto", static: bool = True,
+               **kwargs) -> 'CompressionProfile':
+        """ enable brotli and the static variants only with modules nginx actually has, unknown directives stop it. """
+        modules = nginx_modules(nginx_binary, nginx_path)
+        has_brotli = "brotli" in modules
+        if brotli == "on" and not has_brotli:
+            raise ValueError("brotli requested but nginx has no brotli module")
+        use_brotli = has_brotli and brotli != "off"
+        # ngx_brotli built in has both halves, packaged dynamic modules come as `*brotli-filter*` / `*brotli-static*`.
+        has_brotli_static = "ngx_brotli" in modules or "brotli-static" in modules or "brotli_static" in modules
+        return cls(
+            brotli=use_brotli,
+            gzip_static=static and "http_gzip_static_module" in modules,
+            brotli_static=static and use_brotli and has_brotli_static,
+            **kwargs,
+        )
+
+    def render(self) -> str:
+        types = " ".join(self.types)
+        lines = [
+            "gzip on;",
+            f"gzip_comp_level {self.gzip_level};",
+            f"gzip_min_length {self.min_length};",
+            # responses from the backend are compressed as well, whatever headers the request came with.
+            "gzip_proxied any;",
+            "gzip_vary on;",
+            f"gzip_types {types};",
+        ]
+        if self.gzip_static:
+            lines.append("gzip_static on;")
+        if self.brotli:
+            lines += [
+                "brotli on;",
+                f"brotli_comp_level {self.brotli_level};",
+                f"brotli_min_length {self.min_length};",
+                f"brotli_types {types};",
+            ]
+        if self.brotli_static:
+            lines.append("brotli_static on;")
+        return "\n".join(f"    {line}" for line in lines)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
+
+
+def _brotli():
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+
+def sample_payloads(paths: Iterable[str] = ()) -> List[bytes]:
+    """ files (directories recursively) with a STATIC_EXTENSIONS suffix, generated JSON/JS/CSS without paths. """
+    samples = []
+    for path in paths:
+        files = [path] if os.path.isfile(path) else [
+            os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+        for name in files:
+            if name.endswith(STATIC_EXTENSIONS):
+                with open(name, 'rb') as f:
+                    samples.append(f.read())
+    if samples:
+        return samples
+    rnd = random.Random(0)
+    words = ["id", "name", "price", "status", "created_at", "items", "user", "active", "title", "description"]
+    api = json.dumps([{word: rnd.choice([rnd.randint(0, 10 ** 6), rnd.random(), f"{word}-{rnd.randint(0, 999)}"])
+                       for word in rnd.sample(words, 7)} for _ in range(2000)]).encode()
+    script = "\n".join(f"function {rnd.choice(words)}{number}(a, b) {{ return a.{rnd.choice(words)} + "
+                       f"b.{rnd.choice(words)} * {number}; }}" for number in range(3000)).encode()
+    css = "\n".join(f".{rnd.choice(words)}-{number} {{ margin: {number % 17}px; color: #{rnd.randrange(16 ** 6):06x}; "
+                    f"display: {rnd.choice(['flex', 'block', 'grid'])}; }}" for number in range(3000)).encode()
+    return [api, script, css]
+
+
+def measure(samples: List[bytes], repeat: int = 3) -> Dict[str, List[Dict]]:
+    """ per algorithm and level: compressed/original size ratio and compression throughput in MB/s of CPU time. """
+    original = sum(len(sample) for sample in samples)
+    compressors = {"gzip": [(level, lambda data, level=level: zlib.compress(data, level)) for level in range(1, 10)]}
+    brotli = _brotli()
+    if brotli is not None:
+        compressors["brotli"] = [(level, lambda data, level=level: brotli.compress(data, quality=level))
+                                 for level in range(0, 12)]
+    results = {}
+    for name, levels in compressors.items():
+        results[name] = []
+        for level, compress in levels:
+            start = time.process_time()
+            for _ in range(repeat):
+                size = sum(len(compress(sample)) for sample in samples)
+            elapsed = (time.process_time() - start) / repeat
+            results[name].append({
+                "level": level,
+                "ratio": round(size / original, 4),
+                "mb_per_second": round(original / 1e6 / max(elapsed, 1e-9), 1),
+            })
+    return results
+
+
+def pick_level(levels: List[Dict], tolerance: float = 0.02, min_mb_per_second: float = 20) -> int:
+    """
+    lowest level whose output is within `tolerance` of the smallest one and still compresses
+    `min_mb_per_second` per core, beyond it CPU per response grows for hardly smaller responses.
+    """
+    fast_enough = [entry for entry in levels if entry["mb_per_second"] >= min_mb_per_second] or levels[:1]
+    best = min(entry["ratio"] for entry in fast_enough)
+    return next(entry["level"] for entry in fast_enough if entry["ratio"] <= best * (1 + tolerance))
+
+
+def precompress(root: str, brotli_static: bool = False) -> int:
+    """
+    write `<file>.gz` (and `<file>.br`) at the highest level next to every static file under root that is
+    newer than its variant, for gzip_static / brotli_static. Returns the number of variants written.
+    """
+    brotli = _brotli() if brotli_static else None
+    written = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if not name.endswith(STATIC_EXTENSIONS):
+                continue
+            path = os.path.join(directory, name)
+            variants = [(".gz", lambda data: gzip.compress(data, 9, mtime=0))]
+            if brotli is not None:
+                variants.append((".br", lambda data: brotli.compress(data, quality=11)))
+            data = None
+            for suffix, compress in variants:
+                target = path + suffix
+                if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                    continue
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                compressed = compress(data)
+                # a variant that is not smaller is never worth sending.
+                if len(compressed) >= len(data):
+                    continue
+                with open(target, 'wb') as f:
+                    f.write(compressed)
+                os.utime(target, (os.path.getatime(path), os.path.getmtime(path)))
+                written += 1
+    return written
@@ -1,29 +1,55 @@
 import asyncio
-import json
 import logging
+import random
 import sys
+import time
 import traceback
 import ssl
+from typing import List, Optional
+
 import websockets
 from websockets import WebSocketClientProtocol, InvalidStatusCode
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
+
+from .codec import Codec, JsonCodec, negotiated_codec, offered_codecs
+from .journal import OutboundJournal
+from .log import Payload
+from .metrics import GATEWAY_BYTES_TOTAL, GATEWAY_CONNECTS_TOTAL, GATEWAY_MESSAGES_TOTAL, GATEWAY_REPLAYED_TOTAL
+
+logger = logging.getLogger('agent.gw')
+
 
-logger = logging.getLogger('agent')
+class Backoff:
+    """
+    Decorrelated jitter, each delay is random between `base` and three times the previous one, capped.
+    Edges disconnected by the same gateway restart spread out instead of reconnecting in lockstep.
+    """
 
+    def __init__(self, base: float = 1, cap: float = 60):
+        self.base = base
+        self.cap = cap
+        self.delay = base
 
+    def reset(self):
+        self.delay = self.base
+
+    def next(self) -> float:
+        self.delay = min(self.cap, random.uniform(self.base, self.delay * 3))
+        return self.delay
 
 
 class GateWayAgent:
     websocket: WebSocketClientProtocol = None
     receive_queue: asyncio.Queue
     producer_queue: asyncio.Queue
+    codec: Codec = JsonCodec()
+    stable_after = 60
 
-    @classmethod
-    async def decode_json(cls, text_data):
-        return json.loads(text_data)
+    async def decode_json(self, data):
+        return self.codec.decode(data)
 
-    @classmethod
-    async def encode_json(cls, content):
-        return json.dumps(content)
+    async def encode_json(self, content):
+        return self.codec.encode(content)
 
     def __init__(self, store):
         self.receive_queue = store.receive_queue
@@ -31,15 +57,44 @@ class GateWayAgent:
         self.finished = False
         self.connect_url = store.connect_url
         self.extra_headers = {"TOKEN": store.connect_token}
+        self.codecs: List[Codec] = offered_codecs(store.codecs)
+        self.extensions = self.compression_extensions(store)
+        self.journal = OutboundJournal(store.journal_size, store.journal_path)
+        self.backoff = Backoff(cap=store.reconnect_max_delay)
+
+    @staticmethod
+    def compression_extensions(store) -> Optional[List[ClientPerMessageDeflateFactory]]:
+        """ permessage-deflate with our window and level, context takeover keeps repeated payloads cheap. """
+        if store.no_compression:
+            # None, not [], an empty list still sends an empty `Sec-WebSocket-Extensions` that servers reject.
+            return None
+        window_bits = store.compression_window_bits
+        return [ClientPerMessageDeflateFactory(
+            server_max_window_bits=window_bits if window_bits < 15 else None,
+            client_max_window_bits=window_bits,
+            compress_settings={"level": store.compression_level, "memLevel": store.compression_mem_level},
+        )]
 
     async def websocket_connection(self):
         while not self.finished:
+            connected_at = None
+            delay = 0
             try:
                 self.websocket = await websockets.connect(self.connect_url,
                                                                  max_size=None,
                                                                  extra_headers=self.extra_headers,
-                                                                 ssl=ssl.SSLContext(),
+                                                                 subprotocols=[codec.subprotocol
+                                                                               for codec in self.codecs],
+                                                                 compression=None,
+                                                                 extensions=self.extensions,
+                                                                 ssl=ssl.SSLContext() if self.connect_url.startswith(
+                                                                     "wss://") else None,
                                                                  )
+                GATEWAY_CONNECTS_TOTAL.inc(result="success")
+                connected_at = time.monotonic()
+                self.codec = negotiated_codec(self.codecs, self.websocket.subprotocol)
+                logger.info(f"{self}, connected with codec {self.codec.name}, "
+                            f"extensions {[extension.name for extension in self.websocket.extensions]}")
                 consumer_task = asyncio.create_task(self.receive())
                 producer_task = asyncio.create_task(self.producer())
                 done, pending = await asyncio.wait([consumer_task, producer_task],
@@ -59,36 +114,60 @@ class GateWayAgent:
                 logger.warning(f'{self} Error, disconnected from server mis-transfer: {error}')
 
             except InvalidStatusCode as error:
+                GATEWAY_CONNECTS_TOTAL.inc(result="rejected")
                 logger.warning(f'{self} Error, rejected from server: {error}')
-                await asyncio.sleep(60)
+                delay = self.backoff.cap
 
             except Exception as error:
                 logger.warning(f'{self} Error, unexpected exception: {error}')
                 traceback.print_exc(file=sys.stdout)
 
+            if self.finished:
+                break
+            # a session that lasted a while starts the backoff over, a flapping gateway keeps growing it.
+            if connected_at is not None and time.monotonic() - connected_at >= self.stable_after:
+                self.backoff.reset()
+            delay = max(delay, self.backoff.next())
+            logger.info(f"{self}, reconnecting in {delay:.1f}s, {len(self.journal)} events unacknowledged")
+            await asyncio.sleep(delay)
+
     async def receive(self):
         try:
             async for message in self.websocket:
-                if isinstance(message, str):
-                    await self.receive_json(await self.decode_json(message))
-                else:
-                    raise ValueError("No text section for incoming WebSocket frame!")
+                if isinstance(message, bytes) and not self.codec.binary:
+                    raise ValueError(f"Binary WebSocket frame with codec {self.codec.name}!")
+                GATEWAY_BYTES_TOTAL.inc(len(message), direction="received")
+                await self.receive_json(await self.decode_json(message))
         except asyncio.CancelledError:
             logger.info(f"websocket receive task shutting down.")
 
     async def receive_json(self, data, **kwargs):
         try:
-            logger.debug(f'{self}::receive_json: {data}')
+            logger.debug('%s::receive_json: %s', self, Payload(data))
+            GATEWAY_MESSAGES_TOTAL.inc(direction="received")
+            if data.get("action") == "ack":
+                self.journal.ack(int(data["seq"]))
+                return
             await self.receive_queue.put(data)
         except Exception as error:
-            logger.debug(f'{self}::receive_json: Exception, {error}')
+            logger.debug('%s::receive_json: Exception, %s', self, error)
 
     async def send_json(self, content, **kwargs):
-        await self.websocket.send(await self.encode_json(content))
+        data = await self.encode_json(content)
+        await self.websocket.send(data)
+        GATEWAY_MESSAGES_TOTAL.inc(direction="sent")
+        GATEWAY_BYTES_TOTAL.inc(len(data), direction="sent")
 
     async def producer(self):
         try:
             logger.debug("Websocket Producer Loop Started")
+            # whatever the previous connection did not get acknowledged goes first, in order.
+            pending = self.journal.pending()
+            for event in pending:
+                await self.send_json(event)
+                GATEWAY_REPLAYED_TOTAL.inc()
+            if pending:
+                logger.info(f"{self}, replayed {len(pending)} unacknowledged events")
             while not self.finished:
                 pong_waiter = await self.websocket.ping()
                 await pong_waiter
@@ -98,13 +177,13 @@ class GateWayAgent:
                     if event is None:
                         break
 
-                    logger.debug(f"{self}, send_json {event}")
+                    event = self.journal.append(event)
+                    logger.debug("%s, send_json %s", self, Payload(event))
                     await self.send_json(event)
                 except asyncio.QueueEmpty as error:
                     pass
                 except Exception as error:
-                    # logger.debug(f'{self}::producer_handler: Exception, {error}')
-                    pass
+                    logger.warning(f"{self}, {event.get('action') if event else event} not sent: {error!r}")
         except asyncio.CancelledError:
             logger.info(f"websocket producer task shutting down.")
 
@@ -0,0 +1,81 @@
+import os
+import pickle
+import sys
+import time
+
+import redis
+
+from ..accounts import AccountStore, AcmeDnsClient
+
+# https://www.digitalocean.com/community/tutorials/how-to-acquire-a-let-s-encrypt-certificate-using-dns-validation-with-acme-dns-certbot-on-ubuntu-18-04
+
+# URL to acme-dns instance, the agent passes its settings through the environment, see Store.hook_environ
+ACME_DNS_URL = os.environ.get("NGINX_AGENT_ACME_DNS_URL", "https://auth.acme-dns.io")
+REDIS_URL = os.environ.get("NGINX_AGENT_REDIS_URL", "redis://localhost:6379/0")
+
+ALLOW_FROM = []
+# Force re-registration. Overwrites the already existing acme-dns accounts.
+FORCE_REGISTER = False
+
+# TODO CHANGE ACME_TIME_OUT FOR PRODUCTION
+
+# acme-dns accounts, registered by the agent as soon as add_domain arrives, see AccountCache
+ACCOUNTS_PATH = os.environ.get("NGINX_AGENT_ACCOUNTS_PATH", '/etc/nginx-agent/accounts.sqlite3')
+
+
+class Storage:
+    """ the Domain objects the agent shares with this hook in redis. """
+
+    def __init__(self):
+        self.cache = redis.Redis.from_url(REDIS_URL)
+
+    def get_cache(self, key: str):
+        if self.cache.get(key):
+            return pickle.loads(self.cache.get(key))
+        raise ValueError("Object {} are not exists in cache.".format(key))
+
+    def set_cache(self, key, value, ex=None):
+        return self.cache.set(key, pickle.dumps(value), ex)
+
+
+def main():
+    domain = os.environ["CERTBOT_DOMAIN"]
+    if domain.startswith("*."):
+        domain = domain[2:]
+    validation_token = os.environ["CERTBOT_VALIDATION"]
+
+    client = AcmeDnsClient(ACME_DNS_URL)
+    accounts = AccountStore(ACCOUNTS_PATH)
+    storage = Storage()
+
+    # Check if an account already exists in storage
+    account = accounts.get(domain)
+    try:
+        if FORCE_REGISTER or not account:
+            # Create and save the new account, only when the agent could not register it up front
+            account = client.register_account(ALLOW_FROM)
+            accounts.put(domain, account)
+            #
+            # # Display the notification for the user to update the main zone
+            # msg = "Please add the following CNAME record to your main DNS zone:\n{}"
+            # cname = "{} CNAME {}.".format("_acme-challenge." + domain, account["fulldomain"])
+            # print(msg.format(cname))
+
+        # Update the TXT record in acme-dns instance
+        print(client.update_txt_record(account, validation_token))
+    except ValueError as exc:
+        print(exc)
+        sys.exit(1)
+
+    instance = storage.get_cache(domain)
+    instance.set_account(account)
+    instance.set_token(validation_token)
+    storage.set_cache(domain, instance, instance.cache_time_out)
+
+    # we need set accounts details and token details
+    # and wait for confirm of dns or timeout
+    if instance.token_one and instance.token_two:
+        while not instance.continue_check:
+            time.sleep(5)
+            instance = storage.get_cache(domain)
+
@@ -0,0 +1,12 @@
+import os
+
+TEMP_FOLDER = '/tmp'
+
+
+def main():
+    # CERTBOT_DOMAIN
+    domain = os.environ["CERTBOT_DOMAIN"]
+    # CERTBOT_VALIDATION
+    domain_tmp_tokens = os.path.join(TEMP_FOLDER, domain + ".lock")
+    if os.path.exists(domain_tmp_tokens):
+        os.remove(domain_tmp_tokens)
@@ -0,0 +1,51 @@
+import os
+import subprocess
+import time
+
+from ..ocsp import discard_response, fetch_response
+from ..vhost import deploy_vhost, ocsp_response_path
+
+DEFAULT_LETSENCRYPT_WORK_DIR = "/etc/letsencrypt/"
+DEFAULT_NGINX_WORK_DIR = "/etc/nginx/"
+
+# the agent passes its settings to certbot hooks through the environment, see Store.hook_environ
+LETSENCRYPT_WORK_DIR = os.environ.get("NGINX_AGENT_LETSENCRYPT_PATH", DEFAULT_LETSENCRYPT_WORK_DIR)
+NGINX_WORK_DIR = os.environ.get("NGINX_AGENT_NGINX_PATH", DEFAULT_NGINX_WORK_DIR)
+OCSP_RESPONDER_URL = os.environ.get("NGINX_AGENT_OCSP_RESPONDER") or None
+VHOST_MODE = os.environ.get("NGINX_AGENT_VHOST_MODE", "domain")
+ACCESS_LOG_MODE = os.environ.get("NGINX_AGENT_ACCESS_LOG_MODE", "domain")
+
+
+def reload_nginx():
+    time.sleep(2)
+    try:
+        subprocess.check_output(f"sudo /usr/sbin/nginx -s reload", stderr=subprocess.STDOUT, shell=True)
+    except Exception as exc:
+        print("Nginx Reload: " + str(exc))
+
+
+def main():
+    if not os.environ.get("RENEWED_DOMAINS"):
+        return
+    domain = os.environ["RENEWED_DOMAINS"].split(" ")[0]
+
+    # a fresh certificate gets its OCSP response before the vhost is rendered, so stapling is on from the start.
+    live_path = os.path.join(LETSENCRYPT_WORK_DIR, "live", domain)
+    response_path = ocsp_response_path(LETSENCRYPT_WORK_DIR, domain)
+    # the response of the previous certificate is for another serial, without a new one stapling stays off.
+    discard_response(response_path)
+    try:
+        fetch_response(
+            os.path.join(live_path, "cert.pem"),
+            os.path.join(live_path, "chain.pem"),
+            response_path,
+            OCSP_RESPONDER_URL,
+        )
+    except Exception as exc:
+        print("OCSP: " + str(exc))
+
+    deploy_vhost(NGINX_WORK_DIR, LETSENCRYPT_WORK_DIR, domain, VHOST_MODE, ACCESS_LOG_MODE)
+    # reload nginx for new configs
+    reload_nginx()
+    print("Congratulations! Your certificate and chain have been saved at")
+
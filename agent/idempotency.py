@@ -0,0 +1,75 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+class IdempotencyCache:
+    """
+    Recent commands by `message_id`, with the last result event each of them produced.
+    A command retried by the control plane (same `message_id`) is answered from here instead of running again,
+    also after the domain's redis entry is gone. Results are matched to commands by (action, domain),
+    the handlers and the tasks they start do not need to carry the message id.
+    Bounded to `maxsize` commands, least recently used first out, and forgotten `ttl` seconds after their
+    last result.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 6 * 60 * 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # message_id -> {"action", "domain", "event", "expires"}
+        self.entries: "OrderedDict[str, Dict]" = OrderedDict()
+        # (action, domain) -> message_id of the latest command for it
+        self.latest: Dict[Tuple[str, Optional[str]], str] = {}
+
+    def _expire(self, now: float):
+        while self.entries:
+            message_id, entry = next(iter(self.entries.items()))
+            if entry["expires"] > now and len(self.entries) <= self.maxsize:
+                break
+            self._remove(message_id)
+
+    def _remove(self, message_id: str):
+        entry = self.entries.pop(message_id, None)
+        if entry is not None and self.latest.get((entry["action"], entry["domain"])) == message_id:
+            del self.latest[(entry["action"], entry["domain"])]
+
+    def get(self, message_id: str, now: Optional[float] = None) -> Optional[Dict]:
+        """ the entry of an already seen command, None for a new one. """
+        now = time.time() if now is None else now
+        entry = self.entries.get(message_id)
+        if entry is None:
+            return None
+        if entry["expires"] <= now:
+            self._remove(message_id)
+            return None
+        self.entries.move_to_end(message_id)
+        return entry
+
+    def start(self, message_id: str, action: str, domain: Optional[str] = None, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        self.entries[message_id] = {"action": action, "domain": domain, "event": None, "expires": now + self.ttl}
+        self.entries.move_to_end(message_id)
+        self.latest[(action, domain)] = message_id
+        self._expire(now)
+
+    def resolve(self, action: str, domain: Optional[str], event: Dict, now: Optional[float] = None) -> Optional[str]:
+        """ remember `event` as the outcome of the latest command for (action, domain), returns its message id. """
+        message_id = self.latest.get((action, domain))
+        entry = self.entries.get(message_id) if message_id is not None else None
+        if entry is None:
+            return None
+        now = time.time() if now is None else now
+        entry["event"] = event
+        entry["expires"] = now + self.ttl
+        self.entries.move_to_end(message_id)
+        return message_id
+
+    def forget(self, message_id: str):
+        """ the command failed before producing a result, a retry runs it again. """
+        self._remove(message_id)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
@@ -0,0 +1,135 @@
+import json
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from .metrics import JOURNAL_DROPPED_TOTAL
+from .queues import PROGRESS_ACTIONS
+from .utils import write_atomic
+
+logger = logging.getLogger('agent.journal')
+
+# state snapshots and progress, a replayed one would be stale and the next one or the result is on its way.
+UNJOURNALED_ACTIONS = {"heartbeat"} | PROGRESS_ACTIONS
+# journaled, but dropped before any result when the journal is full.
+EVICT_FIRST_ACTIONS = {"log_stats"}
+
+
+class OutboundJournal:
+    """
+    Gateway events with a sequence number, kept until the gateway acknowledges them with
+    `{"action": "ack", "seq": <n>}` (cumulative) and replayed in order after a reconnect.
+    Bounded to `max_events`, the oldest unacknowledged EVICT_FIRST_ACTIONS event is dropped first,
+    the oldest result only when there is none, a long disconnect keeps the results the journal is for.
+    Nothing is replayed before the gateway acknowledged anything, a gateway without acks is not flooded.
+    With `path` the journal is also an append only JSON lines file, so a restarted agent replays too.
+    """
+    compact_ratio = 2
+
+    def __init__(self, max_events: int = 1000, path: Optional[str] = None):
+        self.max_events = max_events
+        self.path = path
+        self.events: "OrderedDict[int, Dict]" = OrderedDict()
+        # seqs of queued EVICT_FIRST_ACTIONS events, oldest first.
+        self.evict_first: "OrderedDict[int, None]" = OrderedDict()
+        self.seq = 0
+        self.acked = 0
+        self._records = 0
+        self._file = None
+        if self.path:
+            self.load()
+            self._file = open(self.path, 'a')
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn last line after a crash.
+                        continue
+                    if "ack" in record:
+                        self._ack(record["ack"])
+                    elif record["event"].get("action") not in UNJOURNALED_ACTIONS:
+                        self.seq = max(self.seq, record["seq"])
+                        self._add(record["seq"], record["event"])
+        except FileNotFoundError:
+            return
+        self.seq = max(self.seq, self.acked)
+        while len(self.events) > self.max_events:
+            self._evict()
+        logger.info(f"{self}, loaded {len(self.events)} unacknowledged events from {self.path}")
+        self.compact()
+
+    def _write(self, record: Dict):
+        if self._file is None:
+            return
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        self._records += 1
+        if self._records > self.max_events * self.compact_ratio:
+            self.compact()
+
+    def compact(self):
+        """ rewrite the file with only the unacknowledged events. """
+        if not self.path:
+            return
+        # the ack record keeps the sequence going when nothing is pending.
+        lines = [json.dumps({"ack": self.acked}) + "\n"]
+        lines += [json.dumps({"seq": seq, "event": event}) + "\n" for seq, event in self.events.items()]
+        write_atomic(self.path, "".join(lines).encode())
+        if self._file is not None:
+            self._file.close()
+            self._file = open(self.path, 'a')
+        self._records = len(lines)
+
+    def _add(self, seq: int, event: Dict):
+        self.events[seq] = event
+        if event.get("action") in EVICT_FIRST_ACTIONS:
+            self.evict_first[seq] = None
+
+    def _evict(self):
+        if self.evict_first:
+            seq, _ = self.evict_first.popitem(last=False)
+            return seq, self.events.pop(seq)
+        seq, event = self.events.popitem(last=False)
+        return seq, event
+
+    def append(self, event: Dict) -> Dict:
+        """ returns the event to send, journaled ones carry `seq`. """
+        if event.get("action") in UNJOURNALED_ACTIONS:
+            return event
+        self.seq += 1
+        event = {**event, "seq": self.seq}
+        self._add(self.seq, event)
+        self._write({"seq": self.seq, "event": event})
+        if len(self.events) > self.max_events:
+            seq, dropped = self._evict()
+            JOURNAL_DROPPED_TOTAL.inc()
+            if self.acked:
+                logger.warning(f"{self}, journal full, dropped unacknowledged event {seq} {dropped.get('action')}")
+        return event
+
+    def _ack(self, seq: int):
+        self.acked = max(self.acked, seq)
+        while self.events and next(iter(self.events)) <= seq:
+            acked, _ = self.events.popitem(last=False)
+            self.evict_first.pop(acked, None)
+
+    def ack(self, seq: int):
+        if seq <= self.acked or seq > self.seq:
+            return
+        self._ack(seq)
+        self._write({"ack": seq})
+
+    def pending(self) -> List[Dict]:
+        if not self.acked:
+            return []
+        return list(self.events.values())
+
+    def __len__(self):
+        return len(self.events)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
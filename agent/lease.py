@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+import socket
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger('agent.lease')
+
+
+class IssuanceCoordinator:
+    """
+    One issuer per domain across every agent sharing `--shared-redis-url`.
+    The issuer holds an expiring lease `nginx-agent:lease:<domain>` tagged with a fencing token, renews it while
+    certbot runs and publishes the bundle only while the lease is still its own and no newer bundle exists,
+    so an issuer that stalled past its lease can not overwrite a newer certificate.
+    The other agents wait for the `nginx-agent:issued` notification and install the published bundle,
+    when the lease disappears without a bundle (issuer died) one of them takes over.
+    A failed issuance is recorded as `nginx-agent:failed:<domain>`, nobody orders that domain again before it expires,
+    the backoff doubles with every failure in a row, so an invalid domain costs one ACME order per backoff and
+    not one per node.
+    Bundles contain private keys, the shared redis has to be as trusted as the edges themselves.
+    """
+    prefix = "nginx-agent"
+    channel = "nginx-agent:issued"
+    lease_ttl = 120
+    bundle_ttl = 60 * 60
+    poll_interval = 5
+    failure_backoff = 5 * 60
+    max_failure_backoff = 6 * 60 * 60
+
+    def __init__(self, store):
+        # redis.asyncio is only needed in coordinated mode.
+        import redis.asyncio
+
+        self.redis = redis.asyncio.Redis.from_url(store.shared_redis_url)
+        self.node: str = store.node_name or socket.gethostname()
+        self.finished = False
+        self._waiters: Dict[str, asyncio.Event] = {}
+
+    def _key(self, kind: str, domain: str) -> str:
+        return f"{self.prefix}:{kind}:{domain}"
+
+    def _owner(self, token: int) -> bytes:
+        return f"{self.node}:{token}".encode()
+
+    async def acquire(self, domain: str) -> Optional[int]:
+        token = await self.redis.incr(self._key("fence", domain))
+        if await self.redis.set(self._key("lease", domain), self._owner(token), nx=True,
+                                px=int(self.lease_ttl * 1000)):
+            logger.info(f"{self}, {domain}: lease {token} acquired, issuing here.")
+            return token
+        return None
+
+    async def _if_owner(self, domain: str, token: int, commands) -> bool:
+        """ run `commands(pipeline)` in a transaction only while the lease is still held with `token`. """
+        import redis.exceptions
+
+        lease_key = self._key("lease", domain)
+        async with self.redis.pipeline() as pipe:
+            try:
+                await pipe.watch(lease_key, self._key("bundle", domain))
+                if await pipe.get(lease_key) != self._owner(token):
+                    return False
+                if not await commands(pipe):
+                    return False
+                await pipe.execute()
+                return True
+            except redis.exceptions.WatchError:
+                return False
+
+    async def renew(self, domain: str, token: int) -> bool:
+        async def commands(pipe):
+            pipe.multi()
+            pipe.pexpire(self._key("lease", domain), int(self.lease_ttl * 1000))
+            return True
+        return await self._if_owner(domain, token, commands)
+
+    async def keep(self, domain: str, token: int):
+        """ renews the lease until cancelled, the issuer runs it next to certbot. """
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            if not await self.renew(domain, token):
+                logger.warning(f"{self}, {domain}: lease {token} lost, the bundle will not be published.")
+                return
+
+    async def release(self, domain: str, token: int) -> bool:
+        async def commands(pipe):
+            pipe.multi()
+            pipe.delete(self._key("lease", domain))
+            return True
+        return await self._if_owner(domain, token, commands)
+
+    async def publish(self, domain: str, token: int, files: Dict[str, bytes]) -> bool:
+        bundle_key = self._key("bundle", domain)
+        data = json.dumps({
+            "token": token,
+            "node": self.node,
+            "files": {name: content.decode() for name, content in files.items()},
+        })
+
+        async def commands(pipe):
+            current = await pipe.get(bundle_key)
+            # fencing: a bundle from a later lease wins, whatever order the writes arrive in.
+            if current is not None and json.loads(current)["token"] > token:
+                return False
+            pipe.multi()
+            pipe.set(bundle_key, data, ex=self.bundle_ttl)
+            pipe.delete(self._key("lease", domain), self._key("failures", domain))
+            pipe.publish(self.channel, domain)
+            return True
+
+        published = await self._if_owner(domain, token, commands)
+        if published:
+            logger.info(f"{self}, {domain}: bundle {token} published.")
+        else:
+            logger.warning(f"{self}, {domain}: bundle {token} rejected, lease expired or superseded.")
+        return published
+
+    async def fail(self, domain: str, token: int, error: str) -> bool:
+        """ release the lease and back every node off the domain, the last error is kept for them to report. """
+        failures_key = self._key("failures", domain)
+
+        async def commands(pipe):
+            failures = int(await pipe.get(failures_key) or 0) + 1
+            backoff = min(self.failure_backoff * 2 ** (failures - 1), self.max_failure_backoff)
+            data = json.dumps({"token": token, "node": self.node, "error": error, "backoff": backoff})
+            pipe.multi()
+            pipe.set(self._key("failed", domain), data, ex=backoff)
+            # the streak is forgotten once a whole maximum backoff passes without a new failure.
+            pipe.set(failures_key, failures, ex=backoff + self.max_failure_backoff)
+            pipe.delete(self._key("lease", domain))
+            pipe.publish(self.channel, domain)
+            return True
+
+        failed = await self._if_owner(domain, token, commands)
+        if failed:
+            logger.warning(f"{self}, {domain}: issuance {token} failed, every node backs off: {error}")
+        return failed
+
+    async def failure(self, domain: str) -> Optional[Dict]:
+        """ the failure record while the domain is backed off, None when it may be ordered. """
+        data = await self.redis.get(self._key("failed", domain))
+        return json.loads(data) if data is not None else None
+
+    async def bundle(self, domain: str) -> Optional[Dict]:
+        data = await self.redis.get(self._key("bundle", domain))
+        if data is None:
+            return None
+        bundle = json.loads(data)
+        bundle["files"] = {name: content.encode() for name, content in bundle["files"].items()}
+        return bundle
+
+    async def wait(self, domain: str, timeout: float) -> bool:
+        """
+        wait for another node's issuance, True once a bundle exists,
+        False when the lease is gone without one or on timeout, the caller may try to acquire.
+        """
+        event = self._waiters.setdefault(domain, asyncio.Event())
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline:
+                event.clear()
+                if await self.redis.exists(self._key("bundle", domain)):
+                    return True
+                if not await self.redis.exists(self._key("lease", domain)):
+                    return False
+                # polling as well, a notification sent while the subscription reconnects is lost.
+                try:
+                    await asyncio.wait_for(event.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+            return False
+        finally:
+            self._waiters.pop(domain, None)
+
+    async def run(self):
+        import redis.exceptions
+
+        pubsub = self.redis.pubsub()
+        try:
+            while not self.finished:
+                try:
+                    await pubsub.subscribe(self.channel)
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        event = self._waiters.get(message["data"].decode())
+                        if event is not None:
+                            event.set()
+                except (redis.exceptions.ConnectionError, OSError) as exc:
+                    logger.warning(f"{self}, shared redis subscription: {exc}")
+                    await asyncio.sleep(self.poll_interval)
+                except Exception as exc:
+                    logger.exception(exc)
+                    await asyncio.sleep(self.poll_interval)
+        except asyncio.CancelledError:
+            logger.info(f"issuance coordinator shutting down.")
+        finally:
+            await pubsub.aclose()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
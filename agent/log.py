@@ -0,0 +1,173 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+from itertools import islice
+from typing import Dict, List, Optional, Tuple
+
+from .metrics import LOG_DROPPED_TOTAL
+
+LOGGING_CONFIG = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        "main_formatter": {
+            "format": "%(levelname)s:%(name)s: %(message)s(%(asctime)s; %(filename)s:%(lineno)d)",
+            "datefmt": "%Y-%m-%d %H:%M:%S"
+        }
+    },
+    'handlers': {
+        "console": {
+            "class": "logging.StreamHandler",
+            "formatter": "main_formatter"
+        },
+    },
+    'loggers': {
+        'agent': {
+            'level': 'INFO',
+            'handlers': ['console'],
+            'propagate': False
+        },
+    },
+}
+
+# every module logs to `agent.<module>`, levels are set per subsystem with `--log-level gw=DEBUG`.
+SUBSYSTEMS = ("accounts", "cli", "codec", "gw", "journal", "lease", "logstats", "main", "metrics", "ocsp",
+              "profiler", "queues", "ratelimit", "reloader", "state", "telemetry", "tickets", "worker")
+
+
+class Payload:
+    """
+    `logger.debug("%s, send_json %s", self, Payload(event))`: repr'd only when the record is emitted,
+    and bounded, a bundle or a stats delta costs about the same as a heartbeat.
+    reprlib sorts every dict it shortens, this keeps insertion order and is several times faster.
+    """
+    __slots__ = ('value',)
+    max_depth = 3
+    max_items = 10
+    max_string = 200
+
+    def __init__(self, value):
+        self.value = value
+
+    def _repr(self, value, depth: int) -> str:
+        if isinstance(value, dict):
+            if not value:
+                return "{}"
+            if depth <= 0:
+                return "{...}"
+            parts = [f"{key!r}: {self._repr(item, depth - 1)}" for key, item in islice(value.items(), self.max_items)]
+            if len(value) > self.max_items:
+                parts.append(f"... {len(value) - self.max_items} more")
+            return "{" + ", ".join(parts) + "}"
+        if isinstance(value, (list, tuple)):
+            if not value:
+                return repr(value)
+            if depth <= 0:
+                return "[...]"
+            parts = [self._repr(item, depth - 1) for item in islice(value, self.max_items)]
+            if len(value) > self.max_items:
+                parts.append(f"... {len(value) - self.max_items} more")
+            return "[" + ", ".join(parts) + "]"
+        if isinstance(value, (str, bytes)) and len(value) > self.max_string:
+            return f"{value[:self.max_string]!r}... {len(value) - self.max_string} more"
+        return repr(value)
+
+    def __str__(self):
+        return self._repr(self.value, self.max_depth)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    At most `burst` records per call site every `interval` seconds, the next record let through tells
+    how many were suppressed. A reconnect loop or a failing poll logs a few lines per minute, not thousands.
+    DEBUG is not sampled, whoever enabled it wants every line.
+    """
+    interval = 60
+    burst = 10
+
+    def __init__(self):
+        super().__init__()
+        # (logger, path, line) -> [window start, records in window, suppressed]
+        self.sites: Dict[Tuple[str, str, int], List] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno <= logging.DEBUG:
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        now = record.created
+        site = self.sites.get(key)
+        if site is None or now - site[0] >= self.interval:
+            suppressed = site[2] if site is not None else 0
+            site = self.sites[key] = [now, 0, 0]
+            if suppressed:
+                record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        site[1] += 1
+        if site[1] > self.burst:
+            site[2] += 1
+            LOG_DROPPED_TOTAL.inc(reason="rate_limited")
+            return False
+        return True
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the listener thread, the event loop never waits for stdout or journald.
+    Only the message is rendered here, cut at `max_length`, timestamps and the line layout are formatted
+    by the listener. A full queue drops the record instead of blocking.
+    """
+    max_length = 4096
+
+    def __init__(self, maxsize: int = 10000):
+        super().__init__(queue.Queue(maxsize))
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        message = record.getMessage()
+        if len(message) > self.max_length:
+            message = f"{message[:self.max_length]}... ({len(message) - self.max_length} more characters)"
+        # a copy, other handlers of the record see it unchanged.
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg, record.args = message, None
+        if record.exc_info:
+            # the traceback references frames that are gone once the listener gets to it.
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED_TOTAL.inc(reason="queue_full")
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def configure(levels: Optional[List[str]] = None, debug: bool = False) -> QueueHandler:
+    """
+    Moves the `agent` handlers from LOGGING_CONFIG behind a queue and applies `levels`,
+    `["DEBUG"]` for every subsystem, `["gw=DEBUG", "worker=WARNING"]` per subsystem.
+    """
+    global _listener
+    logger = logging.getLogger('agent')
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
+    for entry in levels or []:
+        name, _, level = entry.rpartition("=")
+        logging.getLogger(f"agent.{name}" if name else 'agent').setLevel(level.upper())
+
+    handler = QueueHandler()
+    handler.addFilter(RateLimitFilter())
+    handlers, logger.handlers = logger.handlers, [handler]
+    _listener = logging.handlers.QueueListener(handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    # records still queued at exit are written before the interpreter goes away.
+    atexit.register(shutdown)
+    return handler
+
+
+def shutdown():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,418 @@
+import asyncio
+import calendar
+import glob
+import gzip
+import mmap
+import logging
+import math
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger('agent.logstats')
+
+# `main` log_format from NginxService._gen_main_nginx_conf:
+# '$http_x_forwarded_for - $remote_user [$time_local] "$request_method $scheme://$host$request_uri $server_protocol" '
+# '$status $body_bytes_sent "$http_referer" "$http_user_agent" $request_time'
+# `agent_shared` (vhost.LOGGING_TEMPLATE) is the same with a leading `$host `, for the single shared log file.
+# Everything before `[$time_local]` is skipped, `$http_x_forwarded_for` has a ", " between hops.
+# error_log lines share the per-domain files, they simply do not match.
+MAIN_LOG_PATTERN = re.compile(
+    rb'^[^\[\n]*\[([^\]]+)\] "\S+ [a-z]+://([^/\s"]*)[^"]*" (\d{3}) (\d+) "[^"]*" "[^"]*" ([\d.]+)\r?$',
+    re.M,
+)
+
+
+class QuantileSketch:
+    """
+    Log-bucketed histogram with relative error `accuracy` (DDSketch), sketches from different edges or
+    intervals merge by adding bucket counts.
+    """
+    accuracy = 0.02
+    gamma = (1 + accuracy) / (1 - accuracy)
+    log_gamma = math.log(gamma)
+    # request_time has millisecond resolution, everything below is counted as zero.
+    min_value = 0.001
+
+    def __init__(self):
+        self.zero = 0
+        self.buckets: Dict[int, int] = {}
+
+    def add(self, value: float):
+        if value < self.min_value:
+            self.zero += 1
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    @property
+    def count(self) -> int:
+        return self.zero + sum(self.buckets.values())
+
+    def merge(self, other: 'QuantileSketch'):
+        self.zero += other.zero
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def quantile(self, q: float) -> float:
+        rank = q * (self.count - 1)
+        seen = self.zero
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 0.0
+
+    def serialize(self) -> Dict:
+        # string keys, object keys are strings in JSON anyway and orjson refuses anything else.
+        return {"z": self.zero, "b": {str(index): count for index, count in self.buckets.items()}}
+
+    @classmethod
+    def deserialize(cls, data: Dict) -> 'QuantileSketch':
+        instance = cls()
+        instance.zero = data["z"]
+        instance.buckets = {int(index): count for index, count in data["b"].items()}
+        return instance
+
+
+class HostStats:
+    __slots__ = ('requests', 'status', 'bytes', 'request_time')
+
+    def __init__(self):
+        self.requests = 0
+        # index is status // 100, a slot for every first digit, `return 999` is a valid status in nginx config.
+        self.status = [0] * 10
+        self.bytes = 0
+        self.request_time = QuantileSketch()
+
+    def merge(self, other: 'HostStats'):
+        self.requests += other.requests
+        self.status = [a + b for a, b in zip(self.status, other.status)]
+        self.bytes += other.bytes
+        self.request_time.merge(other.request_time)
+
+    def serialize(self) -> Dict:
+        return {
+            "requests": self.requests,
+            "status": {f"{index}xx": count for index, count in enumerate(self.status) if count},
+            "bytes": self.bytes,
+            "request_time": self.request_time.serialize(),
+            "p50": round(self.request_time.quantile(0.5), 4),
+            "p99": round(self.request_time.quantile(0.99), 4),
+        }
+
+
+MONTHS = {month.encode(): index for index, month in enumerate(calendar.month_abbr) if month}
+_day_cache: Dict[bytes, int] = {}
+
+
+def parse_time_local(value: bytes) -> float:
+    """ $time_local "19/Oct/2026:10:00:00 +0000" to a timestamp, days are cached since logs are sorted. """
+    day = value[:11]
+    base = _day_cache.get(day)
+    if base is None:
+        base = _day_cache[day] = calendar.timegm((int(day[7:11]), MONTHS[day[3:6]], int(day[:2]), 0, 0, 0))
+    seconds = int(value[12:14]) * 3600 + int(value[15:17]) * 60 + int(value[18:20])
+    offset = int(value[22:24]) * 3600 + int(value[24:26]) * 60
+    return base + seconds - offset if value[21:22] == b'+' else base + seconds + offset
+
+
+class LogAggregator:
+    """
+    per host aggregates of `main` formatted lines, shared by the live tailer and the backfill command.
+    host and time window filters are only evaluated when given, the live tailer never pays for them.
+    """
+
+    def __init__(self, host: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None):
+        self.hosts: Dict[bytes, HostStats] = {}
+        self.lines = 0
+        self.host = host.lower().encode() if host else None
+        self.since = since
+        self.until = until
+
+    def feed(self, buffer, start: int = 0, end: Optional[int] = None) -> int:
+        """ aggregate complete lines in buffer[start:end] without slicing it, returns matched line count. """
+        if self.host is not None or self.since is not None or self.until is not None:
+            return self._feed_filtered(buffer, start, end)
+        hosts = self.hosts
+        matched = 0
+        for match in MAIN_LOG_PATTERN.finditer(buffer, start, len(buffer) if end is None else end):
+            _, host, status, body_bytes, request_time = match.groups()
+            stats = hosts.get(host)
+            if stats is None:
+                stats = hosts[host] = HostStats()
+            stats.requests += 1
+            stats.status[status[0] - 48] += 1
+            stats.bytes += int(body_bytes)
+            stats.request_time.add(float(request_time))
+            matched += 1
+        self.lines += matched
+        return matched
+
+    def _feed_filtered(self, buffer, start: int = 0, end: Optional[int] = None) -> int:
+        hosts = self.hosts
+        matched = 0
+        for match in MAIN_LOG_PATTERN.finditer(buffer, start, len(buffer) if end is None else end):
+            time_local, host, status, body_bytes, request_time = match.groups()
+            if self.host is not None and host.lower() != self.host:
+                continue
+            if self.since is not None or self.until is not None:
+                timestamp = parse_time_local(time_local)
+                if self.since is not None and timestamp < self.since:
+                    continue
+                if self.until is not None and timestamp >= self.until:
+                    continue
+            stats = hosts.get(host)
+            if stats is None:
+                stats = hosts[host] = HostStats()
+            stats.requests += 1
+            stats.status[status[0] - 48] += 1
+            stats.bytes += int(body_bytes)
+            stats.request_time.add(float(request_time))
+            matched += 1
+        self.lines += matched
+        return matched
+
+    def merge(self, other: 'LogAggregator'):
+        self.lines += other.lines
+        for host, stats in other.hosts.items():
+            if host in self.hosts:
+                self.hosts[host].merge(stats)
+            else:
+                self.hosts[host] = stats
+
+    def serialize(self) -> Dict:
+        return {host.decode(errors='replace').lower(): stats.serialize() for host, stats in self.hosts.items()}
+
+
+def backfill_file(path: str, host: Optional[str] = None, since: Optional[float] = None,
+                  until: Optional[float] = None, chunk_size: int = 4 * 1024 * 1024) -> Tuple[LogAggregator, int, int]:
+    """
+    aggregate one historical log, plain files are mmapped, `.gz` is streamed.
+    Returns (aggregator, bytes read, lines scanned).
+    """
+    aggregator = LogAggregator(host=host, since=since, until=until)
+    if path.endswith(".gz"):
+        size, lines, partial = 0, 0, b''
+        with gzip.open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                size += len(chunk)
+                lines += chunk.count(b'\n')
+                buffer = partial + chunk if partial else chunk
+                end = buffer.rfind(b'\n') + 1
+                aggregator.feed(buffer, 0, end)
+                partial = buffer[end:]
+        aggregator.feed(partial)
+        return aggregator, size, lines
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return aggregator, 0, 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            aggregator.feed(buffer)
+            lines = sum(buffer[offset:offset + chunk_size].count(b'\n') for offset in range(0, size, chunk_size))
+    return aggregator, size, lines
+
+
+def backfill(paths: List[str], workers: Optional[int] = None, host: Optional[str] = None,
+             since: Optional[float] = None, until: Optional[float] = None) -> Tuple[LogAggregator, int, int]:
+    """ aggregate files in a process pool, one file per task, results are merged in the caller. """
+    result, size, lines = LogAggregator(), 0, 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(backfill_file, path, host, since, until) for path in paths]
+        for future in futures:
+            aggregator, file_size, file_lines = future.result()
+            result.merge(aggregator)
+            size += file_size
+            lines += file_lines
+    return result, size, lines
+
+
+class FileTail:
+    """
+    Follows one log file by offset, a rotated (new inode) or truncated file is drained and re-opened from start.
+    """
+    chunk_size = 256 * 1024
+
+    def __init__(self, path: str, from_end: bool = True):
+        self.path = path
+        self.fd: Optional[int] = None
+        self.inode: Optional[int] = None
+        self.offset = 0
+        self.partial = b''
+        self.skipped = 0
+        self._open(from_end)
+
+    def _open(self, from_end: bool):
+        try:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            self.fd = None
+            return
+        stat = os.fstat(self.fd)
+        self.inode = stat.st_ino
+        self.offset = stat.st_size if from_end else 0
+        self.partial = b''
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _rotated(self) -> bool:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return stat.st_ino != self.inode or stat.st_size < self.offset
+
+    def backlog(self) -> int:
+        if self.fd is None:
+            return 0
+        return max(os.fstat(self.fd).st_size - self.offset, 0)
+
+    def skip_to_end(self):
+        size = os.fstat(self.fd).st_size
+        self.skipped += size - self.offset
+        self.offset = size
+        self.partial = b''
+
+    def read(self, aggregator: LogAggregator, budget: int) -> int:
+        """ read at most `budget` bytes into aggregator, returns bytes consumed. """
+        if self.fd is None:
+            self._open(from_end=False)
+            if self.fd is None:
+                return 0
+        consumed = 0
+        while consumed < budget:
+            chunk = os.pread(self.fd, min(self.chunk_size, budget - consumed), self.offset)
+            if not chunk:
+                if self._rotated():
+                    # old file fully drained, continue with the new one from the start.
+                    self.close()
+                    self._open(from_end=False)
+                    if self.fd is None:
+                        break
+                    continue
+                break
+            self.offset += len(chunk)
+            consumed += len(chunk)
+            buffer = self.partial + chunk if self.partial else chunk
+            end = buffer.rfind(b'\n') + 1
+            aggregator.feed(buffer, 0, end)
+            self.partial = buffer[end:]
+        return consumed
+
+
+class LogStats:
+    """
+    Tails nginx access logs, aggregates per host and publishes the delta on the producer queue every `interval`.
+    Per domain files and the single `agent-access.log` of the shared access log mode both match `*.log`,
+    hosts come from the lines in either layout.
+    CPU is bounded by a byte budget per poll, a backlog above `max_backlog` is skipped and reported instead
+    of parsed late. Polls read and parse in the executor like backfill, the loop only merges the result.
+    """
+    poll_interval = 1
+    rescan_interval = 30
+    # ~40k req/s of `main` lines, twice the expected peak.
+    bytes_per_second = 8 * 1024 * 1024
+    max_backlog = 256 * 1024 * 1024
+
+    def __init__(self, store):
+        self.pattern = os.path.join(store.log_path, "*.log")
+        self.interval: int = store.log_stats_interval
+        self.producer_queue = store.producer_queue
+        self.finished = False
+        self.files: Dict[str, FileTail] = {}
+        self.aggregator = LogAggregator()
+        # file the next poll starts with, a busy log early in the list does not starve the others.
+        self.start = 0
+        self.polling: Optional[asyncio.Future] = None
+
+    def rescan(self, from_end: bool = False):
+        paths = set(glob.glob(self.pattern))
+        for path in paths - set(self.files):
+            self.files[path] = FileTail(path, from_end=from_end)
+        for path in set(self.files) - paths:
+            # removed without a successor, keep the descriptor until everything written to it was read.
+            if self.files[path].backlog() == 0:
+                self.files.pop(path).close()
+
+    def poll(self) -> LogAggregator:
+        """ one budget worth of new lines, in a fresh aggregator so the caller merges it in its own thread. """
+        aggregator = LogAggregator()
+        budget = self.bytes_per_second * self.poll_interval
+        tails = list(self.files.values())
+        if tails:
+            self.start = (self.start + 1) % len(tails)
+            tails = tails[self.start:] + tails[:self.start]
+        for tail in tails:
+            if tail.backlog() > self.max_backlog:
+                logger.warning(f"{self}, {tail.path} is {tail.backlog()} bytes behind, skipping.")
+                tail.skip_to_end()
+            budget -= tail.read(aggregator, budget)
+            if budget <= 0:
+                break
+        return aggregator
+
+    def close(self):
+        for tail in self.files.values():
+            tail.close()
+
+    def delta(self, period: float) -> Dict:
+        aggregator, self.aggregator = self.aggregator, LogAggregator()
+        skipped = sum(tail.skipped for tail in self.files.values())
+        for tail in self.files.values():
+            tail.skipped = 0
+        return {
+            "period": round(period, 3),
+            "lines": aggregator.lines,
+            "skipped_bytes": skipped,
+            "hosts": aggregator.serialize(),
+        }
+
+    async def run(self):
+        if not self.interval:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            self.rescan(from_end=True)
+            last_publish = last_rescan = time.monotonic()
+            while not self.finished:
+                await asyncio.sleep(self.poll_interval)
+                now = time.monotonic()
+                try:
+                    if now - last_rescan >= self.rescan_interval:
+                        self.rescan()
+                        last_rescan = now
+                    self.polling = loop.run_in_executor(None, self.poll)
+                    # shielded, a cancel leaves `polling` pending until the thread is done with the files.
+                    self.aggregator.merge(await asyncio.shield(self.polling))
+                    if now - last_publish >= self.interval:
+                        message = self.delta(now - last_publish)
+                        last_publish = now
+                        if message["lines"] or message["skipped_bytes"]:
+                            await self.producer_queue.put(
+                                {
+                                    "consumer": "remote.vps.agent",
+                                    "type": "receive.json",
+                                    "action": "log_stats",
+                                    "message": message,
+                                }
+                            )
+                except Exception as exc:
+                    logger.exception(exc)
+        except asyncio.CancelledError:
+            if self.polling is not None and not self.polling.done():
+                # the executor is still reading from the descriptors.
+                self.polling.add_done_callback(lambda _: self.close())
+            else:
+                self.close()
+            logger.info(f"log stats shutting down.")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
@@ -2,11 +2,14 @@ import asyncio
 import logging
 from signal import SIGTERM, SIGINT
 
-from gw import GateWayAgent
-from store import Store
-from worker import Worker
+from .gw import GateWayAgent
+from .logstats import LogStats
+from .metrics import JOURNAL_PENDING, MetricsServer, QUEUE_DEPTH
+from .profiler import LoopMonitor
+from .store import Store
+from .worker import Worker
 
-logger = logging.getLogger('agent')
+logger = logging.getLogger('agent.main')
 
 
 def handler(sig, loop):
@@ -22,6 +25,12 @@ def main(store: Store):
 
     gw = GateWayAgent(store)
     worker = Worker(loop, store)
+    log_stats = LogStats(store)
+    metrics = MetricsServer(store)
+    loop_monitor = LoopMonitor(store)
+    QUEUE_DEPTH.set_function(store.receive_queue.qsize, queue="receive")
+    QUEUE_DEPTH.set_function(store.producer_queue.qsize, queue="producer")
+    JOURNAL_PENDING.set_function(gw.journal.__len__)
     # load config
     print(f"main call")
 
@@ -31,6 +40,14 @@ def main(store: Store):
     loop.create_task(gw.websocket_connection())
     loop.create_task(worker.task_queue())
     loop.create_task(worker.cache())
+    loop.create_task(worker.reloader.run())
+    loop.create_task(worker.tickets.run())
+    loop.create_task(worker.ocsp.run())
+    loop.create_task(log_stats.run())
+    loop.create_task(metrics.run())
+    loop.create_task(loop_monitor.run())
+    if worker.coordinator is not None:
+        loop.create_task(worker.coordinator.run())
 
     loop.run_forever()
     tasks = asyncio.all_tasks(loop=loop)
@@ -39,4 +56,5 @@ def main(store: Store):
     gw.finished = True
     group = asyncio.gather(*tasks, return_exceptions=True)
     loop.run_until_complete(group)
+    worker.ratelimit.flush()
     loop.close()
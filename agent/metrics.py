@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+logger = logging.getLogger('agent.metrics')
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._labels(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """ a value set by the caller or, for things like queue depth, read from a function at scrape time. """
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple, float] = {}
+        self.functions: Dict[Tuple, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float], **labels):
+        self.functions[self._key(labels)] = function
+
+    def samples(self) -> List[str]:
+        values = dict(self.values)
+        for key, function in self.functions.items():
+            try:
+                values[key] = function()
+            except Exception as exc:
+                logger.debug(f"{self.name}: {exc}")
+        return [f"{self.name}{self._labels(key)} {value}" for key, value in values.items()]
+
+
+class Histogram(Metric):
+    """ fixed buckets, observe is a bisect and two additions. """
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.values: Dict[Tuple, List] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # [bucket counts..., sum]
+            state = self.values[key] = [0] * len(self.buckets) + [0.0]
+        state[bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, state in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = 'le="+Inf"' if bound == math.inf else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{self._labels(key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {state[-1]}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+ISSUANCE_BUCKETS = (1, 5, 10, 30, 60, 120, 180, 300, 450, 600, 900)
+
+QUEUE_DEPTH = Gauge('agent_queue_depth', 'Items waiting in agent queues.', ['queue'])
+STORE_SECONDS = Histogram('agent_store_seconds', 'Latency of Store redis calls.', ['op'], LATENCY_BUCKETS)
+ISSUANCE_STAGE_SECONDS = Histogram('agent_issuance_stage_seconds',
+                                   'Seconds from add_domain until each letsencrypt stage.', ['stage'],
+                                   ISSUANCE_BUCKETS)
+ISSUANCE_TOTAL = Counter('agent_issuance_total', 'Finished certificate issuances.', ['status'])
+NGINX_RELOADS_TOTAL = Counter('agent_nginx_reloads_total', 'nginx reloads by result.', ['result'])
+GATEWAY_MESSAGES_TOTAL = Counter('agent_gateway_messages_total', 'Gateway messages.', ['direction'])
+LOOP_LAG_SECONDS = Histogram('agent_loop_lag_seconds', 'Event loop scheduling lag.', (),
+                             LATENCY_BUCKETS + (2.5, 5, 10))
+GATEWAY_CONNECTS_TOTAL = Counter('agent_gateway_connects_total', 'Gateway websocket connect attempts.', ['result'])
+GATEWAY_BYTES_TOTAL = Counter('agent_gateway_bytes_total',
+                              'Encoded gateway message bytes, before permessage-deflate.', ['direction'])
+GATEWAY_REPLAYED_TOTAL = Counter('agent_gateway_replayed_total', 'Unacknowledged events sent again after reconnect.')
+JOURNAL_DROPPED_TOTAL = Counter('agent_journal_dropped_total', 'Unacknowledged events dropped from a full journal.')
+QUEUE_DROPPED_TOTAL = Counter('agent_queue_dropped_total', 'Outbound events dropped from a full or superseded '
+                              'queue entry.', ['queue', 'reason'])
+LOG_DROPPED_TOTAL = Counter('agent_log_dropped_total', 'Log records not written, rate limited or queue full.',
+                            ['reason'])
+COMMAND_DUPLICATES_TOTAL = Counter('agent_command_duplicates_total',
+                                   'Retried gateway commands answered from the idempotency cache.', ['action'])
+JOURNAL_PENDING = Gauge('agent_journal_pending', 'Events sent but not acknowledged by the gateway.')
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+class MetricsServer:
+    """ Prometheus text endpoint served from the agent event loop, opt-in with --metrics-port. """
+
+    def __init__(self, store):
+        self.host: str = store.metrics_host
+        self.port: int = store.metrics_port
+        self.server = None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            method, path, *_ = request.split(b" ", 2)
+            if method == b"GET" and path.split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", render().encode()
+            else:
+                status, body = "404 Not Found", b""
+            writer.write(f"HTTP/1.1 {status}\r\n"
+                         f"Content-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self):
+        if not self.port:
+            return
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        logger.info(f"{self}, serving metrics on http://{self.host}:{self.port}/metrics")
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            self.server.close()
+            logger.info(f"metrics server shutting down.")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
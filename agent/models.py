@@ -1,8 +1,6 @@
 import time
 from typing import Dict, List
 
-import dns.resolver
-
 PENDING = "pending"
 SUCCESS = "success"
 FAILED = 'failed'
@@ -17,12 +15,12 @@ class Domain:
     continue_check = False
     cache_time_out = 60 * 11
 
-    def __init__(self, domain: str):
+    def __init__(self, domain: str, nameservers: List[str] = None, port: int = 53):
         self.domain = domain
         self.status = PENDING
         self.account = {}
-        self.resolver = dns.resolver.Resolver()
-        self.resolver.nameservers = ['8.8.8.8', '8.8.8.4']
+        self.nameservers = nameservers or ['8.8.8.8', '8.8.8.4']
+        self.port = port
         self.start_time = time.time()
         self.current_time = time.time()
 
@@ -50,6 +48,16 @@ class Domain:
             "continue_check": self.continue_check,
         }
 
+    @property
+    def resolver(self):
+        # dnspython is only needed by the agent, certbot hooks unpickle Domain and should not pay for the import.
+        import dns.resolver
+
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = self.nameservers
+        resolver.port = self.port
+        return resolver
+
     def get_acme_challenge(self) -> List:
         try:
             results = []
@@ -61,7 +69,8 @@ class Domain:
         except Exception as exc:
             pass
 
-    def check_acme(self):
+    def check_acme(self) -> bool:
+        """ returns True once both challenge tokens are visible in DNS. """
         self.current_time = time.time()
         acme_time = int(self.current_time - self.start_time)
         if acme_time >= self.continue_time_out:
@@ -76,3 +85,5 @@ class Domain:
                     match.append(False)
             if all(match):
                 self.continue_check = True
+                return True
+        return False
@@ -0,0 +1,200 @@
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+from .state import certificate_digest
+from .utils import write_atomic
+from .vhost import ocsp_response_path, vhost_path, write_vhost
+
+logger = logging.getLogger('agent.ocsp')
+
+OPENSSL_TIME_FORMAT = "%b %d %H:%M:%S %Y %Z"
+
+
+def _parse_openssl_time(value: str) -> float:
+    # openssl pads the day with a space: "Oct  1 00:00:00 2026 GMT"
+    value = " ".join(value.split())
+    return datetime.strptime(value, OPENSSL_TIME_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+
+
+def ocsp_state_path(response_path: str) -> str:
+    return os.path.splitext(response_path)[0] + ".json"
+
+
+def discard_response(response_path: str) -> bool:
+    """ remove a response and its sidecar, they belong to a certificate that was replaced. """
+    removed = False
+    for path in (response_path, ocsp_state_path(response_path)):
+        if os.path.exists(path):
+            os.remove(path)
+            removed = True
+    return removed
+
+
+def _file_digest(cert_path: str) -> Optional[str]:
+    try:
+        with open(cert_path, 'rb') as f:
+            return certificate_digest(f.read())
+    except IOError:
+        return None
+
+
+def ocsp_uri(cert_path: str) -> str:
+    result = subprocess.run(['openssl', 'x509', '-noout', '-ocsp_uri', '-in', cert_path],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return result.stdout.decode().strip()
+
+
+def fetch_response(cert_path: str, chain_path: str, response_path: str, url: str = None) -> Tuple[float, float]:
+    """
+    Fetch an OCSP response with the openssl cli and write it in DER format for `ssl_stapling_file`.
+    The response is verified against the issuer chain, so a local stub responder must sign with the issuer.
+    Validity and the digest of the certificate it is for go into a json sidecar next to the response.
+    Returns (this_update, next_update) timestamps.
+    """
+    os.makedirs(os.path.dirname(response_path), exist_ok=True)
+    url = url or ocsp_uri(cert_path)
+    if not url:
+        raise ValueError(f"certificate: {cert_path} has no OCSP responder url.")
+    tmp_path = f"{response_path}.fetch"
+    result = subprocess.run(['openssl', 'ocsp', '-no_nonce',
+                             '-issuer', chain_path, '-cert', cert_path, '-VAfile', chain_path,
+                             '-url', url, '-respout', tmp_path],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=30)
+    output = result.stdout.decode()
+    try:
+        if result.returncode != 0 or f"{cert_path}: good" not in output:
+            raise ValueError(f"OCSP request for {cert_path} failed: {output.strip()}")
+        this_update = next_update = None
+        for line in output.splitlines():
+            key, _, value = line.strip().partition(": ")
+            if key == "This Update":
+                this_update = _parse_openssl_time(value)
+            elif key == "Next Update":
+                next_update = _parse_openssl_time(value)
+        if this_update is None or next_update is None:
+            raise ValueError(f"OCSP response for {cert_path} has no validity period: {output.strip()}")
+        with open(tmp_path, 'rb') as f:
+            write_atomic(response_path, f.read(), mode=0o644)
+        write_atomic(ocsp_state_path(response_path),
+                     json.dumps({"this_update": this_update, "next_update": next_update,
+                                 "certificate": _file_digest(cert_path)}).encode(), mode=0o644)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return this_update, next_update
+
+
+class OcspStapler:
+    """
+    Keeps an OCSP response for every certificate in letsencrypt `live/` ready for `ssl_stapling_file`, so nginx
+    never queries the CA responder during a handshake.
+    A response is refreshed once half of its validity period is gone or when it is for another certificate
+    than the one in `live/`, all refreshed responses go into one reload.
+    """
+    check_interval = 60 * 60
+    concurrency = 8
+
+    def __init__(self, store, reloader):
+        self.letsencrypt_path: str = store.letsencrypt_path
+        self.nginx_path: str = store.nginx_path
+        self.access_log_mode: str = store.access_log_mode
+        self.responder_url: Optional[str] = store.ocsp_responder
+        self.reloader = reloader
+        self.finished = False
+        self.path = os.path.join(self.letsencrypt_path, "ocsp")
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def validity(self, domain: str) -> Optional[Dict]:
+        response_path = ocsp_response_path(self.letsencrypt_path, domain)
+        if not os.path.isfile(response_path):
+            return None
+        try:
+            with open(ocsp_state_path(response_path), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def replaced(self, domain: str, validity: Optional[Dict]) -> bool:
+        """ the response is for a certificate that was renewed since, sidecars without digest are not judged. """
+        if validity is None or "certificate" not in validity:
+            return False
+        cert_path = os.path.join(self.letsencrypt_path, "live", domain, "cert.pem")
+        return validity["certificate"] != _file_digest(cert_path)
+
+    @staticmethod
+    def expired(validity: Optional[Dict], now: float) -> bool:
+        """ past nextUpdate clients reject the staple, none is better than that. """
+        return validity is not None and now >= validity["next_update"]
+
+    def needs_refresh(self, domain: str, now: float) -> bool:
+        validity = self.validity(domain)
+        if validity is None or self.replaced(domain, validity):
+            return True
+        this_update, next_update = validity["this_update"], validity["next_update"]
+        return now >= this_update + (next_update - this_update) / 2
+
+    def domains(self):
+        live_path = os.path.join(self.letsencrypt_path, "live")
+        if not os.path.isdir(live_path):
+            return []
+        return [name for name in os.listdir(live_path)
+                if os.path.isfile(os.path.join(live_path, name, "cert.pem"))]
+
+    async def refresh(self, domain: str) -> bool:
+        """ True when nginx needs a reload, for a new response or for a stale one that is no longer stapled. """
+        live_path = os.path.join(self.letsencrypt_path, "live", domain)
+        response_path = ocsp_response_path(self.letsencrypt_path, domain)
+        # a failed fetch must not leave the previous certificate's response, or an expired one, stapled.
+        validity = self.validity(domain)
+        discarded = ((self.replaced(domain, validity) or self.expired(validity, time.time()))
+                     and discard_response(response_path))
+        fetched = True
+        async with self._semaphore:
+            try:
+                await asyncio.get_event_loop().run_in_executor(
+                    None, fetch_response,
+                    os.path.join(live_path, "cert.pem"),
+                    os.path.join(live_path, "chain.pem"),
+                    response_path,
+                    self.responder_url,
+                )
+            except Exception as exc:
+                logger.warning(f"{self}, {domain}: {exc}")
+                fetched = False
+        if not fetched and not discarded:
+            return False
+        # stapling directives follow whether there is a response.
+        if os.path.isfile(vhost_path(self.nginx_path, domain)):
+            write_vhost(self.nginx_path, self.letsencrypt_path, domain, self.access_log_mode)
+        return True
+
+    async def check(self):
+        now = time.time()
+        domains = [domain for domain in self.domains() if self.needs_refresh(domain, now)]
+        if not domains:
+            return
+        results = await asyncio.gather(*[self.refresh(domain) for domain in domains])
+        if any(results):
+            self.reloader.request(f"{sum(results)} OCSP responses refreshed")
+
+    async def run(self):
+        try:
+            while not self.finished:
+                try:
+                    await self.check()
+                except Exception as exc:
+                    logger.exception(exc)
+                await asyncio.sleep(self.check_interval)
+        except asyncio.CancelledError:
+            logger.info(f"OCSP stapler shutting down.")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
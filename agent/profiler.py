@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+from typing import Dict, List
+
+from .metrics import LOOP_LAG_SECONDS
+
+logger = logging.getLogger('agent.profiler')
+
+
+def _frame_key(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag with a periodic sleep, a watchdog thread logs the loop thread stack while a single
+    callback blocks longer than `threshold`, so the offending sync call (redis, dns, json) shows up by name.
+    """
+    interval = 0.25
+
+    def __init__(self, store):
+        self.threshold: float = store.slow_callback_ms / 1000
+        self.finished = False
+        self.last_tick = time.monotonic()
+        self.loop_thread_id = None
+        self._reported = False
+
+    def watchdog(self):
+        while not self.finished:
+            time.sleep(self.threshold / 2)
+            blocked = time.monotonic() - self.last_tick - self.interval
+            if blocked < self.threshold:
+                self._reported = False
+                continue
+            if self._reported:
+                continue
+            self._reported = True
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                stack = "".join(traceback.format_stack(frame))
+                logger.warning(f"{self}, event loop blocked for {blocked * 1000:.0f}ms in:\n{stack}")
+
+    async def run(self):
+        if not self.threshold:
+            return
+        self.loop_thread_id = threading.get_ident()
+        threading.Thread(target=self.watchdog, name="loop-watchdog", daemon=True).start()
+        try:
+            while not self.finished:
+                start = time.monotonic()
+                self.last_tick = start
+                await asyncio.sleep(self.interval)
+                LOOP_LAG_SECONDS.observe(max(time.monotonic() - start - self.interval, 0))
+        except asyncio.CancelledError:
+            self.finished = True
+            logger.info(f"loop monitor shutting down.")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
+
+
+class SamplingProfiler:
+    """
+    Samples the event loop thread stack from a helper thread, while the loop keeps serving.
+    Reports the top functions by own samples and by cumulative samples plus the top tracemalloc allocations,
+    own samples in `select` are the loop being idle.
+    """
+    sample_interval = 0.005
+    max_seconds = 60
+
+    def __init__(self):
+        self.running = False
+
+    def _sample(self, thread_id: int, stop: threading.Event, own: Counter, cumulative: Counter, total: List[int]):
+        while not stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            total[0] += 1
+            own[_frame_key(frame)] += 1
+            seen = set()
+            while frame is not None:
+                key = _frame_key(frame)
+                if key not in seen:
+                    seen.add(key)
+                    cumulative[key] += 1
+                frame = frame.f_back
+
+    async def profile(self, seconds: float = 5, top: int = 20) -> Dict:
+        if self.running:
+            raise ValueError("Profiler is already running.")
+        self.running = True
+        seconds = min(float(seconds), self.max_seconds)
+        own, cumulative, total = Counter(), Counter(), [0]
+        stop = threading.Event()
+        started_tracemalloc = not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start()
+        sampler = threading.Thread(target=self._sample, name="profiler",
+                                   args=(threading.get_ident(), stop, own, cumulative, total), daemon=True)
+        try:
+            sampler.start()
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            sampler.join()
+            snapshot = tracemalloc.take_snapshot()
+            if started_tracemalloc:
+                tracemalloc.stop()
+            self.running = False
+        statistics = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics('lineno')
+        return {
+            "seconds": seconds,
+            "samples": total[0],
+            "own": [[key, count] for key, count in own.most_common(top)],
+            "cumulative": [[key, count] for key, count in cumulative.most_common(top)],
+            "memory": [[f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+                        stat.size, stat.count] for stat in statistics[:top]],
+        }
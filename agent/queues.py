@@ -0,0 +1,174 @@
+import asyncio
+import logging
+from collections import deque, OrderedDict
+from typing import Dict, Hashable, Optional
+
+from .metrics import QUEUE_DROPPED_TOTAL
+
+logger = logging.getLogger('agent.queues')
+
+CONTROL, RESULT, PROGRESS = range(3)
+CONTROL_ACTIONS = {"heartbeat", "profile_result"}
+# only the newest one is worth sending, a queued one is replaced.
+LATEST_ONLY_ACTIONS = {"heartbeat"}
+PROGRESS_ACTIONS = {"acme_pending"}
+
+
+def priority(event) -> int:
+    if event is None:
+        # producer shutdown sentinel.
+        return CONTROL
+    action = event.get("action")
+    if action in CONTROL_ACTIONS:
+        return CONTROL
+    if action in PROGRESS_ACTIONS:
+        return PROGRESS
+    return RESULT
+
+
+def event_domain(event) -> Optional[str]:
+    message = event.get("message")
+    if isinstance(message, dict) and message.get("domain"):
+        return message["domain"]
+    return None
+
+
+def supersede_key(event) -> Optional[Hashable]:
+    """ a newer progress event with the same key replaces the queued one, e.g. acme_pending per domain. """
+    domain = event_domain(event)
+    if domain is not None:
+        return event.get("action"), domain
+    return None
+
+
+def merge_telemetry(queued, event):
+    """ telemetry only carries what changed, values of the replaced heartbeat the newer one does not repeat stay. """
+    old = (queued.get("data") or {}).get("telemetry")
+    new = (event.get("data") or {}).get("telemetry")
+    if not old or new is None:
+        return event
+    return {**event, "data": {**event["data"], "telemetry": {**old, **new}}}
+
+
+class PriorityEventQueue:
+    """
+    Bounded outbound queue, `get` returns control (heartbeat) before final results before progress updates.
+    Progress updates are superseded per domain and are dropped, oldest first, to make room when full.
+    A result drops the queued progress of its domain, sent after it that would be stale,
+    and a queued heartbeat is replaced by the newer one.
+    When only control and results are queued `put` waits for room, `put_nowait` raises `asyncio.QueueFull`.
+    Same interface as `asyncio.Queue` for the parts the agent uses.
+    """
+
+    def __init__(self, maxsize: int = 1000, name: str = "producer"):
+        self.maxsize = maxsize
+        self.name = name
+        self.control = deque()
+        self.results = deque()
+        self.progress: "OrderedDict[Hashable, Dict]" = OrderedDict()
+        self.dropped: Dict[str, int] = {"superseded": 0, "overflow": 0}
+        self._sequence = 0
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+
+    def qsize(self) -> int:
+        return len(self.control) + len(self.results) + len(self.progress)
+
+    def empty(self) -> bool:
+        return not self.qsize()
+
+    def full(self) -> bool:
+        return self.qsize() >= self.maxsize
+
+    def _drop(self, reason: str):
+        self.dropped[reason] += 1
+        QUEUE_DROPPED_TOTAL.inc(queue=self.name, reason=reason)
+
+    def _has_room(self) -> bool:
+        if not self.full():
+            return True
+        if self.progress:
+            self.progress.popitem(last=False)
+            self._drop("overflow")
+            return True
+        return False
+
+    def _replace_control(self, event) -> bool:
+        if event is None or event.get("action") not in LATEST_ONLY_ACTIONS:
+            return False
+        for index, queued in enumerate(self.control):
+            if queued is not None and queued.get("action") == event["action"]:
+                self.control[index] = merge_telemetry(queued, event)
+                self._drop("superseded")
+                return True
+        return False
+
+    def _drop_progress(self, event):
+        domain = event_domain(event)
+        if domain is None:
+            return
+        for action in PROGRESS_ACTIONS:
+            if self.progress.pop((action, domain), None) is not None:
+                self._drop("superseded")
+
+    def put_nowait(self, event):
+        level = priority(event)
+        if level == PROGRESS:
+            key = supersede_key(event)
+            if key is not None and key in self.progress:
+                # keeps its place in line, only the content is newer.
+                self.progress[key] = event
+                self._drop("superseded")
+                return
+            if not self._has_room():
+                # nothing older to drop, the newest progress update goes.
+                self._drop("overflow")
+                return
+            if key is None:
+                self._sequence += 1
+                key = self._sequence
+            self.progress[key] = event
+        else:
+            if level == CONTROL and self._replace_control(event):
+                return
+            if level == RESULT:
+                self._drop_progress(event)
+            if not self._has_room():
+                raise asyncio.QueueFull
+            (self.control if level == CONTROL else self.results).append(event)
+        self._not_empty.set()
+        if self.full():
+            self._not_full.clear()
+
+    async def put(self, event):
+        while True:
+            try:
+                return self.put_nowait(event)
+            except asyncio.QueueFull:
+                logger.debug("%s, %s full at %s, waiting for the gateway to drain it.", self, self.name, self.maxsize)
+                self._not_full.clear()
+                await self._not_full.wait()
+
+    def get_nowait(self):
+        if self.control:
+            event = self.control.popleft()
+        elif self.results:
+            event = self.results.popleft()
+        elif self.progress:
+            _, event = self.progress.popitem(last=False)
+        else:
+            raise asyncio.QueueEmpty
+        if self.empty():
+            self._not_empty.clear()
+        self._not_full.set()
+        return event
+
+    async def get(self):
+        while self.empty():
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        return self.get_nowait()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from .utils import write_atomic
+
+logger = logging.getLogger('agent.ratelimit')
+
+DAY = 24 * 60 * 60
+
+# Let's Encrypt production limits, (orders, window seconds).
+LIMITS = {
+    "registered_domain": (50, 7 * DAY),
+    "san_set": (5, 7 * DAY),
+    "account": (300, 3 * 60 * 60),
+    "failed_validation": (5, 60 * 60),
+}
+
+RETRY_AFTER_PATTERN = re.compile(r"retry after (\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d)", re.I)
+
+_extract = None
+
+
+def registered_domain(domain: str) -> str:
+    """
+    `shop.example.co.uk` -> `example.co.uk`, with the public suffix list bundled in tldextract, no download.
+    There is no fallback, guessing `co.uk` would put every customer under it into one rate limit bucket.
+    """
+    global _extract
+    domain = domain.lstrip("*.").lower()
+    if _extract is None:
+        import tldextract
+        _extract = tldextract.TLDExtract(suffix_list_urls=(), cache_dir=None)
+    return _extract(domain).registered_domain or domain
+
+
+class RateLimitLedger:
+    """
+    Sliding window ledger of this agent's ACME orders, kept in `<config_path>/ratelimit.json`.
+    `check` tells how long an order for a domain has to wait so it does not hit a Let's Encrypt limit,
+    blocks reported by the CA itself ("retry after ...") are kept until they pass.
+    Changes apply in memory at once, on the event loop they reach the file `save_delay` seconds later in one
+    write from the executor, a burst of orders is one fsync and the loop never waits for the disk.
+    """
+    save_delay = 1.0
+
+    def __init__(self, config_path: str):
+        self.path = os.path.join(config_path, "ratelimit.json")
+        self.orders: Dict[str, List[float]] = {}
+        self.blocked: Dict[str, float] = {}
+        self._save_handle: Optional[asyncio.TimerHandle] = None
+        self._writing: Optional[asyncio.Future] = None
+        os.makedirs(config_path, exist_ok=True)
+        self.load()
+        # without tldextract the agent stops here, not at the first order.
+        registered_domain("example.com")
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self.orders, self.blocked = data.get("orders", {}), data.get("blocked", {})
+        except FileNotFoundError:
+            pass
+        except ValueError as exc:
+            logger.warning(f"{self}, {self.path} unreadable, starting empty: {exc}")
+
+    def _snapshot(self, now: float) -> bytes:
+        longest = max(window for _, window in LIMITS.values())
+        self.orders = {key: [at for at in times if at > now - longest] for key, times in self.orders.items()}
+        self.orders = {key: times for key, times in self.orders.items() if times}
+        self.blocked = {key: until for key, until in self.blocked.items() if until > now}
+        return json.dumps({"orders": self.orders, "blocked": self.blocked}).encode()
+
+    def save(self, now: float):
+        """ write now, in this thread. """
+        write_atomic(self.path, self._snapshot(now), 0o644)
+
+    def changed(self):
+        """ schedule a save, at once outside an event loop. """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save(time.time())
+            return
+        if self._save_handle is None:
+            self._save_handle = loop.call_later(self.save_delay, self._save_in_executor, loop)
+
+    def _save_in_executor(self, loop: asyncio.AbstractEventLoop):
+        if self._writing is not None and not self._writing.done():
+            # one write at a time, an older snapshot never lands after a newer one.
+            self._save_handle = loop.call_later(self.save_delay, self._save_in_executor, loop)
+            return
+        self._save_handle = None
+        self._writing = loop.run_in_executor(None, write_atomic, self.path, self._snapshot(time.time()), 0o644)
+
+    def flush(self):
+        """ write a scheduled save before the loop goes away. """
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+            self.save(time.time())
+
+    @staticmethod
+    def keys(domain: str) -> Dict[str, str]:
+        # letsencrypt_fork orders the domain and its wildcard on the one account of this box.
+        return {
+            "registered_domain": f"registered_domain:{registered_domain(domain)}",
+            "san_set": f"san_set:{domain},*.{domain}",
+            "account": "account",
+            "failed_validation": f"failed_validation:{domain}",
+        }
+
+    def check(self, domain: str, now: float) -> Optional[Tuple[str, float]]:
+        """ (limit, seconds to wait) when an order now would exceed a limit, None when it may go ahead. """
+        worst = None
+        for limit, key in self.keys(domain).items():
+            count, window = LIMITS[limit]
+            times = [at for at in self.orders.get(key, []) if at > now - window]
+            wait = 0.0
+            if len(times) >= count:
+                # the oldest order that has to leave the window before one more fits.
+                wait = sorted(times)[len(times) - count] + window - now
+            wait = max(wait, self.blocked.get(key, 0) - now)
+            if wait > 0 and (worst is None or wait > worst[1]):
+                worst = (limit, wait)
+        return worst
+
+    def record(self, domain: str, now: float):
+        """ count an order placed at `now`, recorded when it is admitted so the next `check` already sees it. """
+        keys = self.keys(domain)
+        for limit in ("registered_domain", "san_set", "account"):
+            self.orders.setdefault(keys[limit], []).append(now)
+        self.changed()
+
+    def release(self, domain: str, at: float):
+        """ undo `record(domain, at)` for an order that was never placed. """
+        keys = self.keys(domain)
+        for limit in ("registered_domain", "san_set", "account"):
+            times = self.orders.get(keys[limit], [])
+            if at in times:
+                times.remove(at)
+        self.changed()
+
+    def record_failure(self, domain: str, now: float, error: str = ""):
+        """ a failed order, with the CA's retry-after when the failure was a rate limit. """
+        keys = self.keys(domain)
+        self.orders.setdefault(keys["failed_validation"], []).append(now)
+        match = RETRY_AFTER_PATTERN.search(error)
+        if match:
+            until = datetime.fromisoformat(match.group(1).replace(" ", "T") + "+00:00").timestamp()
+            if "duplicate" in error.lower():
+                limit = "san_set"
+            elif "failed authorization" in error.lower():
+                limit = "failed_validation"
+            else:
+                limit = "registered_domain"
+            self.blocked[keys[limit]] = max(self.blocked.get(keys[limit], 0), until)
+            logger.warning(f"{self}, {domain}: rate limited by the CA until {match.group(1)}")
+        self.changed()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
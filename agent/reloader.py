@@ -0,0 +1,62 @@
+import asyncio
+import logging
+
+from .metrics import NGINX_RELOADS_TOTAL
+
+logger = logging.getLogger('agent.reloader')
+
+
+class NginxReloader:
+    """
+    Coalesce reload requests from every subsystem into a single `nginx -s reload`.
+    Callers only call `request()`, the `run` task validates config with `nginx -t` before reloading.
+    """
+    delay = 2
+
+    def __init__(self, store):
+        self.nginx_binary: str = store.nginx_binary
+        self.finished = False
+        self.reloads = 0
+        self._event = asyncio.Event()
+
+    def request(self, reason: str = ""):
+        logger.debug("%s, reload requested: %s", self, reason)
+        self._event.set()
+
+    async def _exec(self, *args) -> bool:
+        process = await asyncio.create_subprocess_exec(self.nginx_binary, *args,
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.STDOUT,
+                                                       )
+        stdout, _ = await process.communicate()
+        if process.returncode != 0:
+            logger.warning(f"{self}, nginx {' '.join(args)}: {stdout.decode().strip()}")
+        return process.returncode == 0
+
+    async def reload(self) -> bool:
+        if not await self._exec('-t'):
+            NGINX_RELOADS_TOTAL.inc(result="invalid")
+            return False
+        if not await self._exec('-s', 'reload'):
+            NGINX_RELOADS_TOTAL.inc(result="failed")
+            return False
+        self.reloads += 1
+        NGINX_RELOADS_TOTAL.inc(result="success")
+        return True
+
+    async def run(self):
+        try:
+            while not self.finished:
+                await self._event.wait()
+                # let concurrent writers finish, everything requested meanwhile goes into this reload.
+                await asyncio.sleep(self.delay)
+                self._event.clear()
+                try:
+                    await self.reload()
+                except Exception as exc:
+                    logger.exception(exc)
+        except asyncio.CancelledError:
+            logger.info(f"nginx reloader shutting down.")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
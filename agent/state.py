@@ -0,0 +1,163 @@
+import base64
+import calendar
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .utils import write_atomic
+from .vhost import shared_domains
+
+logger = logging.getLogger('agent.state')
+
+PEM_BEGIN = b"-----BEGIN CERTIFICATE-----"
+PEM_END = b"-----END CERTIFICATE-----"
+
+
+def _der_read(data: bytes, offset: int) -> Tuple[int, int, int]:
+    """ (tag, content start, content end) of the DER element at offset. """
+    tag, length = data[offset], data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7f
+        length = int.from_bytes(data[offset:offset + size], 'big')
+        offset += size
+    return tag, offset, offset + length
+
+
+def certificate_not_after(pem: bytes) -> float:
+    """
+    notAfter of the first certificate in pem as a timestamp, read straight from the DER,
+    an openssl process per certificate would make a cold sync of 10k domains take minutes.
+    """
+    start = pem.index(PEM_BEGIN) + len(PEM_BEGIN)
+    der = base64.b64decode(pem[start:pem.index(PEM_END, start)])
+    _, position, _ = _der_read(der, 0)
+    # tbsCertificate: [0] version, serialNumber, signature, issuer, validity ...
+    _, position, _ = _der_read(der, position)
+    tag, _, end = _der_read(der, position)
+    if tag == 0xa0:
+        _, _, end = _der_read(der, end)
+    _, _, end = _der_read(der, end)
+    _, _, end = _der_read(der, end)
+    _, position, _ = _der_read(der, end)
+    _, _, end = _der_read(der, position)
+    tag, start, end = _der_read(der, end)
+    value = der[start:end].decode()
+    # UTCTime YYMMDDHHMMSSZ, GeneralizedTime YYYYMMDDHHMMSSZ
+    return calendar.timegm(time.strptime(value, "%y%m%d%H%M%SZ" if tag == 0x17 else "%Y%m%d%H%M%SZ"))
+
+
+def certificate_digest(pem: bytes) -> str:
+    """ digest of a `cert.pem` as the manifest and the sync_state reply carry it. """
+    return hashlib.sha256(pem).hexdigest()[:16]
+
+
+class CertificateDigests:
+    """
+    sha256 and expiry of every `live/<domain>/cert.pem`, recomputed only when the file behind the link changed
+    (inode, size, mtime), kept in `<config_path>/sync-cache.json` so a restarted agent starts warm.
+    """
+
+    def __init__(self, config_path: str):
+        self.path = os.path.join(config_path, "sync-cache.json")
+        # cert path -> [inode, size, mtime_ns, digest, not_after]
+        self.entries: Dict[str, List] = {}
+        self.changed = False
+        try:
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as exc:
+            logger.warning(f"{self}, {self.path} unreadable, starting cold: {exc}")
+
+    def get(self, path: str) -> Optional[Tuple[str, float]]:
+        """ (digest, not_after) of the certificate at path, None when there is none. """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+        entry = self.entries.get(path)
+        if entry is not None and entry[:3] == key:
+            return entry[3], entry[4]
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest, not_after = certificate_digest(data), certificate_not_after(data)
+        except (IOError, ValueError, IndexError) as exc:
+            logger.warning(f"{self}, {path}: {exc}")
+            return None
+        self.entries[path] = key + [digest, not_after]
+        self.changed = True
+        return digest, not_after
+
+    def save(self):
+        if self.changed:
+            write_atomic(self.path, json.dumps(self.entries).encode(), 0o644)
+            self.changed = False
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
+
+
+AGENT_CONFIGS = ("00-nginx-agent-",)
+
+
+def deployed_domains(nginx_path: str, vhost_mode: str = "domain") -> List[str]:
+    """ domains with a vhost in `vhost_mode`, one listdir or one map read instead of a stat per domain. """
+    if vhost_mode == "shared":
+        return shared_domains(nginx_path)
+    try:
+        names = os.listdir(os.path.join(nginx_path, "conf.d"))
+    except OSError:
+        return []
+    return [name[:-len(".conf")] for name in names if name.endswith(".conf") and not name.startswith(AGENT_CONFIGS)]
+
+
+def scan(nginx_path: str, letsencrypt_path: str, digests: CertificateDigests,
+         vhost_mode: str = "domain") -> Dict[str, Dict]:
+    """ what this box serves: domain -> {"digest", "not_after", "deployed"}, digest None without certificate. """
+    live_path = os.path.join(letsencrypt_path, "live")
+    try:
+        certificates = os.listdir(live_path)
+    except OSError:
+        certificates = []
+    state = {}
+    for domain in certificates:
+        certificate = digests.get(os.path.join(live_path, domain, "cert.pem"))
+        if certificate is not None:
+            state[domain] = {"digest": certificate[0], "not_after": certificate[1], "deployed": False}
+    for domain in deployed_domains(nginx_path, vhost_mode):
+        state.setdefault(domain, {"digest": None, "not_after": None, "deployed": False})["deployed"] = True
+    digests.save()
+    return state
+
+
+def plan(manifest: Dict[str, Optional[str]], state: Dict[str, Dict], now: float, renew_before: float,
+         prune: bool = False) -> Dict[str, List[str]]:
+    """
+    diff the control plane manifest (domain -> digest of the certificate it expects, or None) against `scan`:
+        issue       no certificate, or one that expires within `renew_before`
+        deploy      certificate fine, vhost missing
+        unchanged   certificate fine, vhost in place
+        mismatch    certificate fine but not the one the manifest expects, a vhost does not change that,
+                    the right bundle has to be installed. Also in deploy or unchanged, it is served meanwhile.
+        prune       served here but not in the manifest, with `prune`
+    A None digest in the manifest has no opinion about which certificate is served.
+    """
+    result = {"issue": [], "deploy": [], "unchanged": [], "mismatch": [], "prune": []}
+    for domain, digest in manifest.items():
+        local = state.get(domain)
+        if local is None or local["digest"] is None or local["not_after"] - now < renew_before:
+            result["issue"].append(domain)
+            continue
+        result["deploy" if not local["deployed"] else "unchanged"].append(domain)
+        if digest is not None and local["digest"] != digest:
+            result["mismatch"].append(domain)
+    if prune:
+        result["prune"] = [domain for domain, local in state.items() if local["deployed"] and domain not in manifest]
+    return result
@@ -1,7 +1,14 @@
 import asyncio
+import os
 import pickle
+import time
+from typing import Dict
+
 import redis
 
+from .metrics import STORE_SECONDS
+from .queues import PriorityEventQueue
+
 
 class Store:
     connect_url = ""
@@ -10,17 +17,52 @@ class Store:
     nginx_path = '/etc/nginx/'
     letsencrypt_path = '/etc/letsencrypt/'
     config_path = '/etc/nginx-agent/'
+    nginx_binary = '/usr/sbin/nginx'
+    ocsp_responder = None
+    log_path = '/var/log/nginx/'
+    log_stats_interval = 60
+    stub_status_url = 'http://127.0.0.1:8088/nginx_status'
+    metrics_host = '127.0.0.1'
+    metrics_port = 0
+    slow_callback_ms = 200
+    nginx_pid_path = '/run/nginx.pid'
+    redis_url = 'redis://localhost:6379/0'
+    nameservers = ['8.8.8.8', '8.8.8.4']
+    dns_port = 53
+    acme_dns_url = 'https://auth.acme-dns.io'
+    hook_command = None
+    codecs = ('msgpack', 'orjson', 'json')
+    no_compression = False
+    compression_level = 6
+    compression_window_bits = 15
+    compression_mem_level = 8
+    journal_size = 1000
+    journal_path = None
+    reconnect_max_delay = 60
+    receive_queue_size = 100
+    producer_queue_size = 1000
+    shared_redis_url = None
+    node_name = None
+    ratelimit_max_defer = 60 * 60
+    vhost_mode = 'domain'
+    access_log_mode = 'domain'
+    idempotency_size = 10000
+    idempotency_ttl = 6 * 60 * 60
+    sync_renew_before = 30 * 24 * 60 * 60
+    sync_issue_limit = 100
 
     def __init__(self, **kwargs):
-        self.cache = redis.Redis(host='localhost', port=6379, db=0)
-        self.cache.flushall()
-
-        self.receive_queue = asyncio.Queue()
-        self.producer_queue = asyncio.Queue()
         for k, v in kwargs.items():
             if hasattr(self, k) and v:
                 setattr(self, k, v)
 
+        self.cache = redis.Redis.from_url(self.redis_url)
+        self.cache.flushall()
+
+        # a full receive queue stops reading the websocket, the gateway sees TCP backpressure.
+        self.receive_queue = asyncio.Queue(self.receive_queue_size)
+        self.producer_queue = PriorityEventQueue(self.producer_queue_size)
+
         if not self.connect_url or not self.connect_token:
             raise ValueError(f"connect_url {self.connect_url} and connect_token {self.connect_token} required!")
 
@@ -29,35 +71,36 @@ class Store:
             if hasattr(self, k) and v:
                 setattr(self, k, v)
 
+    @property
+    def accounts_path(self) -> str:
+        return os.path.join(self.config_path, "accounts.sqlite3")
+
+    def hook_environ(self) -> Dict[str, str]:
+        """ settings for certbot hooks, they run in their own process below `letsencrypt`. """
+        environ = {
+            "NGINX_AGENT_NGINX_PATH": self.nginx_path,
+            "NGINX_AGENT_LETSENCRYPT_PATH": self.letsencrypt_path,
+            "NGINX_AGENT_REDIS_URL": self.redis_url,
+            "NGINX_AGENT_ACME_DNS_URL": self.acme_dns_url,
+            "NGINX_AGENT_ACCOUNTS_PATH": self.accounts_path,
+            "NGINX_AGENT_VHOST_MODE": self.vhost_mode,
+            "NGINX_AGENT_ACCESS_LOG_MODE": self.access_log_mode,
+        }
+        if self.ocsp_responder:
+            environ["NGINX_AGENT_OCSP_RESPONDER"] = self.ocsp_responder
+        return environ
+
     def get_cache(self, key: str):
-        if value := self.cache.get(key):
+        start = time.perf_counter()
+        value = self.cache.get(key)
+        STORE_SECONDS.observe(time.perf_counter() - start, op="get")
+        if value:
             return pickle.loads(value)
         raise ValueError(f"Object {key} are not exists in cache.")
 
     def set_cache(self, key, value, ex=None):
-        return self.cache.set(key, pickle.dumps(value), ex)
-
-
-LOGGING_CONFIG = {
-    'version': 1,
-    'disable_existing_loggers': False,
-    'formatters': {
-        "main_formatter": {
-            "format": "%(levelname)s:%(name)s: %(message)s(%(asctime)s; %(filename)s:%(lineno)d)",
-            "datefmt": "%Y-%m-%d %H:%M:%S"
-        }
-    },
-    'handlers': {
-        "console": {
-            "class": "logging.StreamHandler",
-            "formatter": "main_formatter"
-        },
-    },
-    'loggers': {
-        'agent': {
-            'level': 'DEBUG',
-            'handlers': ['console'],
-            'propagate': False
-        },
-    },
-}
+        start = time.perf_counter()
+        try:
+            return self.cache.set(key, pickle.dumps(value), ex)
+        finally:
+            STORE_SECONDS.observe(time.perf_counter() - start, op="set")
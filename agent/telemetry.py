@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+logger = logging.getLogger('agent.telemetry')
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+CPU_FIELDS = ("user", "nice", "system", "idle", "iowait", "irq", "softirq", "steal")
+
+# counters (cpu_*, nginx_accepts/handled/requests) are sent as they are, the gateway takes the difference
+# between heartbeats, a heartbeat replaced in the queue or lost on a disconnect loses no increments.
+
+
+def _read(path: str) -> str:
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def parse_stub_status(text: str) -> Dict[str, int]:
+    """
+    Active connections: 291
+    server accepts handled requests
+     16630948 16630948 31070465
+    Reading: 6 Writing: 179 Waiting: 106
+    """
+    lines = text.strip().splitlines()
+    accepts, handled, requests = (int(value) for value in lines[2].split())
+    fields = lines[3].split()
+    return {
+        "active": int(lines[0].split(":")[1]),
+        "accepts": accepts,
+        "handled": handled,
+        "requests": requests,
+        "reading": int(fields[1]),
+        "writing": int(fields[3]),
+        "waiting": int(fields[5]),
+    }
+
+
+class TelemetrySampler:
+    """
+    Host and nginx gauges piggybacked on the heartbeat, only what changed since the previous heartbeat is sent.
+    Every `keyframe` samples the full state goes out, so a lost heartbeat can not leave stale values behind.
+    """
+    keyframe = 10
+    timeout = 2
+
+    def __init__(self, store):
+        self.stub_status_url: Optional[str] = store.stub_status_url
+        self.nginx_pid_path: str = store.nginx_pid_path
+        self.last: Dict = {}
+        self.samples = 0
+
+    async def stub_status(self) -> Dict[str, int]:
+        url = urlsplit(self.stub_status_url)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(url.hostname, url.port or 80), self.timeout)
+        try:
+            writer.write(f"GET {url.path or '/'} HTTP/1.0\r\nHost: {url.hostname}\r\n\r\n".encode())
+            response = await asyncio.wait_for(reader.read(), self.timeout)
+        finally:
+            writer.close()
+        head, _, body = response.decode().partition("\r\n\r\n")
+        if " 200 " not in head.splitlines()[0]:
+            raise ValueError(f"stub_status {self.stub_status_url}: {head.splitlines()[0]}")
+        return {f"nginx_{key}": value for key, value in parse_stub_status(body).items()}
+
+    def worker_pids(self) -> List[int]:
+        try:
+            master = int(_read(self.nginx_pid_path).strip())
+            children = _read(f"/proc/{master}/task/{master}/children").split()
+        except (IOError, ValueError):
+            return []
+        return [int(pid) for pid in children]
+
+    @staticmethod
+    def rss(pid) -> int:
+        return int(_read(f"/proc/{pid}/statm").split()[1]) * PAGE_SIZE
+
+    def host(self) -> Dict:
+        sample = {}
+        load = _read("/proc/loadavg").split()
+        sample["load1"], sample["load5"], sample["load15"] = (float(value) for value in load[:3])
+        cpu = _read("/proc/stat").splitlines()[0].split()[1:len(CPU_FIELDS) + 1]
+        sample.update({f"cpu_{name}": int(value) for name, value in zip(CPU_FIELDS, cpu)})
+        for line in _read("/proc/meminfo").splitlines():
+            key, _, value = line.partition(":")
+            if key in ("MemTotal", "MemAvailable"):
+                sample["mem_total" if key == "MemTotal" else "mem_available"] = int(value.split()[0]) * 1024
+        allocated, _, maximum = _read("/proc/sys/fs/file-nr").split()
+        sample["fd_allocated"], sample["fd_max"] = int(allocated), int(maximum)
+        sample["agent_rss"] = self.rss("self")
+        for pid in self.worker_pids():
+            try:
+                sample[f"worker_rss_{pid}"] = self.rss(pid)
+            except (IOError, ValueError):
+                pass
+        return sample
+
+    async def sample(self) -> Dict:
+        sample = {}
+        try:
+            sample.update(self.host())
+        except (IOError, ValueError, IndexError) as exc:
+            logger.debug(f"{self}, host sample failed: {exc}")
+        if self.stub_status_url:
+            try:
+                sample.update(await self.stub_status())
+            except (OSError, ValueError, IndexError, asyncio.TimeoutError) as exc:
+                logger.debug(f"{self}, stub_status failed: {exc}")
+        return sample
+
+    def delta(self, sample: Dict) -> Dict:
+        full = self.samples % self.keyframe == 0
+        self.samples += 1
+        delta = {}
+        for key, value in sample.items():
+            if full or value != self.last.get(key):
+                delta[key] = value
+        # gone keys, e.g. a nginx worker replaced on reload.
+        for key in self.last.keys() - sample.keys():
+            delta[key] = None
+        self.last = sample
+        if full:
+            delta["full"] = True
+        return delta
+
+    async def heartbeat(self) -> Dict:
+        return self.delta(await self.sample())
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
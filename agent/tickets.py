@@ -0,0 +1,140 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from .utils import write_atomic
+
+logger = logging.getLogger('agent.tickets')
+
+TICKET_KEY_SIZES = (48, 80)
+
+
+class TicketKeyManager:
+    """
+    Session ticket keys shared by the whole fleet.
+    Keys are pushed by the control plane with a `not_before` timestamp, every edge activates the same key at the
+    same time, so a ticket issued by one edge can be resumed on any other.
+    nginx encrypts with the first `ssl_session_ticket_key` and only decrypts with the others:
+        current.key   - active key.
+        next.key      - upcoming key, accepted early to absorb clock skew between edges.
+        previous.key  - last active key, keeps tickets issued before rotation valid.
+    """
+    current_key = "current.key"
+    next_key = "next.key"
+    previous_key = "previous.key"
+    state_file = "keys.json"
+    # ids of keys already activated, remembered so a resent key set is not activated again.
+    activated_size = 100
+
+    def __init__(self, store, reloader):
+        self.path: str = os.path.join(store.nginx_path, "ssl", "tickets")
+        self.reloader = reloader
+        self.finished = False
+        self.keys: List[Dict] = []
+        self.active: Optional[Dict] = None
+        self.previous: Optional[Dict] = None
+        self.activated: List[str] = []
+        self._changed = asyncio.Event()
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, mode=0o700)
+        self.load()
+
+    @classmethod
+    def key_paths(cls, path: str) -> List[str]:
+        # order matters, nginx uses the first key for encryption.
+        return [os.path.join(path, name) for name in [cls.current_key, cls.next_key, cls.previous_key]]
+
+    @classmethod
+    def bootstrap(cls, path: str, reconfigure: bool = False):
+        """ nginx refuses to start with missing key files, fill them with a random local key until the fleet key arrives. """
+        if not os.path.exists(path):
+            os.makedirs(path, mode=0o700)
+        key = os.urandom(80)
+        for key_path in cls.key_paths(path):
+            if not os.path.exists(key_path) or reconfigure:
+                write_atomic(key_path, key)
+
+    def load(self):
+        state_path = os.path.join(self.path, self.state_file)
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return
+        self.keys = state.get("keys", [])
+        self.active = state.get("active")
+        self.previous = state.get("previous")
+        self.activated = state.get("activated") or [item["id"] for item in (self.previous, self.active) if item]
+
+    def save(self):
+        state = {"keys": self.keys, "active": self.active, "previous": self.previous,
+                 "activated": self.activated[-self.activated_size:]}
+        write_atomic(os.path.join(self.path, self.state_file), json.dumps(state).encode())
+
+    def update(self, keys: List[Dict]):
+        """
+        merge keys received from the control plane, entries are {"id", "key" (base64), "not_before"}.
+        Keys queued or activated before and keys not newer than the active one are ignored,
+        the control plane resends its whole set and rotation only ever moves forward.
+        """
+        known = {item["id"] for item in self.keys} | set(self.activated)
+        for item in keys:
+            if item["id"] in known:
+                continue
+            if self.active and float(item["not_before"]) <= self.active["not_before"]:
+                continue
+            if len(base64.b64decode(item["key"])) not in TICKET_KEY_SIZES:
+                raise ValueError(f"Ticket key {item['id']} must be {TICKET_KEY_SIZES} bytes long.")
+            self.keys.append({"id": item["id"], "key": item["key"], "not_before": float(item["not_before"])})
+        self.keys.sort(key=lambda item: item["not_before"])
+        self.save()
+        self._changed.set()
+
+    def rotate(self, now: float) -> bool:
+        """ activate the latest key whose time has come, returns True when files were rewritten. """
+        rotated = False
+        while self.keys and self.keys[0]["not_before"] <= now:
+            if self.active:
+                self.previous = self.active
+            self.active = self.keys.pop(0)
+            self.activated.append(self.active["id"])
+            rotated = True
+        if rotated:
+            self.write()
+            self.save()
+        return rotated
+
+    def write(self):
+        active = base64.b64decode(self.active["key"])
+        upcoming = base64.b64decode(self.keys[0]["key"]) if self.keys else active
+        previous = base64.b64decode(self.previous["key"]) if self.previous else active
+        for key_path, key in zip(self.key_paths(self.path), [active, upcoming, previous]):
+            write_atomic(key_path, key)
+
+    def next_rotation(self) -> Optional[float]:
+        if self.keys:
+            return self.keys[0]["not_before"]
+
+    async def run(self):
+        try:
+            while not self.finished:
+                if self.rotate(time.time()):
+                    logger.info(f"{self}, rotated session ticket key to {self.active['id']}")
+                    self.reloader.request("session ticket key rotation")
+                self._changed.clear()
+                timeout = None
+                if (not_before := self.next_rotation()) is not None:
+                    timeout = max(not_before - time.time(), 0)
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            logger.info(f"session ticket rotation shutting down.")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__}>"
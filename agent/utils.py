@@ -0,0 +1,24 @@
+import os
+import tempfile
+
+
+def write_atomic(path: str, data: bytes, mode: int = 0o600):
+    """
+    write into a temporary sibling and rename, so readers (nginx, hooks) never see a half written file.
+    The sibling name is unique, writers in the executor and on the loop can replace the same file concurrently,
+    the last rename wins and none of them renames a file another one is still writing.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            os.fchmod(f.fileno(), mode)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,317 @@
+import os
+import re
+from typing import List, Tuple
+
+from .utils import write_atomic
+
+VHOST_MODES = ("domain", "shared")
+
+# domain: unbuffered `<domain>.log` per domain, one write per request and one descriptor per domain in every worker.
+# buffered: the same files written in `buffer=` sized chunks at least every `flush=`.
+# cached: `<domain>.log` opened by name per request, descriptors of busy files are kept by `open_log_file_cache`,
+#   idle domains hold none. nginx does not buffer logs with variables in the path.
+# shared: one buffered `agent-access.log` for every domain, `$host` as the first field.
+ACCESS_LOG_MODES = ("domain", "buffered", "cached", "shared")
+# nginx allocates the buffer per log file when it reads the config, in every worker: 8k * 10k domains is 80 MB.
+DOMAIN_LOG_BUFFER = "8k"
+SHARED_LOG_BUFFER = "64k"
+LOG_FLUSH = "5s"
+SHARED_ACCESS_LOG = "agent-access.log"
+
+# http level, included before the vhosts in conf.d.
+LOGGING_TEMPLATE = """
+    log_format agent_shared '$host $http_x_forwarded_for - $remote_user [$time_local] '
+                            '"$request_method $scheme://$host$request_uri $server_protocol" '
+                            '$status $body_bytes_sent "$http_referer" '
+                            '"$http_user_agent" $request_time';
+    open_log_file_cache max=1000 inactive=20s valid=1m min_uses=2;
+    """
+
+VHOST_TEMPLATE = """
+    server {{
+            listen 80;
+            server_name {domain} *.{domain};
+            access_log on;{access_log}
+            return 301 https://$host$request_uri;
+    }}
+    server {{
+            listen 443 ssl http2;
+            server_name {domain};
+            rewrite ^(.*) http://www.{domain}$1 permanent;
+            ssl_certificate {ssl_certificate};
+            ssl_certificate_key {ssl_certificate_key};{ssl_stapling}
+            include /etc/nginx/common/restricted.conf;
+    }}
+    server {{
+            listen 443 ssl http2;
+            server_name *.{domain};
+            ssl_certificate {ssl_certificate};
+            ssl_certificate_key {ssl_certificate_key};{ssl_stapling}
+            include /etc/nginx/common/restricted.conf;
+    }}
+    """
+
+STAPLING_TEMPLATE = """
+            ssl_stapling on;
+            ssl_stapling_file {ssl_stapling_file};"""
+
+# every managed domain in two server blocks, the certificate is picked per handshake from the SNI name.
+# per domain `error_log` and OCSP stapling files need fixed paths, in this mode errors go to the main error log
+# and stapling is off.
+# the servers are selected by the included server names, not as default_server: `sites-enabled/default` written
+# by install already is the default for 80 and 443 and keeps answering unknown names with 444.
+SHARED_VHOST_TEMPLATE = """
+    map $ssl_server_name $agent_certificate {{
+            hostnames;
+            default "";
+            include {certificates_map};
+    }}
+    map $host $agent_domain {{
+            hostnames;
+            default "";
+            include {certificates_map};
+    }}
+    map $host $agent_redirect {{
+            hostnames;
+            default "";
+            include {redirects_map};
+    }}
+    server {{
+            listen 80;
+            include {server_names};{access_log}
+            return 301 https://$host$request_uri;
+    }}
+    server {{
+            listen 443 ssl http2;
+            include {server_names};
+            ssl_certificate {live_path}/$agent_certificate/fullchain.pem;
+            ssl_certificate_key {live_path}/$agent_certificate/privkey.pem;{access_log}
+            if ($agent_redirect) {{
+                return 301 $agent_redirect$request_uri;
+            }}
+            include /etc/nginx/common/restricted.conf;
+    }}
+    """
+
+MAP_ENTRY_PATTERN = re.compile(r"^(\S+)\s+(\S+);$", re.M)
+
+
+def ocsp_response_path(letsencrypt_path: str, domain: str) -> str:
+    return os.path.join(letsencrypt_path, "ocsp", domain + ".der")
+
+
+def access_log_directives(log_name: str, mode: str = "domain") -> str:
+    """
+    access log of a server block in `mode`, `log_name` is the per domain file name, a literal domain or
+    a variable. Per domain `error_log` stays only where the file is open anyway.
+    """
+    if mode == "shared":
+        return f"""
+            access_log  /var/log/nginx/{SHARED_ACCESS_LOG} agent_shared buffer={SHARED_LOG_BUFFER} flush={LOG_FLUSH};"""
+    variable = "$" in log_name
+    if mode == "cached" and not variable:
+        # the primary server_name, the same file as the literal name but opened through the cache.
+        log_name = "$server_name"
+        variable = True
+    buffer = f" buffer={DOMAIN_LOG_BUFFER} flush={LOG_FLUSH}" if mode == "buffered" and not variable else ""
+    directives = f"""
+            access_log  /var/log/nginx/{log_name}.log main{buffer};"""
+    if not variable:
+        directives += f"""
+            error_log  /var/log/nginx/{log_name}.log;"""
+    return directives
+
+
+def logging_path(nginx_path: str) -> str:
+    return os.path.join(nginx_path, "conf.d", "00-nginx-agent-logging.conf")
+
+
+def write_logging(nginx_path: str, mode: str = "domain", variable: bool = False) -> bool:
+    """
+    `agent_shared` format and the log descriptor cache, kept once written, vhosts not yet re-rendered use them.
+    `variable`: a log path with variables is written, it needs the cache whatever the mode.
+    """
+    if mode == "domain" and not variable:
+        return False
+    return _write_if_changed(logging_path(nginx_path), LOGGING_TEMPLATE)
+
+
+def vhost_path(nginx_path: str, domain: str) -> str:
+    return os.path.join(nginx_path, "conf.d", domain + '.conf')
+
+
+def certificate_paths(domain: str, letsencrypt_path: str) -> Tuple[str, str]:
+    # this mean we obtain ssl key pair
+    ssl_certificate = os.path.join(letsencrypt_path, "live", domain, "fullchain.pem")
+    if not os.path.isfile(ssl_certificate):
+        raise ValueError(f"certificate:  {ssl_certificate} not exists for {domain}")
+
+    ssl_certificate_key = os.path.join(letsencrypt_path, "live", domain, "privkey.pem")
+    if not os.path.isfile(ssl_certificate_key):
+        raise ValueError(f"certificate key: {ssl_certificate_key} not exists for {domain}")
+    return ssl_certificate, ssl_certificate_key
+
+
+def render_vhost(domain: str, letsencrypt_path: str, access_log: str = "domain") -> str:
+    ssl_certificate, ssl_certificate_key = certificate_paths(domain, letsencrypt_path)
+
+    # nginx fails config test on a missing stapling file, stapling is enabled once the agent fetched a response.
+    ssl_stapling = ""
+    ssl_stapling_file = ocsp_response_path(letsencrypt_path, domain)
+    if os.path.isfile(ssl_stapling_file):
+        ssl_stapling = STAPLING_TEMPLATE.format(ssl_stapling_file=ssl_stapling_file)
+
+    return VHOST_TEMPLATE.format(
+        domain=domain,
+        ssl_certificate=ssl_certificate,
+        ssl_certificate_key=ssl_certificate_key,
+        ssl_stapling=ssl_stapling,
+        access_log=access_log_directives(domain, access_log),
+    )
+
+
+def _write_if_changed(path: str, text: str) -> bool:
+    if _read(path) == text:
+        return False
+    write_atomic(path, text.encode(), 0o644)
+    return True
+
+
+def write_vhost(nginx_path: str, letsencrypt_path: str, domain: str, access_log: str = "domain") -> bool:
+    """ render vhost config for domain, returns True when the file content changed. """
+    changed = write_logging(nginx_path, access_log)
+    changed |= _write_if_changed(vhost_path(nginx_path, domain), render_vhost(domain, letsencrypt_path, access_log))
+    return changed
+
+
+def shared_vhost_path(nginx_path: str) -> str:
+    return os.path.join(nginx_path, "conf.d", "00-nginx-agent-shared.conf")
+
+
+def shared_map_paths(nginx_path: str) -> Tuple[str, str]:
+    """ (certificates, redirects) map entries, included by the shared vhost. """
+    path = os.path.join(nginx_path, "nginx-agent")
+    return os.path.join(path, "certificates.map"), os.path.join(path, "redirects.map")
+
+
+def shared_server_names_path(nginx_path: str) -> str:
+    """ `server_name` directives of the shared vhost, one per domain. """
+    return os.path.join(nginx_path, "nginx-agent", "server_names.conf")
+
+
+def _server_names(domain: str) -> str:
+    return f"server_name {domain} *.{domain};\n"
+
+
+def _read(path: str) -> str:
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except IOError:
+        return ""
+
+
+def shared_domains(nginx_path: str) -> List[str]:
+    certificates_map, _ = shared_map_paths(nginx_path)
+    return [name for name, _ in MAP_ENTRY_PATTERN.findall(_read(certificates_map)) if not name.startswith("*.")]
+
+
+def _write_shared_server(nginx_path: str, letsencrypt_path: str, access_log: str = "domain") -> bool:
+    certificates_map, redirects_map = shared_map_paths(nginx_path)
+    # `$agent_domain` in the log path, without the cache nginx opens the file for every request.
+    changed = write_logging(nginx_path, access_log, variable=True)
+    changed |= _write_if_changed(shared_vhost_path(nginx_path), SHARED_VHOST_TEMPLATE.format(
+        certificates_map=certificates_map,
+        redirects_map=redirects_map,
+        server_names=shared_server_names_path(nginx_path),
+        live_path=os.path.join(letsencrypt_path, "live"),
+        access_log=access_log_directives("$agent_domain", access_log),
+    ))
+    return changed
+
+
+def write_shared_maps(nginx_path: str, letsencrypt_path: str, domains: List[str],
+                      access_log: str = "domain") -> bool:
+    """ rewrite the maps for exactly `domains`, without any domain the shared vhost is removed. """
+    certificates_map, redirects_map = shared_map_paths(nginx_path)
+    server_names = shared_server_names_path(nginx_path)
+    if not domains:
+        # nginx rejects a server without names, the shared vhost goes once the last domain left it.
+        paths = [path for path in (shared_vhost_path(nginx_path), certificates_map, redirects_map, server_names)
+                 if os.path.exists(path)]
+        for path in paths:
+            os.remove(path)
+        return bool(paths)
+    os.makedirs(os.path.dirname(certificates_map), exist_ok=True)
+    domains = sorted(set(domains))
+    changed = _write_if_changed(certificates_map, "".join(f"{domain} {domain};\n*.{domain} {domain};\n"
+                                                          for domain in domains))
+    # the apex redirects to www, like the first https server of the per domain vhost.
+    changed |= _write_if_changed(redirects_map, "".join(f"{domain} http://www.{domain};\n" for domain in domains))
+    changed |= _write_if_changed(server_names, "".join(_server_names(domain) for domain in domains))
+    changed |= _write_shared_server(nginx_path, letsencrypt_path, access_log)
+    return changed
+
+
+def write_shared_vhost(nginx_path: str, letsencrypt_path: str, domain: str, access_log: str = "domain") -> bool:
+    """ add domain to the shared vhost maps, a per domain vhost left from `domain` mode is removed. """
+    certificate_paths(domain, letsencrypt_path)
+    certificates_map, redirects_map = shared_map_paths(nginx_path)
+    server_names = shared_server_names_path(nginx_path)
+    changed = False
+    if os.path.exists(certificates_map) and not os.path.exists(server_names):
+        # maps written before the servers were selected by name.
+        write_atomic(server_names, "".join(_server_names(name) for name in shared_domains(nginx_path)).encode(), 0o644)
+        changed = True
+    certificates = _read(certificates_map)
+    # appended, map entries have no order and a deploy stays one scan of the map at 10k domains.
+    if f"\n{domain} {domain};\n" not in "\n" + certificates:
+        os.makedirs(os.path.dirname(certificates_map), exist_ok=True)
+        write_atomic(certificates_map, f"{certificates}{domain} {domain};\n*.{domain} {domain};\n".encode(), 0o644)
+        write_atomic(redirects_map, f"{_read(redirects_map)}{domain} http://www.{domain};\n".encode(), 0o644)
+        write_atomic(server_names, f"{_read(server_names)}{_server_names(domain)}".encode(), 0o644)
+        changed = True
+    changed |= _write_shared_server(nginx_path, letsencrypt_path, access_log)
+    config_path = vhost_path(nginx_path, domain)
+    if os.path.exists(config_path):
+        os.remove(config_path)
+        changed = True
+    return changed
+
+
+def deploy_vhost(nginx_path: str, letsencrypt_path: str, domain: str, mode: str = "domain",
+                 access_log: str = "domain") -> bool:
+    """
+    serve domain's certificate in the configured vhost mode with access logs in `access_log` mode,
+    returns True when nginx needs a reload.
+    """
+    if mode == "shared":
+        return write_shared_vhost(nginx_path, letsencrypt_path, domain, access_log)
+    changed = write_vhost(nginx_path, letsencrypt_path, domain, access_log)
+    domains = shared_domains(nginx_path)
+    if domain in domains:
+        domains.remove(domain)
+        changed |= write_shared_maps(nginx_path, letsencrypt_path, domains, access_log)
+    return changed
+
+
+def remove_vhost(nginx_path: str, letsencrypt_path: str, domains: List[str], access_log: str = "domain") -> bool:
+    """ stop serving domains in either vhost mode, certificates stay. Returns True when nginx needs a reload. """
+    changed = False
+    removed = set(domains)
+    for domain in removed:
+        config_path = vhost_path(nginx_path, domain)
+        if os.path.exists(config_path):
+            os.remove(config_path)
+            changed = True
+    shared = shared_domains(nginx_path)
+    remaining = [domain for domain in shared if domain not in removed]
+    if len(remaining) != len(shared):
+        changed |= write_shared_maps(nginx_path, letsencrypt_path, remaining, access_log)
+    return changed
+
+
+def is_deployed(nginx_path: str, domain: str, mode: str = "domain") -> bool:
+    if mode == "shared":
+        return domain in shared_domains(nginx_path)
+    return os.path.isfile(vhost_path(nginx_path, domain))
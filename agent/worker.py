@@ -1,12 +1,26 @@
 import asyncio
 import logging
 import os
-from typing import Dict, Tuple
+import time
+from typing import Dict, List, Optional, Tuple
 
-from models import Domain, PENDING, SUCCESS, FAILED
-from store import Store
+from .accounts import AccountCache
+from .bundle import BundleAssembler, install_bundle, read_bundle, verify_bundle
+from .idempotency import IdempotencyCache
+from .log import Payload
+from .metrics import COMMAND_DUPLICATES_TOTAL, ISSUANCE_STAGE_SECONDS, ISSUANCE_TOTAL
+from .models import Domain, PENDING, SUCCESS, FAILED
+from .ocsp import OcspStapler
+from .profiler import SamplingProfiler
+from .ratelimit import RateLimitLedger
+from .reloader import NginxReloader
+from .state import CertificateDigests, certificate_digest, plan, scan
+from .store import Store
+from .telemetry import TelemetrySampler
+from .tickets import TicketKeyManager
+from .vhost import deploy_vhost, is_deployed, remove_vhost
 
-logger = logging.getLogger('agent')
+logger = logging.getLogger('agent.worker')
 
 
 class Worker:
@@ -24,25 +38,70 @@ class Worker:
         self.dns_acme_clean = os.path.join(self.config_path, "dns_acme_clean.py")
         self.dns_acme_deploy = os.path.join(self.config_path, "dns_acme_deploy.py")
 
+        self.reloader = NginxReloader(store)
+        self.tickets = TicketKeyManager(store, self.reloader)
+        self.ocsp = OcspStapler(store, self.reloader)
+        self.telemetry = TelemetrySampler(store)
+        self.profiler = SamplingProfiler()
+        self.bundles = BundleAssembler()
+        self.accounts = AccountCache(store)
+        self.ratelimit = RateLimitLedger(self.config_path)
+        self.deferred: Dict[str, float] = {}
+        # domain -> time of the order recorded when it was admitted, until certbot runs for it.
+        self.reserved: Dict[str, float] = {}
+        self.idempotency = IdempotencyCache(store.idempotency_size, store.idempotency_ttl)
+        self.digests = CertificateDigests(self.config_path)
+        self.sync_lock = asyncio.Lock()
+        self.coordinator = None
+        if store.shared_redis_url:
+            from .lease import IssuanceCoordinator
+            self.coordinator = IssuanceCoordinator(store)
+
+    def hook(self, name: str) -> str:
+        """ certbot hook command, `<hook_command> <name>-hook` for installed or single file builds. """
+        if self.store.hook_command:
+            return f'"{self.store.hook_command} {name}-hook"'
+        return f"./dns_acme_{name}.py"
+
+    async def send_result(self, action: str, domain: Optional[str], event: Dict):
+        """ producer event answering an `action` command, kept as its outcome for retries of that command. """
+        message_id = self.idempotency.resolve(action, domain, event)
+        if message_id is not None:
+            event["message_id"] = message_id
+        await self.store.producer_queue.put(event)
+
     def get_or_create_domain(self, domain: str) -> Tuple[Domain, bool]:
         # we need create redis cache
         try:
             return self.store.get_cache(domain), False
         except ValueError as exc:
-            instance = Domain(domain)
+            instance = Domain(domain, nameservers=self.store.nameservers, port=self.store.dns_port)
             self.store.set_cache(domain, instance, instance.cache_time_out)
             return instance, True
 
+    def cached_domain(self, domain: str) -> Optional[Domain]:
+        """ the domain in issuance, None once periodical_check reported its result or timeout and dropped it. """
+        try:
+            return self.store.get_cache(domain)
+        except ValueError:
+            return None
+
     async def periodical_check(self, instance: Domain):
         try:
             domain: str = instance.domain
+            txt_set = propagated = False
             while instance.status in [PENDING]:
                 await asyncio.sleep(5)
                 # we need get fresh cache object
 
                 instance = self.store.get_cache(domain)
+                if not txt_set and instance.token_one and instance.token_two:
+                    txt_set = True
+                    ISSUANCE_STAGE_SECONDS.observe(time.time() - instance.start_time, stage="txt_set")
                 # now we need check dns propagation status
-                instance.check_acme()
+                if instance.check_acme() and not propagated:
+                    propagated = True
+                    ISSUANCE_STAGE_SECONDS.observe(instance.current_time - instance.start_time, stage="propagated")
 
                 if instance.continue_check:
                     acme_time = int(instance.current_time - instance.start_time)
@@ -51,7 +110,9 @@ class Worker:
                         instance.on_error = "Session and confirmation timeout."
 
                 self.store.set_cache(domain, instance, instance.cache_time_out)
-                await self.store.producer_queue.put(
+                await self.send_result(
+                    "add_domain",
+                    domain,
                     {
                         "consumer": "remote.vps.agent",
                         "type": "receive.json",
@@ -62,8 +123,11 @@ class Worker:
 
             # this mean domains challenge Error or Success
             # TODO add logic for this challenge
+            ISSUANCE_TOTAL.inc(status=instance.status)
             if instance.status == SUCCESS:
-                await self.store.producer_queue.put(
+                await self.send_result(
+                    "add_domain",
+                    domain,
                     {
                         "consumer": "remote.vps.agent",
                         "type": "receive.json",
@@ -74,7 +138,9 @@ class Worker:
                 )
                 self.store.cache.delete(domain)
             else:
-                await self.store.producer_queue.put(
+                await self.send_result(
+                    "add_domain",
+                    domain,
                     {
                         "consumer": "remote.vps.agent",
                         "type": "receive.json",
@@ -97,9 +163,9 @@ class Worker:
             f'--cert-name "{domain}"',
             '--manual',
             # f'--manual-auth-hook {self.dns_acme_auth}',
-            f'--manual-auth-hook ./dns_acme_auth.py',
+            f'--manual-auth-hook {self.hook("auth")}',
             # f'--deploy-hook {self.dns_acme_deploy}',
-            f'--deploy-hook ./dns_acme_deploy.py',
+            f'--deploy-hook {self.hook("deploy")}',
             '--force-renewal',
             '--preferred-challenges=dns',
             '--register-unsafely-without-email',
@@ -112,41 +178,344 @@ class Worker:
         ]
 
         shell_command = " ".join(command)
+        # usually registered since add_domain arrived, the auth hook then only reads it.
+        try:
+            await self.accounts.ensure(domain)
+        except Exception as exc:
+            logger.warning(f"{self}, {domain}: acme-dns registration failed, left to the auth hook: {exc}")
+        ISSUANCE_STAGE_SECONDS.observe(time.time() - instance.start_time, stage="queued")
 
-        process = await asyncio.create_subprocess_shell(shell_command,
-                                                        stdout=asyncio.subprocess.PIPE,
-                                                        stderr=asyncio.subprocess.PIPE
-                                                        )
+        try:
+            process = await asyncio.create_subprocess_shell(shell_command,
+                                                            stdout=asyncio.subprocess.PIPE,
+                                                            stderr=asyncio.subprocess.PIPE,
+                                                            env={**os.environ, **self.store.hook_environ()},
+                                                            )
+        except Exception:
+            self.release_order(domain)
+            raise
+        # the order is placed, its reservation stays counted.
+        self.reserved.pop(domain, None)
         # if success process.returncode = 0
         # if error process.returncode = 1
         stdout, stderr = await process.communicate()
 
-        instance: Domain = self.store.get_cache(domain)
-
+        instance = self.cached_domain(domain)
+        if instance is None:
+            logger.warning(f"{self}, {domain}: certbot exited {process.returncode} after the issuance timed out.")
+            if process.returncode != 0:
+                self.ratelimit.record_failure(domain, time.time(), stderr.decode())
+            return
         instance.on_success = stdout.decode().replace("\n", " ").strip()
         instance.on_error = stderr.decode().replace("\n", " ").strip()
 
-        logger.debug(f"process.communicate: {process.returncode} {instance.serialize()}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("process.communicate: %s %s", process.returncode, Payload(instance.serialize()))
         if process.returncode == 0:
             instance.status = SUCCESS
+            ISSUANCE_STAGE_SECONDS.observe(time.time() - instance.start_time, stage="issued")
+            # deploy hook runs inside certbot, a rendered vhost means the certificate is served.
+            if is_deployed(self.store.nginx_path, domain, self.store.vhost_mode):
+                ISSUANCE_STAGE_SECONDS.observe(time.time() - instance.start_time, stage="deployed")
         else:
             instance.status = FAILED
+            self.ratelimit.record_failure(domain, time.time(), instance.on_error)
+        self.store.set_cache(domain, instance, instance.cache_time_out)
+
+    async def coordinated_issue(self, instance: Domain):
+        """ issue here when this node gets the fleet-wide lease, otherwise install what the lease holder issued. """
+        domain: str = instance.domain
+        try:
+            while True:
+                bundle = await self.coordinator.bundle(domain)
+                if bundle is not None:
+                    # issued by another node, this one never orders.
+                    self.release_order(domain)
+                    await self.install_shared_bundle(domain, bundle)
+                    return
+                failure = await self.coordinator.failure(domain)
+                if failure is not None:
+                    self.coordinated_failed(
+                        domain, f"{failure['node']} failed, backing off {failure['backoff']}s: {failure['error']}")
+                    return
+                if self.cached_domain(domain) is None:
+                    # reported or timed out while waiting, nothing would install what this node issues.
+                    self.release_order(domain)
+                    return
+                token = await self.coordinator.acquire(domain)
+                if token is None:
+                    await self.coordinator.wait(domain, self.coordinator.lease_ttl)
+                    continue
+                keep = asyncio.create_task(self.coordinator.keep(domain, token))
+                try:
+                    await self.letsencrypt_fork(instance)
+                finally:
+                    keep.cancel()
+                instance = self.cached_domain(domain)
+                if instance is None:
+                    # the next waiting node takes over.
+                    await self.coordinator.release(domain, token)
+                elif instance.status == SUCCESS:
+                    await self.coordinator.publish(domain, token, read_bundle(self.letsencrypt_path, domain))
+                else:
+                    await self.coordinator.fail(domain, token, str(instance.on_error or instance.status))
+                return
+        except Exception as exc:
+            logger.exception(exc)
+            self.coordinated_failed(domain, str(exc))
+
+    def coordinated_failed(self, domain: str, error: str):
+        self.release_order(domain)
+        instance = self.cached_domain(domain)
+        if instance is None:
+            return
+        instance.status = FAILED
+        instance.on_error = f"coordinated issuance: {error}"
+        self.store.set_cache(domain, instance, instance.cache_time_out)
+
+    def release_order(self, domain: str):
+        """ give back the rate limit reservation of an admitted domain that ends without an ACME order. """
+        at = self.reserved.pop(domain, None)
+        if at is not None:
+            self.ratelimit.release(domain, at)
+
+    async def deploy_bundle(self, domain: str, files: Dict[str, bytes], source: str):
+        """ certificate issued elsewhere, served after the next batched reload. """
+        await verify_bundle(files)
+        install_bundle(self.store.nginx_path, self.letsencrypt_path, domain, files,
+                       self.store.vhost_mode, self.store.access_log_mode)
+        self.reloader.request(f"{domain} certificate from {source}")
+        asyncio.create_task(self.ocsp.refresh(domain))
+
+    async def install_shared_bundle(self, domain: str, bundle: Dict):
+        await self.deploy_bundle(domain, bundle["files"], bundle["node"])
+
+        instance = self.cached_domain(domain)
+        if instance is None:
+            return
+        instance.status = SUCCESS
+        instance.on_success = f"installed certificate issued by {bundle['node']}"
+        ISSUANCE_STAGE_SECONDS.observe(time.time() - instance.start_time, stage="deployed")
         self.store.set_cache(domain, instance, instance.cache_time_out)
 
+    async def rate_limited(self, payload: Dict, limit: str, wait: float):
+        """ defer the order until the limit allows it, or reject it right away when that is too far out. """
+        domain = payload.get("domain").strip()
+        deferred = wait <= self.store.ratelimit_max_defer
+        if deferred and domain not in self.deferred:
+            self.deferred[domain] = time.time() + wait
+            asyncio.create_task(self.deferred_add_domain(payload, wait))
+        logger.info(f"{self}, {domain}: {limit} limit, {'deferred' if deferred else 'rejected'} for {wait:.0f}s")
+        await self.send_result(
+            "add_domain",
+            domain,
+            {
+                "consumer": "remote.vps.agent",
+                "type": "receive.json",
+                "action": "acme_rate_limited",
+                "error": [f"Let's Encrypt {limit} limit, retry after {wait:.0f}s."],
+                "message": {"domain": domain, "limit": limit, "retry_after": int(wait) + 1, "deferred": deferred},
+            }
+        )
+
+    async def deferred_add_domain(self, payload: Dict, wait: float):
+        await asyncio.sleep(wait)
+        self.deferred.pop(payload.get("domain").strip(), None)
+        await self.action_add_domain(payload)
+
+    async def action_add_domain(self, payload: Dict):
+        domain = payload.get("domain").strip()
+        now = time.time()
+        limited = self.ratelimit.check(domain, now)
+        if limited is not None:
+            await self.rate_limited(payload, *limited)
+            return
+        instance, is_created = self.get_or_create_domain(domain)
+        if is_created:
+            # reserved together with the check, no await in between, a burst of add_domain sees every
+            # order admitted before it, not only the ones certbot already started.
+            self.ratelimit.record(domain, now)
+            self.reserved[domain] = now
+            if self.coordinator is not None:
+                asyncio.create_task(self.coordinated_issue(instance))
+            else:
+                asyncio.create_task(self.letsencrypt_fork(instance))
+            asyncio.create_task(self.periodical_check(instance))
+
+    async def action_install_bundle(self, payload: Dict):
+        domain = payload.get("domain").strip()
+        try:
+            files = self.bundles.add(payload)
+            if files is None:
+                return
+            await self.deploy_bundle(domain, files, "gateway")
+            error = []
+        except Exception as exc:
+            logger.warning(f"{self}, install_bundle {domain}: {exc}")
+            error = [str(exc)]
+        await self.send_result(
+            "install_bundle",
+            domain,
+            {
+                "consumer": "remote.vps.agent",
+                "type": "receive.json",
+                "action": "install_bundle",
+                "error": error,
+                "message": {"domain": domain, "transfer_id": payload.get("transfer_id")},
+            }
+        )
+
+    def apply_sync(self, actions: Dict[str, List[str]]) -> Tuple[bool, List[str]]:
+        """ render and remove vhosts of a sync plan, runs in the executor. Returns (reload needed, errors). """
+        changed, errors = False, []
+        for domain in actions["deploy"]:
+            try:
+                changed |= deploy_vhost(self.store.nginx_path, self.letsencrypt_path, domain,
+                                        self.store.vhost_mode, self.store.access_log_mode)
+            except (IOError, ValueError) as exc:
+                errors.append(f"{domain}: {exc}")
+        if actions["prune"]:
+            changed |= remove_vhost(self.store.nginx_path, self.letsencrypt_path, actions["prune"],
+                                    self.store.access_log_mode)
+        return changed, errors
+
+    async def install_expected(self, manifest: Dict[str, Optional[str]], domains: List[str]) -> List[str]:
+        """
+        install the shared bundle of every domain whose certificate differs from the manifest when the bundle is
+        the expected one, returns the domains installed. Without shared coordination the control plane has to
+        push them with install_bundle.
+        """
+        installed = []
+        if self.coordinator is None:
+            return installed
+        for domain in domains:
+            try:
+                bundle = await self.coordinator.bundle(domain)
+                if bundle is None or certificate_digest(bundle["files"]["cert.pem"]) != manifest[domain]:
+                    continue
+                await self.deploy_bundle(domain, bundle["files"], bundle["node"])
+                installed.append(domain)
+            except Exception as exc:
+                logger.warning(f"{self}, sync_state {domain}: shared bundle not installed: {exc}")
+        return installed
+
+    async def action_sync_state(self, payload: Dict):
+        """
+        reconcile with the control plane manifest `{"domains": {domain: digest or null}, "prune": bool}`,
+        only differing domains are touched and everything applied goes into one validated reload.
+        At most `sync_issue_limit` domains are ordered per sync, the next sync continues with the rest.
+        The reply carries the digests the manifest did not have yet and the ones that differ from it.
+        """
+        async with self.sync_lock:
+            start = time.monotonic()
+            manifest = {domain.strip(): digest for domain, digest in payload.get("domains", {}).items()}
+            loop = asyncio.get_event_loop()
+            state = await loop.run_in_executor(None, scan, self.store.nginx_path, self.letsencrypt_path,
+                                               self.digests, self.store.vhost_mode)
+            actions = plan(manifest, state, time.time(), self.store.sync_renew_before, bool(payload.get("prune")))
+            changed, errors = await loop.run_in_executor(None, self.apply_sync, actions)
+            if changed:
+                self.reloader.request(f"sync_state, {len(actions['deploy'])} deployed, "
+                                      f"{len(actions['prune'])} pruned")
+            installed = await self.install_expected(manifest, actions["mismatch"])
+            mismatched = [domain for domain in actions["mismatch"] if domain not in installed]
+            issuing = actions["issue"][:self.store.sync_issue_limit]
+            for domain in issuing:
+                await self.action_add_domain({"domain": domain})
+            logger.info(f"{self}, sync_state of {len(manifest)} domains: {len(actions['unchanged'])} unchanged, "
+                        f"{len(actions['deploy'])} deployed, {len(installed)} installed, "
+                        f"{len(mismatched)} mismatched, {len(issuing)} of {len(actions['issue'])} issuing, "
+                        f"{len(actions['prune'])} pruned in {time.monotonic() - start:.2f}s")
+            await self.send_result(
+                "sync_state",
+                None,
+                {
+                    "consumer": "remote.vps.agent",
+                    "type": "receive.json",
+                    "action": "sync_state",
+                    "error": errors,
+                    "message": {
+                        "unchanged": len(actions["unchanged"]),
+                        "deployed": actions["deploy"],
+                        "issuing": issuing,
+                        "issue_postponed": len(actions["issue"]) - len(issuing),
+                        "installed": installed,
+                        "mismatched": {domain: state[domain]["digest"] for domain in mismatched},
+                        "pruned": actions["prune"],
+                        "digests": {domain: state[domain]["digest"] for domain in actions["deploy"]},
+                        "seconds": round(time.monotonic() - start, 3),
+                    },
+                }
+            )
+
+    async def action_ticket_keys(self, payload: Dict):
+        # rotation itself happens in TicketKeyManager.run at each key `not_before`.
+        self.tickets.update(payload.get("keys", []))
+
+    async def action_profile(self, payload: Dict):
+        # runs next to the task queue, the profile has to see the agent doing its normal work.
+        asyncio.create_task(self.profile(payload.get("seconds", 5), payload.get("top", 20)))
+
+    async def profile(self, seconds: float, top: int):
+        try:
+            message = await self.profiler.profile(seconds, top)
+            error = []
+        except Exception as exc:
+            logger.exception(exc)
+            message, error = {}, [str(exc)]
+        await self.send_result(
+            "profile",
+            None,
+            {
+                "consumer": "remote.vps.agent",
+                "type": "receive.json",
+                "action": "profile_result",
+                "error": error,
+                "message": message,
+            }
+        )
+
+    async def replay(self, message_id: str, entry: Dict):
+        """ a command seen before, answered with its last result, or as accepted while it has none yet. """
+        COMMAND_DUPLICATES_TOTAL.inc(action=entry["action"])
+        event = entry["event"]
+        if event is None:
+            event = {
+                "consumer": "remote.vps.agent",
+                "type": "receive.json",
+                "action": "accepted",
+                "error": [],
+                "message": {"action": entry["action"], "domain": entry["domain"]},
+            }
+        await self.store.producer_queue.put({**event, "message_id": message_id, "duplicate": True})
+
     async def dispatch(self, message: Dict):
+        message_id = None
         try:
             payload = message["content"]["payload"]
             action = message["content"]["action"]
-            if action == "add_domain":
-                domain = payload.get("domain").strip()
-                instance, is_created = self.get_or_create_domain(domain)
-                if is_created:
-                    asyncio.create_task(self.letsencrypt_fork(instance))
-                    asyncio.create_task(self.periodical_check(instance))
-            logger.debug(f"{self}, dispatch {message}")
+            # use dispatch pattern to invoke method with same name
+            handler = getattr(self, "action_" + action, None)
+            if handler is None:
+                logger.warning(f"{self}, unrecognized action {action}")
+                return
+            # control plane retries carry the message_id of the first attempt.
+            message_id = message["content"].get("message_id")
+            if message_id is not None:
+                entry = self.idempotency.get(message_id)
+                if entry is not None:
+                    logger.info(f"{self}, {action} {message_id} already handled, replaying its result.")
+                    await self.replay(message_id, entry)
+                    return
+                domain = payload.get("domain")
+                self.idempotency.start(message_id, action, domain.strip() if domain else None)
+            await handler(payload)
+            logger.debug("%s, dispatch %s", self, Payload(message))
 
         except Exception as exc:
             logger.exception(exc)
+            if message_id is not None:
+                self.idempotency.forget(message_id)
 
     def __repr__(self):
         return f"<{self.__class__.__name__}>"
@@ -164,7 +533,11 @@ class Worker:
 
         except asyncio.CancelledError:
             self.finished = True
-            await self.store.receive_queue.put(None)
+            try:
+                self.store.receive_queue.put_nowait(None)
+            except asyncio.QueueFull:
+                # nobody reads it any more, waiting for room would hang the shutdown.
+                pass
             logger.info(f"incoming queue shutting down.")
 
     async def cache(self):
@@ -176,7 +549,9 @@ class Worker:
                         {
                             "action": 'heartbeat',
                             "data": {
-                                "is_active": True
+                                "is_active": True,
+                                "telemetry": await self.telemetry.heartbeat(),
+                                "producer_dropped": dict(self.store.producer_queue.dropped),
                             },
                         }
                     )
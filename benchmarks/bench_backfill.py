@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Backfill parser throughput on a generated `main` format fixture.
+
+    $ ./benchmarks/bench_backfill.py --lines 10000000 --files 8
+"""
+import argparse
+import gzip
+import os
+import random
+import sys
+import tempfile
+import time
+
+WORK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WORK_DIR)
+
+from agent.logstats import backfill, backfill_file  # noqa: E402
+
+LINE = ('{ip} - - [{day:02d}/Oct/2026:{hour:02d}:{minute:02d}:{second:02d} +0000] '
+        '"GET https://{host}/api/v1/items?page={page} HTTP/1.1" {status} {size} '
+        '"https://{host}/" "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36" {request_time:.3f}\n')
+STATUSES = [200] * 16 + [301, 304, 404, 499, 502]
+
+
+def generate(path: str, lines: int, hosts: int, compress: bool):
+    rnd = random.Random(path)
+    opener = gzip.open if compress else open
+    with opener(path, 'wt') as f:
+        batch = []
+        for number in range(lines):
+            batch.append(LINE.format(
+                ip=f"10.0.{rnd.randrange(256)}.{rnd.randrange(256)}",
+                day=1 + number * 7 // lines, hour=rnd.randrange(24), minute=rnd.randrange(60),
+                second=rnd.randrange(60), host=f"www.host{rnd.randrange(hosts)}.com", page=rnd.randrange(100),
+                status=rnd.choice(STATUSES), size=rnd.randrange(100000), request_time=rnd.expovariate(20),
+            ))
+            if len(batch) == 10000:
+                f.write(''.join(batch))
+                batch = []
+        f.write(''.join(batch))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, default=10_000_000)
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--hosts', type=int, default=500)
+    parser.add_argument('--gzip', action='store_true', default=False, help='gzip every other fixture file')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--fixture-dir', help='reuse fixture files, generated when missing')
+    args = parser.parse_args()
+
+    fixture_dir = args.fixture_dir or tempfile.mkdtemp(prefix='nginx-agent-backfill-')
+    os.makedirs(fixture_dir, exist_ok=True)
+    paths = []
+    for index in range(args.files):
+        compress = args.gzip and index % 2 == 1
+        path = os.path.join(fixture_dir, f"access.log.{index}" + (".gz" if compress else ""))
+        if not os.path.exists(path):
+            start = time.perf_counter()
+            generate(path, args.lines // args.files, args.hosts, compress)
+            print(f"generated {path} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+        paths.append(path)
+
+    start = time.perf_counter()
+    aggregator, size, lines = backfill_file(paths[0])
+    elapsed = time.perf_counter() - start
+    print(f"single file: {lines} lines in {elapsed:.2f}s, {lines / elapsed:.0f} lines/sec")
+
+    start = time.perf_counter()
+    aggregator, size, lines = backfill(paths, workers=args.workers)
+    elapsed = time.perf_counter() - start
+    print(f"pool: {lines} lines, {size / 1024 / 1024:.0f} MiB, {len(aggregator.hosts)} hosts in "
+          f"{elapsed:.2f}s, {lines / elapsed:.0f} lines/sec")
+
+    start = time.perf_counter()
+    aggregator, size, lines = backfill(paths, workers=args.workers, host="www.host1.com", since=0)
+    elapsed = time.perf_counter() - start
+    print(f"pool, host and time filter: {aggregator.lines} of {lines} lines in {elapsed:.2f}s, "
+          f"{lines / elapsed:.0f} lines/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Bytes on the wire and CPU per message for every gateway codec and permessage-deflate setting, on a replayed
+agent session: acme_pending every 5s per domain, heartbeats with telemetry and log_stats.
+Deflate is applied the way websockets does it, one compressor per connection with context takeover.
+
+    $ ./benchmarks/bench_codec.py --domains 20 --rounds 24
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import zlib
+
+WORK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WORK_DIR)
+
+from agent.codec import CODECS  # noqa: E402
+
+DEFLATE_SETTINGS = [
+    ("none", None, None),
+    ("level 1, window 15", 1, 15),
+    ("level 6, window 15", 6, 15),
+    ("level 9, window 15", 9, 15),
+    ("level 6, window 12", 6, 12),
+    ("level 6, window 9", 6, 9),
+]
+
+
+def session(domains: int, rounds: int):
+    rnd = random.Random(0)
+    start = 1760000000.0
+    accounts = [{"username": f"{rnd.getrandbits(128):032x}", "password": f"{rnd.getrandbits(160):040x}",
+                 "fulldomain": f"{rnd.getrandbits(128):032x}.auth.acme-dns.io",
+                 "subdomain": f"{rnd.getrandbits(128):032x}", "allowfrom": []} for _ in range(domains)]
+    tokens = [f"{rnd.getrandbits(256):064x}"[:43] for _ in range(domains)]
+    messages = []
+    for step in range(rounds):
+        now = start + step * 5
+        for number in range(domains):
+            messages.append({
+                "consumer": "remote.vps.agent", "type": "receive.json", "action": "acme_pending",
+                "message": {
+                    "domain": f"www.shop{number}.example.com", "status": "pending",
+                    "account": accounts[number], "token_one": tokens[number], "token_two": None,
+                    "on_error": None, "on_success": None, "start_time": start, "current_time": now,
+                    "continue_time_out": 60, "continue_check": step > 2,
+                },
+            })
+        if step % 6 == 0:
+            messages.append({"action": "heartbeat", "data": {"telemetry": {
+                "load1": rnd.random(), "cpu_user": rnd.randrange(500), "cpu_idle": rnd.randrange(5000),
+                "mem_available": rnd.randrange(1 << 31), "agent_rss": 40000000 + rnd.randrange(1 << 20),
+                "nginx_active": rnd.randrange(300), "nginx_requests": rnd.randrange(10000),
+            }}})
+        if step % 12 == 0:
+            messages.append({
+                "consumer": "remote.vps.agent", "type": "receive.json", "action": "log_stats",
+                "message": {"hosts": {f"www.shop{number}.example.com": {
+                    "requests": rnd.randrange(100000), "bytes": rnd.randrange(1 << 32),
+                    "status": {"2xx": rnd.randrange(90000), "3xx": rnd.randrange(5000), "4xx": rnd.randrange(500),
+                               "5xx": rnd.randrange(50)},
+                    "request_time": {"p50": rnd.random() / 10, "p95": rnd.random(), "p99": rnd.random() * 2},
+                } for number in range(domains)}},
+            })
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--domains', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=24)
+    args = parser.parse_args()
+
+    messages = session(args.domains, args.rounds)
+    print(f"{len(messages)} messages")
+    print(f"{'codec':8} {'deflate':20} {'bytes':>10} {'B/msg':>8} {'encode us':>10} {'deflate us':>10} "
+          f"{'decode us':>10}")
+    for name, cls in CODECS.items():
+        if not cls.available():
+            print(f"{name:8} not installed")
+            continue
+        codec = cls()
+        start = time.perf_counter()
+        frames = [codec.encode(message) for message in messages]
+        encode = (time.perf_counter() - start) / len(messages)
+        start = time.perf_counter()
+        for frame in frames:
+            codec.decode(frame)
+        decode = (time.perf_counter() - start) / len(messages)
+        payloads = [frame.encode() if isinstance(frame, str) else frame for frame in frames]
+        for label, level, window_bits in DEFLATE_SETTINGS:
+            start = time.perf_counter()
+            if level is None:
+                size = sum(len(payload) for payload in payloads)
+            else:
+                compressor = zlib.compressobj(level, zlib.DEFLATED, -window_bits)
+                # each frame is sync flushed and loses its trailing empty block, as in RFC 7692.
+                size = sum(len(compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+                           for payload in payloads)
+            deflate = (time.perf_counter() - start) / len(messages)
+            print(f"{name:8} {label:20} {size:10} {size / len(messages):8.0f} {encode * 1e6:10.1f} "
+                  f"{deflate * 1e6:10.1f} {decode * 1e6:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Event loop side cost of agent logging per call, for the gateway's `send_json` debug line with a realistic payload:
+
+    sync      the former setup, f-string and a StreamHandler writing in the caller, agent at DEBUG
+    disabled  queue handler, agent at INFO, the lazily formatted debug line is skipped
+    queued    queue handler, agent at DEBUG, bounded payload repr in the caller, writes in the listener thread
+
+    $ ./benchmarks/bench_logging.py --calls 20000 [--output /dev/stderr]
+"""
+import argparse
+import logging
+import logging.config
+import os
+import sys
+import tempfile
+import time
+
+WORK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WORK_DIR)
+
+from agent import log  # noqa: E402
+
+EVENT = {
+    "consumer": "remote.vps.agent",
+    "type": "receive.json",
+    "action": "log_stats",
+    "seq": 1,
+    "error": [],
+    "message": {"period": 60.0, "lines": 120000, "skipped_bytes": 0, "hosts": {
+        f"bench{number}.test": {"requests": 240, "status": {"2xx": 230, "3xx": 10}, "bytes": 1048576,
+                                "p50": 0.012, "p99": 0.25} for number in range(500)}},
+}
+
+
+def setup(mode: str, output: str):
+    config = dict(log.LOGGING_CONFIG)
+    config["handlers"] = {"console": {"class": "logging.FileHandler", "filename": output,
+                                      "formatter": "main_formatter"}}
+    logging.config.dictConfig(config)
+    if mode == "sync":
+        logging.getLogger('agent').setLevel(logging.DEBUG)
+        return None
+    return log.configure(debug=mode == "queued")
+
+
+def run(mode: str, calls: int, output: str) -> dict:
+    setup(mode, output)
+    logger = logging.getLogger('agent.gw')
+    agent = "<GateWayAgent>"
+    start = time.perf_counter()
+    if mode == "sync":
+        for _ in range(calls):
+            logger.debug(f"{agent}, send_json {EVENT}")
+    else:
+        for _ in range(calls):
+            logger.debug("%s, send_json %s", agent, log.Payload(EVENT))
+    caller = time.perf_counter() - start
+    log.shutdown()
+    total = time.perf_counter() - start
+    return {"mode": mode, "calls": calls, "caller_us_per_call": round(caller / calls * 1e6, 2),
+            "total_seconds": round(total, 3), "bytes_written": os.path.getsize(output)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=20_000)
+    parser.add_argument('--output', help='log destination, default: a temporary file per mode')
+    args = parser.parse_args()
+
+    for mode in ("sync", "disabled", "queued"):
+        with tempfile.NamedTemporaryFile(prefix=f"bench-logging-{mode}-") as f:
+            print(run(mode, args.calls, args.output or f.name), flush=True)
+
+
+if __name__ == "__main__":
+    main()
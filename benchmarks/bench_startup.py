@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Interpreter start up time of the agent entry points, median wall time of --runs fresh processes.
+Hooks are measured up to the point where they would start talking to acme-dns and redis.
+
+    $ ./benchmarks/bench_startup.py --runs 20 [--pyz dist/nginx-agent.pyz]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+WORK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(command, runs: int) -> float:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=WORK_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--pyz', help='also measure a single file build')
+    args = parser.parse_args()
+
+    python = sys.executable
+    cases = [
+        ("python baseline", [python, "-c", "pass"]),
+        ("run --help", [python, "nginx-agent.py", "run", "--help"]),
+        ("install --help", [python, "nginx-agent.py", "install", "--help"]),
+        ("auth hook", [python, "-c", "from agent.hooks.auth import main"]),
+        ("deploy hook", [python, "-c", "from agent.hooks.deploy import main"]),
+        ("clean hook", [python, "-c", "from agent.hooks.clean import main"]),
+    ]
+    if args.pyz:
+        cases += [
+            ("pyz run --help", [python, args.pyz, "run", "--help"]),
+            ("pyz clean-hook", [python, args.pyz, "clean-hook"]),
+        ]
+    baseline = None
+    for name, command in cases:
+        median = measure(command, args.runs)
+        baseline = median if baseline is None else baseline
+        print(f"{name:20} {median * 1000:8.1f} ms  (+{(median - baseline) * 1000:.1f} ms over python)")
+
+
+if __name__ == "__main__":
+    main()
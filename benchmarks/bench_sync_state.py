@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+sync_state reconciliation time at synthetic domain counts: local scan with a cold and a warm certificate digest
+cache, the diff against a manifest, and the apply step after some vhosts were deleted.
+
+    $ ./benchmarks/bench_sync_state.py --domains 10000 [--drift 100]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+WORK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WORK_DIR)
+
+from agent.state import CertificateDigests, plan, scan  # noqa: E402
+from agent.vhost import deploy_vhost, vhost_path  # noqa: E402
+
+
+def prepare(prefix: str, domains, mode: str):
+    nginx_path, letsencrypt_path = os.path.join(prefix, "nginx"), os.path.join(prefix, "letsencrypt")
+    os.makedirs(os.path.join(nginx_path, "conf.d"))
+    source = os.path.join(prefix, "source")
+    os.makedirs(source)
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "90",
+                           "-subj", "/CN=bench.test", "-keyout", os.path.join(source, "privkey.pem"),
+                           "-out", os.path.join(source, "cert.pem")], stderr=subprocess.DEVNULL)
+    for domain in domains:
+        live = os.path.join(letsencrypt_path, "live", domain)
+        os.makedirs(live)
+        shutil.copyfile(os.path.join(source, "cert.pem"), os.path.join(live, "cert.pem"))
+        shutil.copyfile(os.path.join(source, "cert.pem"), os.path.join(live, "fullchain.pem"))
+        shutil.copyfile(os.path.join(source, "privkey.pem"), os.path.join(live, "privkey.pem"))
+        deploy_vhost(nginx_path, letsencrypt_path, domain, mode)
+    return nginx_path, letsencrypt_path
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, round(time.perf_counter() - start, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--domains', type=int, default=10000)
+    parser.add_argument('--drift', type=int, default=100, help='vhosts deleted before the second sync')
+    parser.add_argument('--vhost-mode', choices=['domain', 'shared'], default='domain')
+    args = parser.parse_args()
+
+    prefix = tempfile.mkdtemp(prefix="nginx-agent-sync-")
+    try:
+        domains = [f"bench{number}.test" for number in range(args.domains)]
+        nginx_path, letsencrypt_path = prepare(prefix, domains, args.vhost_mode)
+        config_path = os.path.join(prefix, "config")
+        os.makedirs(config_path)
+        result = {"domains": args.domains, "vhost_mode": args.vhost_mode}
+
+        digests = CertificateDigests(config_path)
+        state, result["scan_cold_seconds"] = timed(scan, nginx_path, letsencrypt_path, digests, args.vhost_mode)
+        manifest = {domain: local["digest"] for domain, local in state.items()}
+        state, result["scan_warm_seconds"] = timed(scan, nginx_path, letsencrypt_path, digests, args.vhost_mode)
+        # a restarted agent, digests from sync-cache.json.
+        state, result["scan_restarted_seconds"] = timed(scan, nginx_path, letsencrypt_path,
+                                                        CertificateDigests(config_path), args.vhost_mode)
+        actions, result["plan_seconds"] = timed(plan, manifest, state, time.time(), 30 * 24 * 60 * 60)
+        result["unchanged"] = len(actions["unchanged"])
+
+        if args.vhost_mode == "domain":
+            for domain in random.Random(0).sample(domains, min(args.drift, len(domains))):
+                os.remove(vhost_path(nginx_path, domain))
+            start = time.perf_counter()
+            state = scan(nginx_path, letsencrypt_path, digests, args.vhost_mode)
+            actions = plan(manifest, state, time.time(), 30 * 24 * 60 * 60)
+            for domain in actions["deploy"]:
+                deploy_vhost(nginx_path, letsencrypt_path, domain, args.vhost_mode)
+            result["drift_sync_seconds"] = round(time.perf_counter() - start, 3)
+            result["redeployed"] = len(actions["deploy"])
+        print(json.dumps(result))
+    finally:
+        shutil.rmtree(prefix, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
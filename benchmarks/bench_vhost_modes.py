@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+`domain` vs `shared` vhost mode at synthetic domain counts: render time, config size, `nginx -t` time,
+reload time, worker RSS after start and reload, and TLS handshake latency (the shared mode loads the
+certificate during the handshake).
+nginx runs unprivileged from a temporary prefix, listen ports are moved above 1024.
+
+    $ ./benchmarks/bench_vhost_modes.py --domains 1000 10000 [--nginx /usr/sbin/nginx] [--handshakes 200]
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+WORK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WORK_DIR)
+
+from agent.vhost import deploy_vhost  # noqa: E402
+
+HTTP_PORT, HTTPS_PORT = 18080, 18443
+
+NGINX_CONF = """
+worker_processes {workers};
+pid {prefix}/nginx.pid;
+error_log {prefix}/logs/error.log;
+events {{
+    worker_connections 1024;
+}}
+http {{
+    log_format main '$remote_addr [$time_local] "$request_method $scheme://$host$request_uri" $status';
+    server_names_hash_bucket_size 256;
+    server_names_hash_max_size 65536;
+    map_hash_bucket_size 256;
+    map_hash_max_size 65536;
+    include {prefix}/conf.d/*.conf;
+}}
+"""
+
+
+def certificate(path: str):
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "30",
+                           "-subj", "/CN=bench.test", "-keyout", os.path.join(path, "privkey.pem"),
+                           "-out", os.path.join(path, "fullchain.pem")], stderr=subprocess.DEVNULL)
+
+
+def prepare(prefix: str, domains, mode: str) -> float:
+    """ render every domain in `mode`, returns render seconds. """
+    letsencrypt_path = os.path.join(prefix, "letsencrypt")
+    for path in ("conf.d", "logs", "common"):
+        os.makedirs(os.path.join(prefix, path), exist_ok=True)
+    open(os.path.join(prefix, "common", "restricted.conf"), 'w').close()
+    source = os.path.join(prefix, "source")
+    if not os.path.isdir(source):
+        os.makedirs(source)
+        certificate(source)
+    for domain in domains:
+        live = os.path.join(letsencrypt_path, "live", domain)
+        if not os.path.isdir(live):
+            os.makedirs(live)
+            # copies, each domain is its own file for nginx to read.
+            for name in ("fullchain.pem", "privkey.pem"):
+                shutil.copyfile(os.path.join(source, name), os.path.join(live, name))
+
+    start = time.perf_counter()
+    for domain in domains:
+        deploy_vhost(prefix, letsencrypt_path, domain, mode)
+    elapsed = time.perf_counter() - start
+
+    for name in os.listdir(os.path.join(prefix, "conf.d")):
+        path = os.path.join(prefix, "conf.d", name)
+        with open(path, 'r') as f:
+            text = f.read()
+        text = (text.replace("/etc/nginx/common/", os.path.join(prefix, "common") + "/")
+                .replace("/var/log/nginx/", os.path.join(prefix, "logs") + "/")
+                .replace("listen 80", f"listen {HTTP_PORT}").replace("listen 443", f"listen {HTTPS_PORT}"))
+        with open(path, 'w') as f:
+            f.write(text)
+    return elapsed
+
+
+def config_bytes(prefix: str) -> int:
+    total = 0
+    for root, _, files in os.walk(prefix):
+        if "letsencrypt" in root or "source" in root or "logs" in root:
+            continue
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files if name.endswith((".conf", ".map")))
+    return total
+
+
+def workers(prefix: str):
+    with open(os.path.join(prefix, "nginx.pid")) as f:
+        master = int(f.read().strip())
+    with open(f"/proc/{master}/task/{master}/children") as f:
+        return master, [int(pid) for pid in f.read().split()]
+
+
+def rss(pids) -> int:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                total += next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS"))
+        except (IOError, StopIteration):
+            pass
+    return total
+
+
+def handshakes(domains, count: int):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    timings = []
+    for number in range(count):
+        domain = domains[number * 7919 % len(domains)]
+        start = time.perf_counter()
+        with socket.create_connection(("127.0.0.1", HTTPS_PORT)) as sock:
+            with context.wrap_socket(sock, server_hostname=f"www.{domain}"):
+                pass
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {"p50_ms": round(statistics.median(timings) * 1000, 2),
+            "p99_ms": round(timings[int(len(timings) * 0.99) - 1] * 1000, 2)}
+
+
+def run_nginx(nginx: str, prefix: str, domains, args) -> dict:
+    conf = os.path.join(prefix, "nginx.conf")
+    with open(conf, 'w') as f:
+        f.write(NGINX_CONF.format(prefix=prefix, workers=args.workers))
+    command = [nginx, "-p", prefix, "-c", conf]
+    result = {}
+
+    start = time.perf_counter()
+    test = subprocess.run(command + ["-t"], capture_output=True, text=True)
+    result["test_seconds"] = round(time.perf_counter() - start, 3)
+    if test.returncode != 0:
+        result["error"] = test.stderr.strip().splitlines()[-1]
+        return result
+
+    subprocess.check_call(command)
+    try:
+        deadline = time.monotonic() + 120
+        while time.monotonic() < deadline:
+            try:
+                master, pids = workers(prefix)
+                if len(pids) >= args.workers:
+                    break
+            except (IOError, ValueError):
+                pass
+            time.sleep(0.05)
+        result["worker_rss_bytes"] = rss(pids)
+        result["master_rss_bytes"] = rss([master])
+        if args.handshakes:
+            result["handshake"] = handshakes(domains, args.handshakes)
+
+        start = time.perf_counter()
+        os.kill(master, signal.SIGHUP)
+        while True:
+            _, new_pids = workers(prefix)
+            if len(new_pids) >= args.workers and not set(new_pids) & set(pids):
+                break
+            time.sleep(0.01)
+        result["reload_seconds"] = round(time.perf_counter() - start, 3)
+        result["worker_rss_after_reload_bytes"] = rss(new_pids)
+    finally:
+        subprocess.run(command + ["-s", "stop"], capture_output=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--domains', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--nginx', default=shutil.which("nginx") or "/usr/sbin/nginx")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--handshakes', type=int, default=200)
+    parser.add_argument('--keep', action='store_true', help='keep the generated prefixes')
+    args = parser.parse_args()
+
+    nginx = args.nginx if os.access(args.nginx, os.X_OK) else None
+    if nginx is None:
+        print(f"nginx not found at {args.nginx}, reporting render time and config size only.", file=sys.stderr)
+
+    for count in args.domains:
+        domains = [f"bench{number}.test" for number in range(count)]
+        for mode in ("domain", "shared"):
+            prefix = tempfile.mkdtemp(prefix=f"nginx-agent-vhost-{mode}-{count}-")
+            try:
+                result = {"domains": count, "mode": mode}
+                result["render_seconds"] = round(prepare(prefix, domains, mode), 3)
+                result["config_bytes"] = config_bytes(prefix)
+                if nginx:
+                    result.update(run_nginx(nginx, prefix, domains, args))
+                print(json.dumps(result), flush=True)
+            finally:
+                if not args.keep:
+                    shutil.rmtree(prefix, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+End to end load harness, everything the agent talks to is replaced by a local stub:
+
+    control plane   websocket server sending N concurrent `add_domain` commands
+    letsencrypt     fake binary on PATH, runs the real `dns_acme_auth.py` hook twice per certificate
+    acme-dns        HTTP api stub, /register and /update
+    DNS             UDP server answering `_acme-challenge.*` TXT with every token posted to acme-dns
+    redis           local `redis-server`, or fakeredis TcpFakeServer when the binary is missing
+
+The agent runs unmodified as `nginx-agent.py run` in a subprocess. Results go to a JSON file, pass the file of
+a previous version with --compare to see regressions.
+
+    $ ./benchmarks/harness.py --domains 50 --output results.json --compare previous.json
+
+Agent logging overhead shows in cpu_seconds, log_bytes and loop lag, compare a run with `-- --debug` to one without.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import secrets
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+import dns.message
+import dns.rdatatype
+import dns.rrset
+import websockets
+
+WORK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WORK_DIR)
+
+from agent.version import version  # noqa: E402
+
+FAKE_LETSENCRYPT = """#!{python}
+import os
+import secrets
+import subprocess
+import sys
+
+args = sys.argv[1:]
+hook = args[args.index('--manual-auth-hook') + 1]
+domains = [args[index + 1] for index, arg in enumerate(args) if arg == '-d']
+for domain in domains:
+    environ = dict(os.environ, CERTBOT_DOMAIN=domain, CERTBOT_VALIDATION=secrets.token_urlsafe(32))
+    if subprocess.call([sys.executable, hook], env=environ, stdout=subprocess.DEVNULL) != 0:
+        sys.exit(1)
+print("Congratulations! Your certificate and chain have been saved.")
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    values = sorted(values)
+    if not values:
+        return {"p50": None, "p90": None, "p99": None, "max": None}
+
+    def rank(q):
+        return round(values[min(int(math.ceil(q * len(values))) - 1, len(values) - 1)], 3)
+
+    return {"p50": rank(0.5), "p90": rank(0.9), "p99": rank(0.99), "max": round(values[-1], 3)}
+
+
+class AcmeDnsStub:
+    def __init__(self):
+        self.accounts: Dict[str, Dict] = {}
+        self.txt: Dict[str, List[str]] = {}
+
+    def tokens(self) -> List[str]:
+        return [token for tokens in self.txt.values() for token in tokens]
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            request_line, *header_lines = head.decode().split("\r\n")
+            headers = {key.lower(): value.strip() for key, _, value in
+                       (line.partition(":") for line in header_lines if line)}
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            path = request_line.split()[1]
+            if path == "/register":
+                subdomain = secrets.token_hex(8)
+                account = {"username": secrets.token_hex(8), "password": secrets.token_hex(16),
+                           "fulldomain": f"{subdomain}.auth.test", "subdomain": subdomain, "allowfrom": []}
+                self.accounts[subdomain] = account
+                status, response = "201 Created", account
+            elif path == "/update":
+                update = json.loads(body)
+                # acme-dns keeps the two latest records per subdomain, one per certbot validation.
+                self.txt[update["subdomain"]] = (self.txt.get(update["subdomain"], []) + [update["txt"]])[-2:]
+                status, response = "200 OK", {"txt": update["txt"]}
+            else:
+                status, response = "404 Not Found", {}
+            data = json.dumps(response).encode()
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+class DnsStub(asyncio.DatagramProtocol):
+    def __init__(self, acme_dns: AcmeDnsStub):
+        self.acme_dns = acme_dns
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        query = dns.message.from_wire(data)
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        tokens = self.acme_dns.tokens()
+        if question.rdtype == dns.rdatatype.TXT and question.name.to_text().startswith("_acme-challenge.") and tokens:
+            response.answer.append(dns.rrset.from_text_list(question.name, 1, 'IN', 'TXT',
+                                                            [f'"{token}"' for token in tokens]))
+        self.transport.sendto(response.to_wire(max_size=65535), addr)
+
+
+class ControlPlane:
+    """
+    sends every add_domain once, the first time the agent connects, and times the acme results.
+    With `retry` a finished add_domain is sent again with the same message_id, the agent has to answer it
+    from its idempotency cache instead of issuing again.
+    """
+
+    def __init__(self, domains: List[str], retry: bool = False):
+        self.domains = domains
+        self.retry = retry
+        self.duplicates: Dict[str, str] = {}
+        self.sent_at: Dict[str, float] = {}
+        self.finished_at: Dict[str, float] = {}
+        self.status: Dict[str, str] = {}
+        self.received = 0
+        self.received_bytes = 0
+        self.connects = 0
+        self.done = asyncio.Event()
+
+    async def handler(self, websocket, path=None):
+        self.connects += 1
+        if not self.sent_at:
+            for domain in self.domains:
+                self.sent_at[domain] = time.monotonic()
+                await websocket.send(json.dumps(self.add_domain(domain)))
+        async for message in websocket:
+            self.received += 1
+            self.received_bytes += len(message)
+            event = json.loads(message)
+            action = event.get("action", "")
+            if action in ("acme_success", "acme_failed"):
+                domain = event["message"]["domain"]
+                if event.get("duplicate"):
+                    self.duplicates[domain] = action[len("acme_"):]
+                elif domain not in self.finished_at:
+                    self.finished_at[domain] = time.monotonic()
+                    self.status[domain] = action[len("acme_"):]
+                    if self.retry:
+                        await websocket.send(json.dumps(self.add_domain(domain)))
+                if len(self.finished_at) == len(self.domains) and (
+                        not self.retry or len(self.duplicates) == len(self.domains)):
+                    self.done.set()
+
+    @staticmethod
+    def add_domain(domain: str) -> Dict:
+        return {"content": {"action": "add_domain", "message_id": f"add_domain:{domain}",
+                            "payload": {"domain": domain}}}
+
+
+class RedisServer:
+    def __init__(self, port: int):
+        self.port = port
+        self.process = None
+        self.server = None
+
+    def start(self) -> str:
+        binary = shutil.which("redis-server")
+        if binary:
+            self.process = subprocess.Popen([binary, "--port", str(self.port), "--save", "", "--appendonly", "no"],
+                                            stdout=subprocess.DEVNULL)
+        else:
+            from fakeredis import TcpFakeServer
+            self.server = TcpFakeServer(("127.0.0.1", self.port), server_type="redis")
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        for _ in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        return f"redis://127.0.0.1:{self.port}/0"
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            self.process.wait()
+        if self.server:
+            self.server.shutdown()
+
+
+async def scrape(port: int) -> str:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /metrics HTTP/1.0\r\n\r\n")
+    response = await reader.read()
+    writer.close()
+    return response.decode().partition("\r\n\r\n")[2]
+
+
+def histogram_quantiles(text: str, name: str) -> Dict[str, Optional[float]]:
+    """ upper bucket bound of p50/p99 from a Prometheus histogram without labels. """
+    buckets, count, total = [], 0, 0.0
+    for line in text.splitlines():
+        if line.startswith(f"{name}_bucket"):
+            le = line.split('le="')[1].split('"')[0]
+            buckets.append((math.inf if le == "+Inf" else float(le), float(line.split()[-1])))
+        elif line.startswith(f"{name}_count"):
+            count = float(line.split()[-1])
+        elif line.startswith(f"{name}_sum"):
+            total = float(line.split()[-1])
+    result = {"mean": round(total / count, 6) if count else None}
+    for q in (0.5, 0.99):
+        result[f"p{int(q * 100)}"] = next((bound for bound, cumulative in buckets if cumulative >= q * count), None)
+    return result
+
+
+def peak_rss(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        return None
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    """ user + system time of a running process. """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rpartition(")")[2].split()
+        return round((int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK"), 3)
+    except (IOError, ValueError):
+        return None
+
+
+async def run(args) -> Dict:
+    workdir = tempfile.mkdtemp(prefix="nginx-agent-harness-")
+    bin_path = os.path.join(workdir, "bin")
+    for path in ["bin", "nginx", "letsencrypt", "config", "log"]:
+        os.makedirs(os.path.join(workdir, path), exist_ok=True)
+    letsencrypt = os.path.join(bin_path, "letsencrypt")
+    with open(letsencrypt, "w") as f:
+        f.write(FAKE_LETSENCRYPT.format(python=sys.executable))
+    os.chmod(letsencrypt, 0o755)
+
+    acme_dns = AcmeDnsStub()
+    acme_dns_port, dns_port, ws_port, metrics_port = free_port(), free_port(), free_port(), free_port()
+    acme_dns_server = await asyncio.start_server(acme_dns.handle, "127.0.0.1", acme_dns_port)
+    dns_transport, _ = await asyncio.get_event_loop().create_datagram_endpoint(
+        lambda: DnsStub(acme_dns), local_addr=("127.0.0.1", dns_port))
+    domains = [f"bench{index}.test" for index in range(args.domains)]
+    control_plane = ControlPlane(domains, args.retry)
+    ws_server = await websockets.serve(control_plane.handler, "127.0.0.1", ws_port, max_size=None)
+    redis_server = RedisServer(free_port())
+    redis_url = redis_server.start()
+
+    command = [sys.executable, os.path.join(WORK_DIR, "nginx-agent.py"), "run",
+               "--connect_url", f"ws://127.0.0.1:{ws_port}", "--connect_token", "harness",
+               "--redis-url", redis_url, "--nameserver", "127.0.0.1", "--dns-port", str(dns_port),
+               "--acme-dns-url", f"http://127.0.0.1:{acme_dns_port}",
+               "--nginx-path", os.path.join(workdir, "nginx"),
+               "--letsencrypt-path", os.path.join(workdir, "letsencrypt"),
+               "--config-path", os.path.join(workdir, "config"),
+               "--log-path", os.path.join(workdir, "log"),
+               "--nginx-binary", shutil.which("true"),
+               "--metrics-port", str(metrics_port)] + args.agent_args
+    environ = dict(os.environ, PATH=bin_path + os.pathsep + os.environ.get("PATH", ""))
+    agent_log = open(os.path.join(workdir, "agent.log"), "wb")
+    started = time.monotonic()
+    agent = subprocess.Popen(command, cwd=WORK_DIR, env=environ, stdout=agent_log, stderr=subprocess.STDOUT)
+    timed_out = False
+    try:
+        await asyncio.wait_for(control_plane.done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+    elapsed = time.monotonic() - started
+    metrics = ""
+    try:
+        metrics = await scrape(metrics_port)
+    except OSError:
+        pass
+    rss = peak_rss(agent.pid)
+    cpu = cpu_seconds(agent.pid)
+    agent.send_signal(signal.SIGTERM)
+    try:
+        agent.wait(10)
+    except subprocess.TimeoutExpired:
+        agent.kill()
+    agent_log.close()
+    ws_server.close()
+    acme_dns_server.close()
+    dns_transport.close()
+    redis_server.stop()
+
+    with open(agent_log.name, "rb") as f:
+        log_lines = sum(1 for _ in f)
+    durations = [control_plane.finished_at[domain] - control_plane.sent_at[domain]
+                 for domain in control_plane.finished_at]
+    return {
+        "version": version,
+        "timestamp": time.time(),
+        "domains": args.domains,
+        "succeeded": sum(1 for status in control_plane.status.values() if status == "success"),
+        "failed": sum(1 for status in control_plane.status.values() if status == "failed"),
+        "timed_out": timed_out,
+        "duration": round(elapsed, 3),
+        "time_to_success": percentiles(durations),
+        "messages_received": control_plane.received,
+        "messages_per_sec": round(control_plane.received / elapsed, 2),
+        "bytes_received": control_plane.received_bytes,
+        "reconnects": max(control_plane.connects - 1, 0),
+        "duplicates_answered": len(control_plane.duplicates),
+        "peak_rss_bytes": rss,
+        "cpu_seconds": cpu,
+        "log_lines": log_lines,
+        "log_bytes": os.path.getsize(agent_log.name),
+        "loop_lag_seconds": histogram_quantiles(metrics, "agent_loop_lag_seconds"),
+        "agent_log": agent_log.name,
+    }
+
+
+def compare(current: Dict, previous: Dict):
+    rows = [
+        ("time_to_success p50", current["time_to_success"]["p50"], previous["time_to_success"]["p50"]),
+        ("time_to_success p99", current["time_to_success"]["p99"], previous["time_to_success"]["p99"]),
+        ("messages_per_sec", current["messages_per_sec"], previous["messages_per_sec"]),
+        ("peak_rss_bytes", current["peak_rss_bytes"], previous["peak_rss_bytes"]),
+        ("cpu_seconds", current.get("cpu_seconds"), previous.get("cpu_seconds")),
+        ("log_bytes", current.get("log_bytes"), previous.get("log_bytes")),
+        ("loop_lag p99", current["loop_lag_seconds"]["p99"], previous["loop_lag_seconds"]["p99"]),
+    ]
+    print(f"{'':24}{previous['version']:>16}{current['version']:>16}{'change':>10}")
+    for name, value, old in rows:
+        change = f"{(value - old) / old * 100:+.1f}%" if value is not None and old else "-"
+        print(f"{name:24}{str(old):>16}{str(value):>16}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--domains', type=int, default=20, help='concurrent add_domain commands')
+    parser.add_argument('--timeout', type=float, default=15 * 60)
+    parser.add_argument('--output', default='harness-results.json')
+    parser.add_argument('--compare', help='results of a previous run')
+    parser.add_argument('--retry', action='store_true', help='send every finished add_domain again, same message_id')
+    parser.add_argument('agent_args', nargs=argparse.REMAINDER, help='extra `nginx-agent.py run` arguments')
+    args = parser.parse_args()
+    if args.agent_args[:1] == ["--"]:
+        args.agent_args = args.agent_args[1:]
+
+    results = asyncio.run(run(args))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
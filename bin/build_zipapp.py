@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Single file build of the agent, `dist/nginx-agent.pyz`, with the same commands as nginx-agent.py plus the
+certbot hooks:
+
+    $ python3 bin/build_zipapp.py --deps websockets redis dnspython
+    $ ./dist/nginx-agent.pyz run --hook-command ./dist/nginx-agent.pyz --connect_url ... --connect_token ...
+
+Pure python dependencies can be bundled with --deps, packages with C extensions have to be installed system wide.
+tldextract is always bundled, the agent does not start without it.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipapp
+
+WORK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runtime dependencies the agent refuses to run without.
+REQUIRED_DEPS = ['tldextract']
+
+MAIN = """from agent.__main__ import main
+
+main()
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default=os.path.join(WORK_DIR, 'dist', 'nginx-agent.pyz'))
+    parser.add_argument('--deps', nargs='*', default=[], help='packages bundled into the archive')
+    parser.add_argument('--interpreter', default='/usr/bin/env python3')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as staging:
+        shutil.copytree(os.path.join(WORK_DIR, 'agent'), os.path.join(staging, 'agent'),
+                        ignore=shutil.ignore_patterns('__pycache__', '*.pyc'))
+        with open(os.path.join(staging, '__main__.py'), 'w') as f:
+            f.write(MAIN)
+        deps = REQUIRED_DEPS + [dep for dep in args.deps if dep not in REQUIRED_DEPS]
+        subprocess.check_call([sys.executable, '-m', 'pip', 'install', '--quiet', '--no-compile',
+                               '--target', staging] + deps)
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        zipapp.create_archive(staging, args.output, interpreter=args.interpreter, compressed=True)
+    print(f"{args.output}: {os.path.getsize(args.output) / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
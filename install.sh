@@ -6,7 +6,7 @@ sudo apt update && apt install -y git python3.8 python3.8-dev python3.8-venv &&
 sudo locale-gen en_US.UTF-8
 #sudo update-alternatives --install /usr/bin/python3 python3 /usr/bin/python3.8 2
 #sudo python3.8 -m easy_install pip
-sudo apt install -y nginx letsencrypt redis-server && pipenv install --deploy --system
+sudo apt install -y nginx letsencrypt redis-server && pipenv install --deploy --system && python3.8 -m pip install .
 
 mkdir -p /etc/nginx-agent/
 
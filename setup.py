@@ -3,11 +3,27 @@ import setuptools
 setuptools.setup(
     name="nginx-agent",  # Replace with your own username
     version="0.0.1",
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(include=["agent", "agent.*"]),
+    entry_points={
+        "console_scripts": [
+            "nginx-agent=agent.__main__:main",
+        ],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
     python_requires='>=3.8',
+    install_requires=[
+        # redis.asyncio with `aclose`, used by the shared issuance coordinator.
+        "redis>=5.0.1",
+        "websockets",
+        "dnspython",
+        # binary gateway codecs, without them only json is negotiated.
+        "msgpack",
+        "orjson",
+        # registered domains for the rate limit ledger, there is no fallback.
+        "tldextract",
+    ],
 )
@@ -0,0 +1,33 @@
+import asyncio
+
+import fakeredis
+import pytest
+import redis
+
+from agent.store import Store
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(redis.Redis, "from_url", lambda url: fakeredis.FakeRedis())
+    paths = {name: str(tmp_path / name) for name in ("nginx", "letsencrypt", "config")}
+    for path in paths.values():
+        (tmp_path / path).mkdir()
+    return Store(
+        connect_url="ws://gateway.test", connect_token="token", nginx_path=paths["nginx"],
+        letsencrypt_path=paths["letsencrypt"], config_path=paths["config"],
+    )
+
+
+@pytest.fixture
+def worker(store, monkeypatch):
+    from agent.worker import Worker
+
+    async def idle(*args, **kwargs):
+        pass
+
+    worker = Worker(asyncio.new_event_loop(), store)
+    # no certbot and no DNS polling, only what the handlers decide.
+    monkeypatch.setattr(worker, "letsencrypt_fork", idle)
+    monkeypatch.setattr(worker, "periodical_check", idle)
+    return worker
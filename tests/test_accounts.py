@@ -0,0 +1,39 @@
+import asyncio
+import json
+import os
+
+from agent.accounts import AccountCache, AccountStore
+
+
+def account(name: str):
+    return {"subdomain": name, "fulldomain": f"{name}.auth.test", "username": "user", "password": "secret"}
+
+
+def test_legacy_json_accounts_are_imported_once(store):
+    with open(os.path.join(store.letsencrypt_path, "one.test.json"), 'w') as f:
+        json.dump({"one.test": account("one"), "two.test": {"unrelated": True}}, f)
+    with open(os.path.join(store.letsencrypt_path, "broken.json"), 'w') as f:
+        f.write("{")
+
+    cache = AccountCache(store)
+    assert cache.cache == {"one.test": account("one")}
+    assert AccountStore(store.accounts_path).import_legacy(store.letsencrypt_path) == []
+
+
+def test_concurrent_requests_register_one_account(store, monkeypatch):
+    cache, registrations = AccountCache(store), []
+
+    def register(allow_from):
+        registrations.append(allow_from)
+        return account(f"sub{len(registrations)}")
+
+    monkeypatch.setattr(cache.client, "register_account", register)
+
+    async def run():
+        cache.prefetch("one.test")
+        return await asyncio.gather(cache.ensure("one.test"), cache.ensure("*.one.test"))
+
+    assert asyncio.run(run()) == [account("sub1")] * 2
+    assert len(registrations) == 1
+    # the auth hook reads what the agent registered.
+    assert AccountStore(store.accounts_path).get("*.one.test") == account("sub1")
@@ -0,0 +1,53 @@
+import base64
+import hashlib
+import json
+import os
+
+import pytest
+
+from agent.bundle import BUNDLE_FILES, BundleAssembler, read_bundle, write_bundle
+
+
+def files(serial: str):
+    return {name: f"{serial} {name}" for name in BUNDLE_FILES}
+
+
+def chunked(transfer_id: str, data: bytes, size: int, sha256: str = None):
+    parts = [data[offset:offset + size] for offset in range(0, len(data), size)]
+    return [{"transfer_id": transfer_id, "chunk": number, "chunks": len(parts),
+             "data": base64.b64encode(part).decode(), "sha256": sha256 if number == 0 else None}
+            for number, part in enumerate(parts)]
+
+
+def test_chunks_in_any_order_assemble_the_bundle():
+    data = json.dumps({"files": files("one")}).encode()
+    chunks = chunked("t-1", data, 16, hashlib.sha256(data).hexdigest())
+    assembler = BundleAssembler()
+    assert all(assembler.add(chunk) is None for chunk in reversed(chunks[1:]))
+    assert assembler.add(chunks[0]) == {name: content.encode() for name, content in files("one").items()}
+    assert assembler.transfers == {}
+
+
+def test_checksum_mismatch_and_oversized_transfers_are_rejected():
+    data = json.dumps({"files": files("one")}).encode()
+    assembler = BundleAssembler()
+    with pytest.raises(ValueError):
+        for chunk in chunked("t-1", data, 16, hashlib.sha256(b"other").hexdigest()):
+            assembler.add(chunk)
+
+    assembler.max_size = 32
+    with pytest.raises(ValueError):
+        for chunk in chunked("t-2", data, 16):
+            assembler.add(chunk)
+    assert assembler.transfers == {}
+
+
+def test_written_bundle_is_served_from_live_links(tmp_path):
+    letsencrypt_path = str(tmp_path)
+    for serial in ("one", "two"):
+        write_bundle(letsencrypt_path, "one.test", {name: content.encode() for name, content in files(serial).items()})
+
+    assert read_bundle(letsencrypt_path, "one.test")["cert.pem"] == b"two cert.pem"
+    link = os.path.join(letsencrypt_path, "live", "one.test", "privkey.pem")
+    assert os.readlink(link) == "../../archive/one.test/privkey2.pem"
+    assert os.stat(link).st_mode & 0o777 == 0o600
@@ -0,0 +1,11 @@
+from agent.cli import _parse_datetime
+
+
+def test_parse_datetime_defaults_to_utc():
+    assert _parse_datetime("2026-01-01") == 1767225600
+    assert _parse_datetime("2026-01-01T00:00:00") == 1767225600
+
+
+def test_parse_datetime_keeps_explicit_offset():
+    assert _parse_datetime("2026-01-01T00:00:00+02:00") == 1767225600 - 2 * 60 * 60
+    assert _parse_datetime("2026-01-01T00:00:00+00:00") == 1767225600
@@ -0,0 +1,70 @@
+import asyncio
+import json
+
+import pytest
+import websockets
+
+from agent.codec import CODECS, JsonCodec, MsgpackCodec, negotiated_codec, offered_codecs
+from agent.gw import GateWayAgent
+from agent.logstats import LogAggregator, QuantileSketch
+
+
+def log_stats_event():
+    aggregator = LogAggregator()
+    aggregator.feed(b"".join(
+        f'1.2.3.4 - - [01/Jan/2026:00:00:00 +0000] "GET https://one.test/ HTTP/1.1" {status} 10 "-" "curl" '
+        f'{request_time}\n'.encode()
+        for status, request_time in ((200, "0.000"), (200, "0.012"), (404, "0.300"), (502, "1.500"))))
+    return {"consumer": "remote.vps.agent", "type": "receive.json", "action": "log_stats",
+            "message": {"period": 60.0, "lines": aggregator.lines, "skipped_bytes": 0,
+                        "hosts": aggregator.serialize()}}
+
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_log_stats_round_trip(name):
+    codec_class = CODECS[name]
+    if not codec_class.available():
+        pytest.skip(f"{name} not installed")
+    codec = codec_class()
+    event = log_stats_event()
+    decoded = codec.decode(codec.encode(event))
+    assert decoded == json.loads(json.dumps(event))
+    sketch = QuantileSketch.deserialize(decoded["message"]["hosts"]["one.test"]["request_time"])
+    assert sketch.count == 4
+
+
+def test_codecs_fall_back_to_json(monkeypatch):
+    monkeypatch.setattr(MsgpackCodec, "available", classmethod(lambda cls: False))
+    offered = offered_codecs(("msgpack", "orjson"))
+    assert [codec.name for codec in offered][-1] == "json"
+    assert "msgpack" not in [codec.name for codec in offered]
+    # a gateway that picks no subprotocol, or one we did not offer, gets JSON.
+    assert isinstance(negotiated_codec(offered, None), JsonCodec)
+    assert isinstance(negotiated_codec(offered, "nginx-agent.msgpack"), JsonCodec)
+    with pytest.raises(ValueError):
+        offered_codecs(("cbor",))
+
+
+@pytest.mark.parametrize("no_compression", [False, True])
+def test_gateway_negotiates_codec_and_deflate(store, no_compression):
+    store.no_compression = no_compression
+    store.compression_window_bits = 12
+    agent = GateWayAgent(store)
+
+    async def handler(websocket):
+        await websocket.wait_closed()
+
+    async def connect():
+        async with websockets.serve(handler, "127.0.0.1", 0, subprotocols=["nginx-agent.json"]) as server:
+            port = server.sockets[0].getsockname()[1]
+            async with websockets.connect(f"ws://127.0.0.1:{port}", compression=None, extensions=agent.extensions,
+                                          subprotocols=[codec.subprotocol for codec in agent.codecs]) as websocket:
+                return websocket.subprotocol, [extension.name for extension in websocket.extensions], \
+                    [extension.remote_max_window_bits for extension in websocket.extensions]
+
+    subprotocol, extensions, window_bits = asyncio.run(connect())
+    assert isinstance(negotiated_codec(agent.codecs, subprotocol), JsonCodec)
+    if no_compression:
+        assert extensions == []
+    else:
+        assert extensions == ["permessage-deflate"] and window_bits == [12]
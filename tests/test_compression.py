@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+import agent.compression
+from agent.compression import CompressionProfile, pick_level, precompress
+
+
+def detect(monkeypatch, modules: str, **kwargs):
+    monkeypatch.setattr(agent.compression, "nginx_modules", lambda binary, path: modules)
+    return CompressionProfile.detect("nginx", "/etc/nginx", **kwargs)
+
+
+def test_render_without_modules_is_plain_gzip(monkeypatch):
+    rendered = detect(monkeypatch, "", gzip_level=4).render()
+    assert "gzip_comp_level 4;" in rendered
+    assert "text/html" not in rendered
+    assert "gzip_static" not in rendered and "brotli" not in rendered
+
+
+def test_render_with_brotli_and_static_modules(monkeypatch):
+    modules = "--with-http_gzip_static_module --add-module=ngx_brotli"
+    rendered = detect(monkeypatch, modules, brotli_level=6).render()
+    for line in ("gzip_static on;", "brotli on;", "brotli_comp_level 6;", "brotli_static on;"):
+        assert line in rendered
+    assert "brotli" not in detect(monkeypatch, modules, brotli="off").render()
+
+
+def test_brotli_on_without_module_stops_install(monkeypatch):
+    with pytest.raises(ValueError):
+        detect(monkeypatch, "--with-http_gzip_static_module", brotli="on")
+
+
+def test_pick_level_prefers_the_cheapest_level_near_the_best_ratio():
+    levels = [{"level": 1, "ratio": 0.30, "mb_per_second": 200}, {"level": 5, "ratio": 0.25, "mb_per_second": 60},
+              {"level": 6, "ratio": 0.248, "mb_per_second": 40}, {"level": 9, "ratio": 0.24, "mb_per_second": 5}]
+    assert pick_level(levels) == 5
+
+
+def test_precompress_writes_each_variant_once(tmp_path):
+    with open(tmp_path / "app.js", 'wb') as f:
+        f.write(b"function a() { return 1; }\n" * 200)
+    with open(tmp_path / "photo.jpg", 'wb') as f:
+        f.write(os.urandom(1024))
+
+    assert precompress(str(tmp_path)) == 1
+    assert os.path.exists(tmp_path / "app.js.gz")
+    assert precompress(str(tmp_path)) == 0
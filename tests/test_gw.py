@@ -0,0 +1,21 @@
+import random
+
+from agent.gw import Backoff
+
+
+def test_backoff_stays_within_base_and_cap():
+    random.seed(1)
+    backoff = Backoff(base=1, cap=60)
+    delays = [backoff.next() for _ in range(200)]
+    assert all(1 <= delay <= 60 for delay in delays)
+    assert max(delays) == 60
+    # each delay grows at most threefold.
+    assert all(later <= earlier * 3 for earlier, later in zip(delays, delays[1:]))
+
+
+def test_backoff_reset_starts_over():
+    backoff = Backoff(base=2, cap=30)
+    for _ in range(50):
+        backoff.next()
+    backoff.reset()
+    assert 2 <= backoff.next() <= 6
@@ -0,0 +1,45 @@
+import asyncio
+
+from agent.idempotency import IdempotencyCache
+
+
+def drain(queue):
+    events = []
+    while not queue.empty():
+        events.append(queue.get_nowait())
+    return events
+
+
+def test_least_recently_used_command_is_evicted():
+    cache = IdempotencyCache(maxsize=2, ttl=60)
+    cache.start("one", "add_domain", "one.test", now=0)
+    cache.start("two", "add_domain", "two.test", now=1)
+    assert cache.get("one", now=2) is not None
+    cache.start("three", "add_domain", "three.test", now=3)
+
+    assert cache.get("two", now=4) is None
+    assert cache.get("one", now=4)["domain"] == "one.test"
+    assert cache.resolve("add_domain", "two.test", {"action": "add_domain"}, now=4) is None
+
+
+def test_expired_command_runs_again():
+    cache = IdempotencyCache(maxsize=10, ttl=60)
+    cache.start("one", "add_domain", "one.test", now=0)
+    assert cache.get("one", now=60) is None
+
+
+def test_duplicate_add_domain_is_answered_without_a_second_order(worker, store):
+    message = {"content": {"action": "add_domain", "message_id": "m-1", "payload": {"domain": "one.test"}}}
+
+    async def run():
+        await worker.dispatch(message)
+        first = drain(store.producer_queue)
+        await worker.dispatch(message)
+        return first, drain(store.producer_queue)
+
+    first, second = asyncio.run(run())
+    assert list(worker.reserved) == ["one.test"]
+    assert len(worker.ratelimit.orders["registered_domain:one.test"]) == 1
+    assert [event.get("duplicate") for event in second] == [True]
+    assert second[0]["message_id"] == "m-1"
+    assert all(not event.get("duplicate") for event in first)
@@ -0,0 +1,24 @@
+from agent.journal import OutboundJournal
+
+
+def test_progress_is_not_journaled():
+    journal = OutboundJournal(10)
+    event = {"action": "acme_pending", "message": {"domain": "one.test"}}
+    assert journal.append(event) == event
+    assert len(journal) == 0
+
+
+def test_stats_are_evicted_before_results(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = OutboundJournal(3, path)
+    journal.append({"action": "acme_success", "message": {"domain": "one.test"}})
+    for number in range(5):
+        journal.append({"action": "log_stats", "message": {"number": number}})
+    journal.append({"action": "install_bundle", "message": {"domain": "two.test"}})
+
+    kept = [(event["action"], event["message"]) for event in journal.events.values()]
+    assert kept == [("acme_success", {"domain": "one.test"}), ("log_stats", {"number": 4}),
+                    ("install_bundle", {"domain": "two.test"})]
+
+    # a restarted agent replays the same.
+    assert list(OutboundJournal(3, path).events) == list(journal.events)
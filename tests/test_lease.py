@@ -0,0 +1,46 @@
+import asyncio
+
+import fakeredis
+import redis.asyncio
+
+from agent.lease import IssuanceCoordinator
+from agent.models import Domain, FAILED
+
+
+def coordinated(worker, store, monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.asyncio.Redis, "from_url", lambda url: fakeredis.aioredis.FakeRedis(server=server))
+    store.shared_redis_url = "redis://shared.test"
+    worker.coordinator = IssuanceCoordinator(store)
+    return worker.coordinator
+
+
+def test_failed_issuance_backs_off_every_node(worker, store, monkeypatch):
+    coordinator = coordinated(worker, store, monkeypatch)
+    orders = []
+
+    async def fork(instance):
+        orders.append(instance.domain)
+        instance.status, instance.on_error = FAILED, "NXDOMAIN"
+        store.set_cache(instance.domain, instance)
+
+    monkeypatch.setattr(worker, "letsencrypt_fork", fork)
+
+    async def issue_twice():
+        for _ in range(2):
+            store.set_cache("one.test", Domain("one.test"))
+            await worker.coordinated_issue(Domain("one.test"))
+        return await coordinator.failure("one.test")
+
+    failure = asyncio.run(issue_twice())
+    assert orders == ["one.test"]
+    assert failure["error"] == "NXDOMAIN" and failure["backoff"] == coordinator.failure_backoff
+    assert "NXDOMAIN" in store.get_cache("one.test").on_error
+
+
+def test_dropped_domain_is_not_ordered(worker, store, monkeypatch):
+    coordinated(worker, store, monkeypatch)
+    worker.reserved["gone.test"] = 1.0
+
+    asyncio.run(worker.coordinated_issue(Domain("gone.test")))
+    assert "gone.test" not in worker.reserved
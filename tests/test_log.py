@@ -0,0 +1,40 @@
+import logging
+
+from agent.log import Payload, QueueHandler, RateLimitFilter
+
+
+def record(created: float, level: int = logging.WARNING, lineno: int = 10) -> logging.LogRecord:
+    item = logging.LogRecord("agent.gw", level, "gw.py", lineno, "reconnect failed", None, None)
+    item.created = created
+    return item
+
+
+def test_payload_is_bounded_and_keeps_order():
+    rendered = str(Payload({"b": "x" * 500, "a": list(range(25)), "nested": {"one": {"two": {"three": 3}}}}))
+    assert rendered.startswith("{'b': 'xxx")
+    assert "... 300 more" in rendered and "... 15 more" in rendered
+    assert "{'two': {...}}" in rendered
+
+
+def test_rate_limit_per_call_site_reports_suppressed():
+    limiter = RateLimitFilter()
+    passed = [limiter.filter(record(100 + number / 100)) for number in range(limiter.burst + 5)]
+    assert passed.count(True) == limiter.burst
+    # another line is its own call site, DEBUG is never sampled.
+    assert limiter.filter(record(101, lineno=20))
+    assert all(limiter.filter(record(101, logging.DEBUG)) for _ in range(limiter.burst * 2))
+
+    after = record(100 + limiter.interval)
+    assert limiter.filter(after)
+    assert after.msg == "reconnect failed (5 similar messages suppressed)"
+
+
+def test_queue_handler_cuts_long_messages_and_drops_when_full():
+    handler = QueueHandler(maxsize=1)
+    long = logging.LogRecord("agent.gw", logging.INFO, "gw.py", 1, "%s", ("x" * 5000,), None)
+    handler.handle(long)
+    handler.handle(record(1))
+    queued = handler.queue.get_nowait()
+    assert queued.getMessage().endswith("(904 more characters)")
+    assert long.args == ("x" * 5000,)
+    assert handler.queue.empty()
@@ -0,0 +1,44 @@
+import os
+
+from agent.logstats import LogAggregator, LogStats
+
+
+def line(host: str, status: int, prefix: str = '1.2.3.4') -> bytes:
+    return (f'{prefix} - - [01/Jan/2026:00:00:00 +0000] "GET https://{host}/ HTTP/1.1" {status} 10 "-" "curl" 0.010\n'
+            .encode())
+
+
+def test_custom_statuses_get_their_own_bucket():
+    aggregator = LogAggregator()
+    assert aggregator.feed(b"".join(line("one.test", status) for status in (200, 404, 600, 799, 999))) == 5
+    assert aggregator.serialize()["one.test"]["status"] == {"2xx": 1, "4xx": 1, "6xx": 1, "7xx": 1, "9xx": 1}
+
+
+def test_multi_hop_forwarded_for_in_main_and_shared_formats():
+    aggregator = LogAggregator()
+    lines = [
+        line("main.test", 200, "1.2.3.4, 10.0.0.1, 10.0.0.2"),
+        line("shared.test", 200, "shared.test 1.2.3.4, 10.0.0.1"),
+        line("shared.test", 404, "shared.test -"),
+    ]
+    assert aggregator.feed(b"".join(lines)) == 3
+    hosts = aggregator.serialize()
+    assert hosts["main.test"]["requests"] == 1
+    assert hosts["shared.test"]["status"] == {"2xx": 1, "4xx": 1}
+
+
+def test_poll_budget_rotates_over_files(store, tmp_path):
+    log_path = tmp_path / "logs"
+    log_path.mkdir()
+    for name in ("a.test", "b.test"):
+        with open(log_path / f"{name}.log", 'wb') as f:
+            f.write(line(name, 200) * 1000)
+    store.log_path = str(log_path)
+    stats = LogStats(store)
+    stats.rescan(from_end=False)
+    stats.bytes_per_second = os.path.getsize(log_path / "a.test.log") // 4
+
+    stats.aggregator.merge(stats.poll())
+    stats.aggregator.merge(stats.poll())
+    hosts = stats.aggregator.serialize()
+    assert set(hosts) == {"a.test", "b.test"}
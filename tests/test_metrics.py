@@ -0,0 +1,42 @@
+import asyncio
+
+import agent.metrics
+from agent.metrics import Counter, Gauge, Histogram, MetricsServer
+
+
+def test_histogram_buckets_are_cumulative(monkeypatch):
+    monkeypatch.setattr(agent.metrics, "REGISTRY", [])
+    histogram = Histogram("test_seconds", "Test.", ["op"], (0.1, 1))
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value, op="get")
+
+    assert histogram.samples() == [
+        'test_seconds_bucket{op="get",le="0.1"} 2',
+        'test_seconds_bucket{op="get",le="1"} 3',
+        'test_seconds_bucket{op="get",le="+Inf"} 4',
+        'test_seconds_sum{op="get"} 5.65',
+        'test_seconds_count{op="get"} 4',
+    ]
+
+
+def test_scrape_renders_counters_and_gauge_functions(store, monkeypatch):
+    monkeypatch.setattr(agent.metrics, "REGISTRY", [])
+    Counter("test_total", "Test.", ["result"]).inc(result="ok")
+    gauge = Gauge("test_depth", "Test.", ["queue"])
+    gauge.set_function(lambda: 3, queue="receive")
+    gauge.set_function(lambda: 1 / 0, queue="broken")
+
+    async def scrape(path: bytes):
+        server = await asyncio.start_server(MetricsServer(store).handle, "127.0.0.1", 0)
+        async with server:
+            reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+            writer.write(b"GET " + path + b" HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+            return response.decode()
+
+    response = asyncio.run(scrape(b"/metrics"))
+    assert response.startswith("HTTP/1.1 200 OK")
+    assert 'test_total{result="ok"} 1' in response
+    assert 'test_depth{queue="receive"} 3' in response and "broken" not in response
+    assert asyncio.run(scrape(b"/other")).startswith("HTTP/1.1 404")
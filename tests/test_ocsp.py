@@ -0,0 +1,66 @@
+import asyncio
+import json
+import os
+
+import agent.ocsp
+from agent.ocsp import OcspStapler, ocsp_state_path
+from agent.state import certificate_digest
+from agent.vhost import ocsp_response_path, vhost_path, write_vhost
+
+
+def renewed_domain(store, domain: str):
+    """ a served domain whose response and sidecar are still those of the previous certificate. """
+    live = os.path.join(store.letsencrypt_path, "live", domain)
+    os.makedirs(live)
+    for name in ("cert.pem", "chain.pem", "fullchain.pem", "privkey.pem"):
+        with open(os.path.join(live, name), 'wb') as f:
+            f.write(b"renewed " + name.encode())
+    os.makedirs(os.path.join(store.nginx_path, "conf.d"))
+    response_path = ocsp_response_path(store.letsencrypt_path, domain)
+    os.makedirs(os.path.dirname(response_path), exist_ok=True)
+    with open(response_path, 'wb') as f:
+        f.write(b"response for the previous serial")
+    with open(ocsp_state_path(response_path), 'w') as f:
+        json.dump({"this_update": 1000, "next_update": 10 ** 10, "certificate": certificate_digest(b"previous")}, f)
+    write_vhost(store.nginx_path, store.letsencrypt_path, domain)
+    return response_path
+
+
+def test_failed_refresh_unstaples_response_of_replaced_certificate(store, monkeypatch):
+    def unreachable(*args):
+        raise ValueError("responder unreachable")
+
+    monkeypatch.setattr(agent.ocsp, "fetch_response", unreachable)
+    response_path = renewed_domain(store, "one.test")
+    stapler = OcspStapler(store, reloader=None)
+    assert stapler.needs_refresh("one.test", 2000)
+
+    assert asyncio.run(stapler.refresh("one.test"))
+    assert not os.path.exists(response_path)
+    assert not os.path.exists(ocsp_state_path(response_path))
+    with open(vhost_path(store.nginx_path, "one.test")) as f:
+        assert "ssl_stapling" not in f.read()
+
+
+def test_response_of_current_certificate_is_kept(store):
+    response_path = renewed_domain(store, "one.test")
+    with open(ocsp_state_path(response_path), 'w') as f:
+        json.dump({"this_update": 1000, "next_update": 10 ** 10,
+                   "certificate": certificate_digest(b"renewed cert.pem")}, f)
+    assert not OcspStapler(store, reloader=None).needs_refresh("one.test", 2000)
+
+
+def test_failed_refresh_unstaples_expired_response(store, monkeypatch):
+    def unreachable(*args):
+        raise ValueError("responder unreachable")
+
+    monkeypatch.setattr(agent.ocsp, "fetch_response", unreachable)
+    response_path = renewed_domain(store, "one.test")
+    with open(ocsp_state_path(response_path), 'w') as f:
+        json.dump({"this_update": 1000, "next_update": 2000,
+                   "certificate": certificate_digest(b"renewed cert.pem")}, f)
+
+    assert asyncio.run(OcspStapler(store, reloader=None).refresh("one.test"))
+    assert not os.path.exists(response_path)
+    with open(vhost_path(store.nginx_path, "one.test")) as f:
+        assert "ssl_stapling" not in f.read()
@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize("hook", ["agent.hooks.auth", "agent.hooks.deploy", "agent.hooks.clean"])
+def test_hooks_skip_the_agent_runtime(hook):
+    # the auth hook reads the domain from redis, it is the websocket and event loop modules that stay out.
+    code = (f"import sys, {hook}; "
+            "print(sorted(name for name in ('agent.cli', 'agent.worker', 'websockets') if name in sys.modules))")
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    assert output.strip() == "[]"
+
+
+def test_zipapp_bundles_tldextract_and_runs(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(os.path.join(ROOT, "bin"))
+    import build_zipapp
+
+    installed = []
+    # no index here, what pip would install is recorded instead.
+    monkeypatch.setattr(build_zipapp.subprocess, "check_call", lambda command: installed.append(command))
+    output = str(tmp_path / "nginx-agent.pyz")
+    monkeypatch.setattr(sys, "argv", ["build_zipapp.py", "--output", output, "--deps", "websockets", "tldextract"])
+    build_zipapp.main()
+
+    assert installed[0][-2:] == ["tldextract", "websockets"]
+    with zipfile.ZipFile(output) as archive:
+        assert {"__main__.py", "agent/__main__.py", "agent/hooks/auth.py"} <= set(archive.namelist())
+    result = subprocess.run([sys.executable, output, "--help"], capture_output=True, text=True)
+    assert result.returncode == 0 and "usage" in result.stdout.lower()
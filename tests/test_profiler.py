@@ -0,0 +1,48 @@
+import asyncio
+import logging
+import time
+
+import pytest
+
+from agent.profiler import LoopMonitor, SamplingProfiler
+
+
+def busy(seconds: float):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+def test_profile_names_the_blocking_function():
+    profiler = SamplingProfiler()
+
+    async def run():
+        task = asyncio.create_task(profiler.profile(0.2, top=20))
+        await asyncio.sleep(0)
+        with pytest.raises(ValueError):
+            await profiler.profile(0.1)
+        busy(0.15)
+        return await task
+
+    result = asyncio.run(run())
+    assert result["samples"] > 0
+    assert any("(busy)" in key for key, _ in result["own"])
+    assert not profiler.running
+
+
+def test_watchdog_logs_the_blocked_stack(store, caplog):
+    store.slow_callback_ms = 50
+    monitor = LoopMonitor(store)
+
+    async def run():
+        task = asyncio.create_task(monitor.run())
+        await asyncio.sleep(0.3)
+        busy(0.3)
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await task
+
+    with caplog.at_level(logging.WARNING, logger="agent.profiler"):
+        asyncio.run(run())
+    blocked = [record.getMessage() for record in caplog.records if "event loop blocked" in record.getMessage()]
+    assert len(blocked) == 1 and "in busy" in blocked[0]
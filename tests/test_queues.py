@@ -0,0 +1,70 @@
+import asyncio
+
+from agent.queues import PriorityEventQueue
+
+
+def event(action: str, domain: str = None, **data):
+    return {"action": action, "message": {"domain": domain} if domain else {}, **data}
+
+
+def drain(queue):
+    events = []
+    while not queue.empty():
+        events.append(queue.get_nowait())
+    return events
+
+
+def test_result_drops_queued_progress_of_its_domain():
+    queue = PriorityEventQueue(10)
+    queue.put_nowait(event("acme_pending", "one.test"))
+    queue.put_nowait(event("acme_pending", "two.test"))
+    queue.put_nowait(event("acme_success", "one.test"))
+
+    delivered = [(item["action"], item["message"]["domain"]) for item in drain(queue)]
+    assert delivered == [("acme_success", "one.test"), ("acme_pending", "two.test")]
+    assert queue.dropped["superseded"] == 1
+
+
+def test_heartbeats_keep_only_the_newest():
+    queue = PriorityEventQueue(10)
+    for number in range(50):
+        queue.put_nowait({"action": "heartbeat", "data": {"number": number}})
+    queue.put_nowait(event("profile_result"))
+
+    delivered = drain(queue)
+    assert [item["action"] for item in delivered] == ["heartbeat", "profile_result"]
+    assert delivered[0]["data"]["number"] == 49
+
+
+def test_shutdown_sentinel_is_not_replaced():
+    queue = PriorityEventQueue(10)
+
+    async def run():
+        await queue.put(None)
+        await queue.put({"action": "heartbeat"})
+        return drain(queue)
+
+    assert asyncio.run(run()) == [None, {"action": "heartbeat"}]
+
+
+def test_replaced_heartbeat_keeps_telemetry_changes():
+    queue = PriorityEventQueue(10)
+    queue.put_nowait({"action": "heartbeat", "data": {"telemetry": {"load1": 0.5, "worker_rss_10": 1, "full": True}}})
+    queue.put_nowait({"action": "heartbeat", "data": {"telemetry": {"load1": 0.7, "worker_rss_10": None}}})
+
+    [heartbeat] = drain(queue)
+    assert heartbeat["data"]["telemetry"] == {"load1": 0.7, "worker_rss_10": None, "full": True}
+
+
+def test_task_queue_cancel_with_full_receive_queue(worker, store):
+    async def run():
+        task = asyncio.create_task(worker.task_queue())
+        await asyncio.sleep(0)
+        # full when the cancel arrives, the handler must not wait for room.
+        for number in range(store.receive_queue.maxsize):
+            store.receive_queue.put_nowait({"action": "noop", "number": number})
+        task.cancel()
+        await asyncio.wait_for(task, 1)
+
+    asyncio.run(run())
+    assert worker.finished
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+from agent.ratelimit import LIMITS, RateLimitLedger, registered_domain
+
+
+def drain(queue):
+    events = []
+    while not queue.empty():
+        events.append(queue.get_nowait())
+    return events
+
+
+def test_burst_of_add_domain_trips_registered_domain_limit(worker, store):
+    count, _ = LIMITS["registered_domain"]
+
+    async def burst():
+        for number in range(count + 1):
+            await worker.action_add_domain({"domain": f"shop{number}.example.com"})
+        await asyncio.sleep(0)
+
+    asyncio.run(burst())
+    events = drain(store.producer_queue)
+    limited = [event for event in events if event["action"] == "acme_rate_limited"]
+    assert [event["message"]["domain"] for event in limited] == [f"shop{count}.example.com"]
+    assert limited[0]["message"]["limit"] == "registered_domain"
+    assert len(worker.reserved) == count
+
+
+def test_release_gives_back_reservation(tmp_path):
+    ledger, now = RateLimitLedger(str(tmp_path)), time.time()
+    ledger.record("example.com", now)
+    assert ledger.check("example.com", now) is None
+    for _ in range(LIMITS["san_set"][0] - 1):
+        ledger.record("example.com", now)
+    assert ledger.check("example.com", now)[0] == "san_set"
+    ledger.release("example.com", now)
+    assert ledger.check("example.com", now) is None
+    assert RateLimitLedger(str(tmp_path)).orders["san_set:example.com,*.example.com"] == [now] * 4
+
+
+def test_registered_domain_uses_public_suffix_list():
+    assert registered_domain("shop.example.co.uk") == "example.co.uk"
+    assert registered_domain("*.Example.com") == "example.com"
+
+
+def test_saves_on_loop_are_batched(tmp_path, monkeypatch):
+    ledger, writes = RateLimitLedger(str(tmp_path)), []
+    monkeypatch.setattr(RateLimitLedger, "save_delay", 0.01)
+    monkeypatch.setattr("agent.ratelimit.write_atomic", lambda path, data, mode: writes.append(data))
+
+    async def burst():
+        for number in range(10):
+            ledger.record(f"shop{number}.example.com", time.time())
+        assert writes == []
+        await asyncio.sleep(0.1)
+
+    asyncio.run(burst())
+    assert len(writes) == 1
+    ledger.record("example.org", time.time())
+    ledger.flush()
+    assert len(writes) == 2
@@ -0,0 +1,43 @@
+import asyncio
+
+from agent.state import plan
+
+DAY = 24 * 60 * 60
+
+
+def local(digest, deployed=True, expires_in=60 * DAY):
+    return {"digest": digest, "not_after": 1000 + expires_in, "deployed": deployed}
+
+
+def test_plan_routes_digest_mismatch_to_bundle_install_not_redeploy():
+    state = {
+        "same.test": local("aa"),
+        "other.test": local("bb"),
+        "missing.test": local("cc", deployed=False),
+        "any.test": local("dd"),
+        "expiring.test": local("ee", expires_in=DAY),
+    }
+    manifest = {"same.test": "aa", "other.test": "xx", "missing.test": "xx", "any.test": None,
+                "expiring.test": None, "new.test": None}
+    actions = plan(manifest, state, 1000, 30 * DAY)
+    assert actions == {
+        "issue": ["expiring.test", "new.test"],
+        "deploy": ["missing.test"],
+        "unchanged": ["same.test", "other.test", "any.test"],
+        "mismatch": ["other.test", "missing.test"],
+        "prune": [],
+    }
+
+
+def test_sync_state_orders_at_most_the_issue_limit(worker, store):
+    store.sync_issue_limit = 3
+    domains = {f"site{number}.test": None for number in range(5)}
+    asyncio.run(worker.action_sync_state({"domains": domains}))
+
+    events = []
+    while not store.producer_queue.empty():
+        events.append(store.producer_queue.get_nowait())
+    message = next(event for event in events if event["action"] == "sync_state")["message"]
+    assert message["issuing"] == ["site0.test", "site1.test", "site2.test"]
+    assert message["issue_postponed"] == 2
+    assert sorted(worker.reserved) == message["issuing"]
@@ -0,0 +1,11 @@
+from agent.telemetry import TelemetrySampler
+
+
+def test_counters_are_absolute(store):
+    sampler = TelemetrySampler(store)
+    sampler.keyframe = 100
+    assert sampler.delta({"nginx_requests": 10, "load1": 0.5}) == {"nginx_requests": 10, "load1": 0.5, "full": True}
+    # this heartbeat is lost, the next one still carries every request.
+    sampler.delta({"nginx_requests": 15, "load1": 0.5})
+    assert sampler.delta({"nginx_requests": 20, "load1": 0.5}) == {"nginx_requests": 20}
+    assert sampler.delta({"nginx_requests": 20}) == {"load1": None}
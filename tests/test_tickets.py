@@ -0,0 +1,83 @@
+import base64
+import os
+
+import pytest
+
+from agent.tickets import TicketKeyManager
+
+
+def key(key_id: str, not_before: float):
+    return {"id": key_id, "key": base64.b64encode(os.urandom(80)).decode(), "not_before": not_before}
+
+
+def current_key(manager):
+    with open(os.path.join(manager.path, TicketKeyManager.current_key), 'rb') as f:
+        return f.read()
+
+
+def test_resent_key_set_does_not_roll_back(store):
+    manager = TicketKeyManager(store, reloader=None)
+    keys = [key("A", 100), key("B", 200), key("C", 10 ** 10)]
+    manager.update(keys)
+    assert manager.rotate(1000)
+    assert (manager.active["id"], manager.previous["id"]) == ("B", "A")
+    active = current_key(manager)
+
+    manager.update(keys)
+    assert not manager.rotate(1000)
+    assert (manager.active["id"], manager.previous["id"]) == ("B", "A")
+    assert [item["id"] for item in manager.keys] == ["C"]
+    assert current_key(manager) == active
+
+    # also after a restart, from the saved state.
+    restarted = TicketKeyManager(store, reloader=None)
+    restarted.update(keys)
+    assert not restarted.rotate(1000)
+    assert restarted.active["id"] == "B"
+
+
+def test_key_older_than_active_is_ignored(store):
+    manager = TicketKeyManager(store, reloader=None)
+    manager.update([key("B", 200)])
+    manager.rotate(1000)
+    manager.update([key("late", 150)])
+    assert manager.keys == []
+    assert not manager.rotate(1000)
+
+
+def key_file(manager, name: str) -> bytes:
+    with open(os.path.join(manager.path, name), 'rb') as f:
+        return f.read()
+
+
+def test_keys_received_out_of_order_rotate_by_not_before(store):
+    manager = TicketKeyManager(store, reloader=None)
+    keys = {item["id"]: item for item in (key("C", 300), key("A", 100), key("B", 200))}
+    manager.update(list(keys.values()))
+    assert [item["id"] for item in manager.keys] == ["A", "B", "C"]
+    assert manager.next_rotation() == 100
+
+    assert manager.rotate(150)
+    # encrypt with the active key, accept the upcoming one early, fall back to the active one as previous.
+    assert key_file(manager, "current.key") == base64.b64decode(keys["A"]["key"])
+    assert key_file(manager, "next.key") == base64.b64decode(keys["B"]["key"])
+    assert key_file(manager, "previous.key") == base64.b64decode(keys["A"]["key"])
+
+    assert manager.rotate(250)
+    assert (manager.active["id"], manager.previous["id"], manager.next_rotation()) == ("B", "A", 300)
+    assert key_file(manager, "next.key") == base64.b64decode(keys["C"]["key"])
+    assert key_file(manager, "previous.key") == base64.b64decode(keys["A"]["key"])
+
+
+def test_overdue_keys_skip_to_the_latest(store):
+    manager = TicketKeyManager(store, reloader=None)
+    manager.update([key("A", 100), key("B", 200), key("C", 300)])
+    assert manager.rotate(1000)
+    assert (manager.active["id"], manager.previous["id"], manager.keys) == ("C", "B", [])
+    assert key_file(manager, "next.key") == key_file(manager, "current.key")
+
+
+def test_wrong_key_size_is_rejected(store):
+    manager = TicketKeyManager(store, reloader=None)
+    with pytest.raises(ValueError):
+        manager.update([{"id": "short", "key": base64.b64encode(os.urandom(16)).decode(), "not_before": 100}])
@@ -0,0 +1,16 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from agent.utils import write_atomic
+
+
+def test_concurrent_writers_never_tear_the_file(tmp_path):
+    path = str(tmp_path / "one.test.conf")
+    payloads = [bytes([65 + number]) * 256 * 1024 for number in range(8)]
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda data: write_atomic(path, data, 0o644), payloads * 4))
+
+    with open(path, 'rb') as f:
+        assert f.read() in payloads
+    assert os.listdir(tmp_path) == ["one.test.conf"]
+    assert os.stat(path).st_mode & 0o777 == 0o644
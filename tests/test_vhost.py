@@ -0,0 +1,59 @@
+import os
+import re
+
+from agent.cli import NginxService
+from agent.vhost import deploy_vhost, logging_path, shared_server_names_path, shared_vhost_path
+
+
+def certificate(letsencrypt_path: str, domain: str):
+    live = os.path.join(letsencrypt_path, "live", domain)
+    os.makedirs(live)
+    for name in ("fullchain.pem", "privkey.pem"):
+        open(os.path.join(live, name), 'w').close()
+
+
+def default_servers(nginx_path: str):
+    """ (file, port) of every default_server across what install and the agent wrote. """
+    found = []
+    for root, _, names in os.walk(nginx_path):
+        for name in names:
+            with open(os.path.join(root, name), errors="ignore") as f:
+                found += [(name, port) for port in re.findall(r"listen\s+(\d+)[^;]*default_server", f.read())]
+    return found
+
+
+def test_shared_mode_keeps_a_single_default_server(store, monkeypatch):
+    monkeypatch.setattr(NginxService, "_gen_ssl_certificate", lambda self: None)
+    NginxService(config_dir=store.nginx_path, upstream="example.com").check()
+    for domain in ("one.test", "two.test"):
+        certificate(store.letsencrypt_path, domain)
+        deploy_vhost(store.nginx_path, store.letsencrypt_path, domain, "shared")
+
+    assert sorted(port for _, port in default_servers(store.nginx_path)) == ["443", "80"]
+    with open(shared_vhost_path(store.nginx_path)) as f:
+        assert f.read().count(f"include {shared_server_names_path(store.nginx_path)};") == 2
+    with open(shared_server_names_path(store.nginx_path)) as f:
+        assert f.read() == "server_name one.test *.one.test;\nserver_name two.test *.two.test;\n"
+
+
+def test_server_names_rebuilt_for_maps_of_an_older_agent(store):
+    os.makedirs(os.path.join(store.nginx_path, "conf.d"))
+    for domain in ("one.test", "two.test"):
+        certificate(store.letsencrypt_path, domain)
+    deploy_vhost(store.nginx_path, store.letsencrypt_path, "one.test", "shared")
+    os.remove(shared_server_names_path(store.nginx_path))
+
+    assert deploy_vhost(store.nginx_path, store.letsencrypt_path, "two.test", "shared")
+    with open(shared_server_names_path(store.nginx_path)) as f:
+        assert f.read() == "server_name one.test *.one.test;\nserver_name two.test *.two.test;\n"
+
+
+def test_shared_mode_with_per_domain_logs_caches_descriptors(store):
+    os.makedirs(os.path.join(store.nginx_path, "conf.d"))
+    certificate(store.letsencrypt_path, "one.test")
+    deploy_vhost(store.nginx_path, store.letsencrypt_path, "one.test", "shared", "domain")
+
+    with open(shared_vhost_path(store.nginx_path)) as f:
+        assert "/var/log/nginx/$agent_domain.log main;" in f.read()
+    with open(logging_path(store.nginx_path)) as f:
+        assert "open_log_file_cache" in f.read()